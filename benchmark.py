@@ -0,0 +1,824 @@
+"""
+Benchmarks de la transformación y de la subida, sin acceso a la nube.
+
+- steps: pasos fila por fila de clean_transform_data frente a sus versiones vectorizadas.
+- sql: paridad del motor 'sql' (sql_transform) con clean_transform_data, ejecutando el query
+  en DuckDB como sustituto local de BigQuery (requiere el paquete duckdb).
+- athena: espera de consultas de Athena (main.wait_for_athena_query) con un cliente que repite
+  secuencias de estados y un reloj simulado: límites del backoff, error en FAILED y timeout.
+- pipeline: filas/s y memoria pico de cada paso de clean_transform_data (normal, compacto y por shards),
+  de la serialización CSV frente a Parquet y de la subida y la ejecución completa contra clientes simulados,
+  con logs sintéticos (synthetic_data.py). Las salidas del modo compacto, por shards y de la ejecución
+  en etapas deben ser iguales a la de clean_transform_data; el resultado se compara con la línea base
+  guardada en benchmark_baseline.json (por número de filas y semilla).
+
+Uso:
+    python benchmark.py --suite steps --rows 1000000
+    python benchmark.py --suite pipeline --rows 100000
+    python benchmark.py --suite pipeline --rows 100000 --save-baseline
+    python benchmark.py --suite sql --rows 100000
+    python benchmark.py --suite athena
+"""
+import argparse
+import datetime
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+import warnings
+from io import BytesIO, StringIO
+from types import SimpleNamespace
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import clean_data as c_data
+import metrics
+import sql_transform
+import synthetic_data
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json")
+
+
+def generate_session_rows(rows: int, seed: int = 0) -> pd.DataFrame:
+    """
+    Genera filas de log ya aplanadas (como session_data) con sesiones de varios turnos.
+    """
+    rng = np.random.default_rng(seed)
+    sessions = max(rows // 5, 1)
+    session_numbers = np.sort(rng.integers(0, sessions, rows))
+    prefixes = np.array(['whatsapp:+52155', 'us-east-1:', ''])[session_numbers % 3]
+    session_ids = pd.Series(prefixes).str.cat(pd.Series(session_numbers).astype(str).str.zfill(10))
+
+    start = pd.Timestamp('2025-03-04')
+    timestamps = start + pd.to_timedelta(rng.integers(0, 86_400_000_000, rows), unit='us')
+    intents = np.array(['saldo', 'asesorEnLinea', 'FallbackIntent', 'citas', None], dtype=object)
+    domains = np.array(['creditos', 'ahorro', 'general', None], dtype=object)
+
+    return pd.DataFrame({
+        'session_id': session_ids,
+        'timestamp': timestamps,
+        'intent_name': intents[rng.integers(0, len(intents), rows)],
+        'knowledge_domain': domains[rng.integers(0, len(domains), rows)],
+    }).sort_values(by=['session_id', 'timestamp'], ignore_index=True)
+
+
+def generate_contact_rows(rows: int, seed: int = 0) -> pd.DataFrame:
+    """
+    Genera filas con sessionid y columnas de contacto como las que recibe get_contact_info: valores
+    nulos, cadenas vacías y varios valores distintos por sesión y por grupo (empates que se resuelven
+    por orden de fila y por prioridad de columna). Algunas columnas de cada grupo no aparecen.
+    """
+    rng = np.random.default_rng(seed)
+    session_data = generate_session_rows(rows, seed)
+    contacts = pd.DataFrame({'sessionid': session_data['session_id']})
+    candidates = {
+        'curp': ['CURP800101HDFABC01', 'CURP900202MDFXYZ02'],
+        'correo': ['ana@example.com', 'luis@example.com'],
+        'correoElectronico': ['ana@example.com', 'otro@example.com'],
+        'email': ['luis@example.com'],
+        'telefono': ['5512345678', '5587654321'],
+        'numeroCelular': ['5511112222'],
+        'tels': ['5533334444', '5555556666'],
+    }
+    for col, values in candidates.items():
+        options = np.array([None, None, None, ''] + values, dtype=object)
+        contacts[col] = options[rng.integers(0, len(options), rows)]
+    return contacts
+
+
+# --- Implementaciones anteriores (fila por fila), como referencia ---
+def legacy_get_contact_info(df: pd.DataFrame) -> pd.DataFrame:
+    def get_contact_info(group):
+        def find_first(data, cols):
+            for col in cols:
+                if col in data and not data[col].dropna().empty:
+                    return data[col].dropna().iloc[0]
+            return None
+
+        curp_cols = ['curp']
+        email_cols = ['correo', 'correoElectronico', 'correo_WA', 'email']
+        phone_cols = ['telefono', 'numeroCelular', 'phoneNumber', 'tel1', 'telefono1_WA', 'telefonos', 'tels']
+
+        curp = find_first(group, curp_cols)
+        correo = find_first(group, email_cols)
+        telefono = find_first(group, phone_cols)
+
+        if not telefono and 'sessionid' in group:
+            session_id_val = group['sessionid'].iloc[0]
+            if isinstance(session_id_val, str) and session_id_val.startswith('whatsapp:'):
+                telefono = session_id_val.replace('whatsapp:', '')
+
+        return pd.Series({'curp': curp, 'correo': correo, 'telefono': telefono})
+
+    # La versión anterior usaba también la columna de agrupación dentro de cada grupo
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", DeprecationWarning)
+        return df.groupby('sessionid').apply(get_contact_info).reset_index()
+
+
+def legacy_determinar_canal(session_ids: pd.Series) -> pd.Series:
+    def determinar_canal(session_id):
+        session_id_str = str(session_id)
+        if 'whatsapp:' in session_id_str:
+            return 'whatsapp'
+        elif 'us-east-1' in session_id_str:
+            return 'text'
+        else:
+            return 'speech'
+    return session_ids.apply(determinar_canal)
+
+
+def legacy_fill_within_session(values: pd.Series, session_ids: pd.Series) -> pd.Series:
+    return values.groupby(session_ids).transform(lambda x: x.ffill().bfill())
+
+
+def legacy_format_duration(durations: pd.Series) -> pd.Series:
+    def format_duration(td):
+        total_seconds = int(td.total_seconds())
+        hours, remainder = divmod(total_seconds, 3600)
+        minutes, seconds = divmod(remainder, 60)
+        return f"{hours:02}:{minutes:02}:{seconds:02}"
+    return durations.apply(format_duration)
+
+
+def legacy_flag(values: pd.Series, expected: str, flag, default) -> pd.Series:
+    return values.apply(lambda x: flag if x == expected else default)
+
+
+def vectorized_flag(values: pd.Series, expected: str, flag, default) -> pd.Series:
+    return pd.Series(np.where(values == expected, flag, default), index=values.index, dtype=object)
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def run_steps(rows: int):
+    session_data = generate_session_rows(rows)
+    session_times = session_data.groupby('session_id')['timestamp'].agg(['min', 'max'])
+    durations = session_times['max'] - session_times['min']
+    contacts = generate_contact_rows(rows)
+
+    steps = [
+        ('canal', rows, legacy_determinar_canal, c_data.determinar_canal, (session_data['session_id'],)),
+        ('intent ffill/bfill', rows, legacy_fill_within_session, c_data.fill_within_session,
+         (session_data['intent_name'], session_data['session_id'])),
+        ('duracion', len(durations), legacy_format_duration, c_data.format_duration, (durations,)),
+        ('transferenciaasesor', rows, legacy_flag, vectorized_flag,
+         (session_data['intent_name'], 'asesorEnLinea', 'Si', '')),
+        ('fallbackmessage', rows, legacy_flag, vectorized_flag,
+         (session_data['intent_name'], 'FallbackIntent', 'Yes', None)),
+        ('contacto', rows, legacy_get_contact_info, c_data.get_contact_info, (contacts,)),
+    ]
+
+    print(f"{'paso':<22}{'filas':>10}{'antes filas/s':>16}{'después filas/s':>18}{'aceleración':>13}")
+    for name, step_rows, before, after, args in steps:
+        expected, before_seconds = timed(before, *args)
+        result, after_seconds = timed(after, *args)
+        if isinstance(expected, pd.DataFrame):
+            pd.testing.assert_frame_equal(expected, result)
+        else:
+            pd.testing.assert_series_equal(expected, result, check_dtype=False, check_names=False)
+        print(f"{name:<22}{step_rows:>10}{step_rows / before_seconds:>16,.0f}"
+              f"{step_rows / after_seconds:>18,.0f}{before_seconds / after_seconds:>12.1f}x")
+
+
+# --- Suite sql ---
+def get_arrow_field_paths(fields, prefix: str = "") -> set:
+    """
+    Rutas 'a.b.c' de los campos de un esquema Arrow (equivalente a sql_transform.get_schema_field_paths).
+    """
+    paths = set()
+    for field in fields:
+        path = f"{prefix}{field.name}"
+        paths.add(path)
+        if pa.types.is_struct(field.type):
+            paths |= get_arrow_field_paths(list(field.type), f"{path}.")
+    return paths
+
+
+def run_sql_parity(rows: int, seed: int = 0, without_contact_slots: bool = False):
+    """
+    Ejecuta el query de sql_transform en DuckDB y clean_transform_data sobre las mismas filas
+    sintéticas y compara las salidas (ordenadas por timestamp y sessionid, porque los empates
+    de timestamp pueden quedar en distinto orden). Devuelve True si son iguales.
+    Con without_contact_slots se quitan los slots curp/correo/telefono, de modo que la salida
+    incluye las columnas de contacto.
+    """
+    import duckdb
+
+    raw = synthetic_data.generate_log_rows(rows, seed=seed)
+    if without_contact_slots:
+        for payload in raw['jsonPayload']:
+            for key in sql_transform.CONTACT_GROUPS:
+                payload['session_attributes'].pop(key, None)
+    table = pa.Table.from_pandas(raw, preserve_index=False)
+    field_paths = get_arrow_field_paths(table.schema)
+
+    connection = duckdb.connect()
+    connection.execute("SET TimeZone = 'UTC'")
+    connection.register("logs", table)
+    query = sql_transform.build_session_query("SELECT * FROM logs", field_paths, dialect="duckdb")
+    sql_df, sql_seconds = timed(lambda: sql_transform.finalize_results(connection.execute(query).df(), field_paths))
+    pandas_df, pandas_seconds = timed(c_data.clean_transform_data, raw.copy())
+
+    def digest(df):
+        return get_output_digest(df.sort_values(by=['timestamp', 'sessionid']))
+
+    equal = list(sql_df.columns) == list(pandas_df.columns) and digest(sql_df) == digest(pandas_df)
+    print(f"{rows:,} filas, {len(pandas_df):,} sesiones, {len(pandas_df.columns)} columnas: "
+          f"pandas {rows / pandas_seconds:,.0f} filas/s, sql (DuckDB) {rows / sql_seconds:,.0f} filas/s, "
+          f"{'salidas iguales' if equal else 'SALIDAS DISTINTAS'}")
+    return equal
+
+
+# --- Clientes simulados (sin red) ---
+class StubS3Client:
+    """
+    Cliente S3 que solo cuenta los objetos y bytes recibidos; con keep_bodies guarda además el
+    contenido de cada objeto en bodies (para revisar la salida subida).
+    """
+
+    def __init__(self, keep_bodies: bool = False):
+        self.objects = {}
+        self.bodies = {}
+        self.keep_bodies = keep_bodies
+        self._uploads = {}
+
+    def put_object(self, Bucket, Key, Body):
+        self.objects[Key] = len(Body)
+        if self.keep_bodies:
+            self.bodies[Key] = bytes(Body)
+        return {}
+
+    def create_multipart_upload(self, Bucket, Key):
+        self._uploads[Key] = []
+        return {'UploadId': Key}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        # Sin keep_bodies solo se guarda el tamaño de cada parte
+        self._uploads[UploadId].append(bytes(Body) if self.keep_bodies else len(Body))
+        return {'ETag': f"etag-{PartNumber}"}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        parts = self._uploads.pop(UploadId)
+        if self.keep_bodies:
+            self.bodies[Key] = b"".join(parts)
+            parts = [len(part) for part in parts]
+        self.objects[Key] = sum(parts)
+        return {}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self._uploads.pop(UploadId, None)
+        return {}
+
+
+class StubAthenaClient:
+    """
+    Cliente Athena cuyas consultas terminan de inmediato con SUCCEEDED.
+    """
+
+    def __init__(self):
+        self.queries = []
+
+    def start_query_execution(self, QueryString, QueryExecutionContext, ResultConfiguration):
+        self.queries.append(QueryString)
+        return {'QueryExecutionId': f"q{len(self.queries)}"}
+
+    def get_query_execution(self, QueryExecutionId):
+        return {'QueryExecution': {
+            'QueryExecutionId': QueryExecutionId,
+            'StatementType': 'DML',
+            'Status': {'State': 'SUCCEEDED'},
+            'Statistics': {'EngineExecutionTimeInMillis': 0, 'QueryQueueTimeInMillis': 0, 'DataScannedInBytes': 0},
+        }}
+
+
+class ReplayAthenaClient:
+    """
+    Cliente Athena que devuelve, en cada get_query_execution, el siguiente estado de states
+    (el último se repite para siempre). Las estadísticas de cola y de motor son el tiempo que la
+    consulta lleva en QUEUED y en RUNNING según clock; cada respuesta se guarda en executions.
+    """
+
+    def __init__(self, states, clock, reason: str = None):
+        self.states = list(states)
+        self.clock = clock
+        self.reason = reason
+        self.executions = []
+        self._entered = {}
+
+    def get_query_execution(self, QueryExecutionId):
+        state = self.states[min(len(self.executions), len(self.states) - 1)]
+        now = self.clock()
+        self._entered.setdefault(state, now)
+        status = {'State': state}
+        if state == 'FAILED' and self.reason:
+            status['StateChangeReason'] = self.reason
+        queued_until = self._entered.get('RUNNING', now)
+        execution = {
+            'QueryExecutionId': QueryExecutionId,
+            'StatementType': 'DML',
+            'Status': status,
+            'Statistics': {
+                'QueryQueueTimeInMillis': int((queued_until - self._entered.get('QUEUED', queued_until)) * 1000),
+                'EngineExecutionTimeInMillis': int((now - self._entered['RUNNING']) * 1000) if 'RUNNING' in self._entered else 0,
+            },
+        }
+        self.executions.append(execution)
+        return {'QueryExecution': execution}
+
+
+class FakeClock:
+    """
+    Reloj para wait_for_athena_query: sleep avanza el reloj sin esperar y guarda cada intervalo.
+    """
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds: float):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class StubBigQueryClient:
+    """
+    Cliente BigQuery cuyos queries devuelven siempre las filas sintéticas, ya en Arrow
+    (como la lectura por REST de main.fetch_query_results).
+    """
+    project = 'benchmark'
+    destination = None
+
+    def __init__(self, results: pd.DataFrame):
+        self.results = results
+        self.table = pa.Table.from_pandas(results, preserve_index=False)
+        self.total_rows = self.table.num_rows
+        self.page_size = None
+        self.modified = datetime.datetime(2025, 3, 4, tzinfo=datetime.timezone.utc)
+
+    def query(self, query, job_config=None):
+        return self
+
+    def result(self, page_size=None):
+        self.page_size = page_size
+        return self
+
+    def to_arrow(self, create_bqstorage_client=False):
+        return self.table
+
+    def to_dataframe_iterable(self):
+        # Las filas sintéticas ya vienen con cada sesión contigua, como con el ORDER BY del query
+        page_size = self.page_size or self.total_rows
+        for start in range(0, self.total_rows, page_size):
+            yield self.results.iloc[start:start + page_size].reset_index(drop=True)
+
+    def get_table(self, table_ref):
+        return SimpleNamespace(
+            schema=get_schema_fields(self.table.schema), modified=self.modified,
+            num_rows=self.total_rows, num_bytes=self.table.nbytes, streaming_buffer=None,
+        )
+
+
+def get_schema_fields(arrow_fields):
+    """
+    Esquema Arrow como lista de campos con name y fields (lo que lee sql_transform.get_schema_field_paths).
+    """
+    return [
+        SimpleNamespace(name=field.name, fields=get_schema_fields(field.type) if pa.types.is_struct(field.type) else [])
+        for field in arrow_fields
+    ]
+
+
+class StubClientPool:
+    """
+    Reemplazo de clients.ClientPool con los clientes simulados (sin Storage API: se lee por REST).
+    """
+
+    def __init__(self, results: pd.DataFrame):
+        self.clients = {'s3': StubS3Client(), 'athena': StubAthenaClient()}
+        self.bigquery = StubBigQueryClient(results)
+
+    def aws_client(self, service_name: str):
+        return self.clients[service_name]
+
+    def bigquery_client(self):
+        return self.bigquery
+
+    def bigquery_storage_client(self):
+        return None
+
+
+# --- Suite athena ---
+def run_athena_polling_checks():
+    """
+    Comprueba main.next_athena_poll_interval y main.wait_for_athena_query con ReplayAthenaClient
+    y FakeClock: límites del backoff, error en FAILED y timeout de una consulta que nunca termina.
+    Devuelve la lista de problemas.
+    """
+    import main
+
+    problems = []
+
+    def check(condition: bool, message: str):
+        if not condition:
+            problems.append(message)
+
+    initial, backoff, maximum = main.ATHENA_POLL_INITIAL_SECONDS, main.ATHENA_POLL_BACKOFF, main.ATHENA_POLL_MAX_SECONDS
+
+    def interval_bound(attempt: int, execution: dict) -> float:
+        # Intervalo antes del jitter: backoff exponencial o una fracción del tiempo transcurrido, entre initial y maximum
+        statistics = execution['Statistics']
+        elapsed_ms = statistics['QueryQueueTimeInMillis'] if execution['Status']['State'] == 'QUEUED' else statistics['EngineExecutionTimeInMillis']
+        return min(max(initial * backoff ** attempt, main.ATHENA_POLL_ELAPSED_FRACTION * elapsed_ms / 1000, initial), maximum)
+
+    # Límites de next_athena_poll_interval: el jitter va de la mitad del intervalo al intervalo completo
+    previous = 0
+    for attempt in range(12):
+        for state, statistic in (('QUEUED', 'QueryQueueTimeInMillis'), ('RUNNING', 'EngineExecutionTimeInMillis')):
+            for elapsed_seconds in (0, 10, 60, 600):
+                execution = {'Status': {'State': state}, 'Statistics': {statistic: elapsed_seconds * 1000}}
+                bound = interval_bound(attempt, execution)
+                low = main.next_athena_poll_interval(attempt, execution, rand=lambda: 0.0)
+                high = main.next_athena_poll_interval(attempt, execution, rand=lambda: 1.0)
+                check(abs(low - bound / 2) < 1e-9 and abs(high - bound) < 1e-9,
+                      f"intervalo {state} intento {attempt} con {elapsed_seconds}s: [{low}, {high}] frente a [{bound / 2}, {bound}]")
+                check(initial / 2 <= low <= high <= maximum, f"intervalo fuera de [{initial / 2}, {maximum}]: [{low}, {high}]")
+        execution = {'Status': {'State': 'RUNNING'}, 'Statistics': {}}
+        current = main.next_athena_poll_interval(attempt, execution, rand=lambda: 1.0)
+        check(current >= previous, f"el intervalo baja del intento {attempt - 1} al {attempt}: {previous} -> {current}")
+        previous = current
+    check(previous == maximum, f"el backoff no llega a ATHENA_POLL_MAX_SECONDS: {previous}")
+    long_running = {'Status': {'State': 'RUNNING'}, 'Statistics': {'EngineExecutionTimeInMillis': 3_600_000}}
+    check(main.next_athena_poll_interval(0, long_running, rand=lambda: 1.0) == maximum,
+          "una consulta que lleva una hora corriendo no se consulta con el intervalo máximo")
+
+    # QUEUED -> RUNNING -> SUCCEEDED: una consulta por estado y esperas dentro de los límites
+    clock = FakeClock()
+    states = ['QUEUED', 'QUEUED', 'RUNNING', 'RUNNING', 'RUNNING', 'SUCCEEDED']
+    client = ReplayAthenaClient(states, clock)
+    status = main.wait_for_athena_query('q-ok', timeout_seconds=300, athena_client=client, sleep=clock.sleep, clock=clock)
+    check(status == 'SUCCEEDED', f"estado final {status} en lugar de SUCCEEDED")
+    check(len(client.executions) == len(states), f"{len(client.executions)} consultas de estado para {len(states)} estados")
+    check(len(clock.sleeps) == len(states) - 1, f"{len(clock.sleeps)} esperas para {len(states) - 1} estados intermedios")
+    for attempt, (seconds, execution) in enumerate(zip(clock.sleeps, client.executions)):
+        bound = interval_bound(attempt, execution)
+        check(bound / 2 <= seconds <= bound, f"espera {attempt} de {seconds:.3f}s fuera de [{bound / 2:.3f}, {bound:.3f}]")
+
+    # QUEUED -> RUNNING -> FAILED: se lanza el error con el motivo y no se vuelve a consultar
+    clock = FakeClock()
+    reason = "SYNTAX_ERROR: line 1:8: Column 'x' cannot be resolved"
+    client = ReplayAthenaClient(['QUEUED', 'RUNNING', 'FAILED'], clock, reason=reason)
+    try:
+        main.wait_for_athena_query('q-failed', athena_client=client, sleep=clock.sleep, clock=clock)
+        check(False, "FAILED no lanzó una excepción")
+    except Exception as e:
+        check(reason in str(e) and 'q-failed' in str(e), f"el error de FAILED no incluye el id y el motivo: {e}")
+    check(len(client.executions) == 3, f"{len(client.executions)} consultas de estado para QUEUED, RUNNING, FAILED")
+
+    # CANCELLED termina sin excepción
+    clock = FakeClock()
+    client = ReplayAthenaClient(['RUNNING', 'CANCELLED'], clock)
+    status = main.wait_for_athena_query('q-cancelled', athena_client=client, sleep=clock.sleep, clock=clock)
+    check(status == 'CANCELLED', f"estado final {status} en lugar de CANCELLED")
+
+    # Una consulta que nunca termina: timeout al pasar timeout_seconds, con esperas acotadas
+    clock = FakeClock()
+    timeout_seconds = 60
+    client = ReplayAthenaClient(['QUEUED', 'RUNNING'], clock)
+    try:
+        main.wait_for_athena_query('q-stuck', timeout_seconds=timeout_seconds, athena_client=client, sleep=clock.sleep, clock=clock)
+        check(False, "una consulta que nunca termina no lanzó timeout")
+    except Exception as e:
+        check('timed out' in str(e) and 'q-stuck' in str(e), f"el error de timeout no lo indica: {e}")
+    check(timeout_seconds < clock.now <= timeout_seconds + maximum,
+          f"timeout a los {clock.now:.1f}s (esperado entre {timeout_seconds} y {timeout_seconds + maximum}s)")
+    check(max(clock.sleeps) <= maximum, f"una espera de {max(clock.sleeps):.2f}s supera ATHENA_POLL_MAX_SECONDS")
+
+    print(f"wait_for_athena_query: backoff, FAILED, CANCELLED y timeout comprobados "
+          f"({len(client.executions)} consultas de estado en {clock.now:.1f}s simulados hasta el timeout)")
+    return problems
+
+
+# --- Suite pipeline ---
+class StageRecorder:
+    """
+    Guarda la duración de cada etapa y paso registrados por metrics y, si tracemalloc está
+    activo, la memoria pico de Python/NumPy durante cada uno. Los buffers de Arrow no pasan
+    por tracemalloc: su pico se mide aparte para toda la función (arrow_peak_bytes).
+    """
+
+    def __init__(self):
+        self.seconds = {}
+        self.peak_bytes = {}
+        self.arrow_peak_bytes = 0
+
+    def __call__(self, stage, seconds, fields):
+        self.seconds[stage] = self.seconds.get(stage, 0) + seconds
+        if tracemalloc.is_tracing():
+            self.peak_bytes[stage] = max(self.peak_bytes.get(stage, 0), tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+
+
+def measure(function, *args, repeats: int = 3):
+    """
+    Ejecuta function repeats veces para medir el tiempo por etapa (se queda con el menor de
+    cada etapa, el menos afectado por ruido) y una vez más con tracemalloc para medir la
+    memoria pico de cada etapa. Devuelve (resultado, StageRecorder).
+    """
+    recorder = StageRecorder()
+    metrics.stage_listeners.append(recorder)
+    try:
+        timings = {}
+        for _ in range(repeats):
+            recorder.seconds = {}
+            result = function(*args)
+            for stage, seconds in recorder.seconds.items():
+                timings[stage] = min(seconds, timings.get(stage, seconds))
+        recorder.seconds = {}
+        default_pool = pa.default_memory_pool()
+        arrow_pool = pa.proxy_memory_pool(default_pool)
+        pa.set_memory_pool(arrow_pool)
+        tracemalloc.start()
+        try:
+            function(*args)
+        finally:
+            tracemalloc.stop()
+            pa.set_memory_pool(default_pool)
+        recorder.seconds = timings
+        recorder.arrow_peak_bytes = arrow_pool.max_memory() or 0
+    finally:
+        metrics.stage_listeners.remove(recorder)
+    return result, recorder
+
+
+def get_output_digest(df: pd.DataFrame) -> str:
+    return hashlib.sha256(df.to_csv(index=False).encode("utf-8")).hexdigest()
+
+
+def run_pipelined_transfer(main):
+    """
+    main.run_transfer con PIPELINED_TRANSFER (pipeline.run_pipeline) y páginas de 10,000 filas.
+    Devuelve los objetos subidos a S3 ({llave: contenido}) para comparar la salida.
+    La memoria medida no incluye la de los procesos de transformación.
+    """
+    settings = {'PIPELINED_TRANSFER': True, 'BIGQUERY_PAGE_SIZE': 10_000, '_source_field_paths': None}
+    previous = {name: getattr(main, name) for name in settings}
+    previous_s3 = main.client_pool.clients['s3']
+    s3_client = main.client_pool.clients['s3'] = StubS3Client(keep_bodies=True)
+    try:
+        for name, value in settings.items():
+            setattr(main, name, value)
+        main.run_transfer()
+    finally:
+        main.client_pool.clients['s3'] = previous_s3
+        for name, value in previous.items():
+            setattr(main, name, value)
+    return s3_client.bodies
+
+
+def get_uploaded_output_digest(bodies: dict) -> str:
+    """
+    Digest de los archivos de datos subidos (CSV o Parquet) unidos y ordenados por sessionid, para
+    compararlo con get_sorted_output_digest: el orden de las filas entre archivos no importa.
+    """
+    frames = [pd.read_parquet(BytesIO(body)) if key.endswith(".parquet") else pd.read_csv(BytesIO(body))
+              for key, body in sorted(bodies.items()) if key.endswith((".csv", ".parquet"))]
+    if not frames:
+        return None
+    return get_sorted_output_digest(pd.concat(frames, ignore_index=True))
+
+
+def get_sorted_output_digest(df: pd.DataFrame) -> str:
+    """
+    Digest de df ordenado por sessionid, después de pasarlo por CSV (así los tipos coinciden con los
+    de un archivo leído con read_csv).
+    """
+    df = pd.read_csv(StringIO(df.to_csv(index=False)))
+    return get_output_digest(df.sort_values('sessionid', kind='mergesort', ignore_index=True))
+
+
+def run_pipeline(rows: int, seed: int = 0):
+    """
+    Mide cada etapa con logs sintéticos y devuelve {'rows', 'seed', 'output_sha256', 'stages'}.
+    stages[etapa] = {'rows', 'seconds', 'rows_per_second', 'peak_memory_mb', 'arrow_memory_mb'[, 'bytes']}.
+    Las etapas upload.* incluyen la serialización; 'run' es run_transfer completo.
+    """
+    # main lee su configuración al importarse: se importa aquí para poder fijar el entorno antes
+    import main
+
+    start = time.perf_counter()
+    raw = synthetic_data.generate_log_rows(rows, seed=seed)
+    print(f"Generadas {rows:,} filas sintéticas en {time.perf_counter() - start:.1f}s "
+          f"({raw['jsonPayload'].map(lambda payload: payload['session_attributes'].get('sessionid')).nunique():,} sesiones).")
+
+    stages = {}
+
+    def add(stage, stage_rows, seconds, peak_bytes, arrow_bytes, **extra):
+        stages[stage] = {
+            'rows': stage_rows,
+            'seconds': round(seconds, 4),
+            'rows_per_second': round(stage_rows / seconds) if seconds else None,
+            'peak_memory_mb': round(peak_bytes / 1024 ** 2, 1),
+            'arrow_memory_mb': round(arrow_bytes / 1024 ** 2, 1),
+            **extra,
+        }
+
+    # Transformación, paso por paso (metrics.StageTimer de clean_transform_data)
+    df_results, recorder = measure(lambda: c_data.clean_transform_data(raw.copy()))
+    for stage, seconds in recorder.seconds.items():
+        add(stage, rows, seconds, recorder.peak_bytes.get(stage, 0), recorder.arrow_peak_bytes)
+    add('transform', rows, sum(recorder.seconds.values()), max(recorder.peak_bytes.values()), recorder.arrow_peak_bytes)
+
+    # Mismo paso en modo compacto (clean_transform_data_compact); sus pasos se guardan como transform_compact.<paso>
+    compact_results, recorder = measure(lambda: c_data.clean_transform_data(raw.copy(), compact=True))
+    for stage, seconds in recorder.seconds.items():
+        add(stage.replace('transform.', 'transform_compact.', 1), rows, seconds, recorder.peak_bytes.get(stage, 0),
+            recorder.arrow_peak_bytes)
+    add('transform_compact', rows, sum(recorder.seconds.values()), max(recorder.peak_bytes.values()),
+        recorder.arrow_peak_bytes)
+
+    # Transformación por shards de sesiones (clean_transform_budgeted) con un presupuesto de 1/4 de la
+    # memoria estimada, en memoria y con los shards escritos en disco (Arrow IPC)
+    budget = -(-c_data.estimate_transform_memory(raw) // 4)
+    sharded = {
+        'transform_sharded': lambda: c_data.clean_transform_budgeted(raw.copy(), budget),
+        'transform_sharded_spill': lambda: c_data.clean_transform_budgeted(raw.copy(), budget, spill_dir=tempfile.gettempdir()),
+    }
+    sharded_digests = {}
+    for stage, transform in sharded.items():
+        def timed_transform(stage=stage, transform=transform):
+            with metrics.span(f"bench.{stage}"):
+                return transform()
+        sharded_results, recorder = measure(timed_transform)
+        sharded_digests[stage] = get_output_digest(sharded_results)
+        add(stage, rows, recorder.seconds[f"bench.{stage}"], max(recorder.peak_bytes.values()), recorder.arrow_peak_bytes)
+
+    # Serialización de la salida
+    serializers = {
+        'serialize.csv': lambda: df_results.to_csv(index=False, header=True).encode("utf-8"),
+        'serialize.parquet_snappy': lambda: main.dataframe_to_parquet(df_results, "snappy"),
+        'serialize.parquet_zstd': lambda: main.dataframe_to_parquet(df_results, "zstd"),
+    }
+    for stage, serialize in serializers.items():
+        def timed_serialize(stage=stage, serialize=serialize):
+            with metrics.span(stage):
+                return serialize()
+        body, recorder = measure(timed_serialize)
+        add(stage, len(df_results), recorder.seconds[stage], recorder.peak_bytes[stage], recorder.arrow_peak_bytes,
+            bytes=len(body))
+
+    # Subida y ejecución completa contra clientes simulados
+    main.client_pool = StubClientPool(raw)
+    uploads = {
+        'upload.csv': lambda: main.upload_dataframe_to_s3(df_results, "bench/data.csv", "csv"),
+        'upload.parquet': lambda: main.upload_dataframe_to_s3(df_results, "bench/data.parquet", "parquet"),
+        'upload.parquet_multipart': lambda: main.upload_dataframe_to_s3_multipart(df_results, "bench/multipart.parquet", "parquet"),
+        'run': lambda: main.run_transfer(),
+        'run_pipelined': lambda: run_pipelined_transfer(main),
+    }
+    for stage, upload in uploads.items():
+        def timed_upload(stage=stage, upload=upload):
+            with metrics.span(f"bench.{stage}"):
+                return upload()
+        output, recorder = measure(timed_upload)
+        if stage == 'run_pipelined':
+            pipelined_digest = get_uploaded_output_digest(output)
+        stage_rows = rows if stage.startswith('run') else len(df_results)
+        # Las etapas internas (serialize, upload, athena_*) reinician el pico: se toma el mayor de todas
+        add(stage, stage_rows, recorder.seconds[f"bench.{stage}"], max(recorder.peak_bytes.values()),
+            recorder.arrow_peak_bytes)
+
+    return {'rows': rows, 'seed': seed, 'output_sha256': get_output_digest(df_results),
+            'compact_output_sha256': get_output_digest(compact_results), 'sharded_output_sha256': sharded_digests,
+            'pipelined_output_sha256': {'expected': get_sorted_output_digest(df_results), 'uploaded': pipelined_digest},
+            'stages': stages}
+
+
+def load_baseline(path: str = BASELINE_PATH):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as baseline_file:
+        return json.load(baseline_file)
+
+
+def baseline_key(rows: int, seed: int):
+    return f"{rows}:{seed}"
+
+
+def check_output_parity(result: dict):
+    """
+    Devuelve la lista de variantes (modo compacto, por shards, run_transfer en etapas) cuya salida
+    es distinta a la de clean_transform_data. No depende de la línea base.
+    """
+    problems = []
+    if result['compact_output_sha256'] != result['output_sha256']:
+        problems.append("la salida del modo compacto es distinta a la de clean_transform_data")
+    for stage, digest in result['sharded_output_sha256'].items():
+        if digest != result['output_sha256']:
+            problems.append(f"la salida de {stage} es distinta a la de clean_transform_data")
+    pipelined = result['pipelined_output_sha256']
+    if pipelined['uploaded'] != pipelined['expected']:
+        problems.append("los archivos subidos por run_pipelined (ordenados por sessionid) son distintos "
+                        "a la salida de clean_transform_data")
+    return problems
+
+
+def compare_with_baseline(result: dict, baseline: dict, tolerance: float):
+    """
+    Imprime cada etapa frente a la línea base y devuelve la lista de problemas: salida distinta
+    o etapas con un throughput más de tolerance por debajo de la línea base.
+    """
+    problems = []
+    if baseline and baseline['output_sha256'] != result['output_sha256']:
+        problems.append("la salida de clean_transform_data es distinta a la de la línea base")
+
+    print(f"{'etapa':<44}{'filas/s':>14}{'base filas/s':>14}{'cambio':>9}{'memoria MB':>12}{'Arrow MB':>10}{'bytes':>14}")
+    for stage, values in result['stages'].items():
+        base = baseline.get('stages', {}).get(stage) if baseline else None
+        rate = values['rows_per_second'] or 0
+        change = ""
+        if base and base['rows_per_second']:
+            ratio = rate / base['rows_per_second']
+            change = f"{(ratio - 1) * 100:+.0f}%"
+            if ratio < 1 - tolerance:
+                problems.append(f"{stage}: {rate:,} filas/s frente a {base['rows_per_second']:,} en la línea base")
+        base_rate = f"{base['rows_per_second']:,}" if base and base['rows_per_second'] else "-"
+        size = f"{values['bytes']:,}" if 'bytes' in values else ""
+        print(f"{stage:<44}{rate:>14,}{base_rate:>14}{change:>9}{values['peak_memory_mb']:>12}{values['arrow_memory_mb']:>10}{size:>14}")
+    return problems
+
+
+def main_pipeline(rows: int, seed: int, save_baseline: bool, tolerance: float):
+    result = run_pipeline(rows, seed)
+    baselines = load_baseline()
+    key = baseline_key(rows, seed)
+    problems = compare_with_baseline(result, baselines.get(key), tolerance)
+    transform, compact = result['stages']['transform'], result['stages']['transform_compact']
+    print(f"Memoria pico de la transformación: {transform['peak_memory_mb']} MB; modo compacto: "
+          f"{compact['peak_memory_mb']} MB ({(1 - compact['peak_memory_mb'] / transform['peak_memory_mb']) * 100:.0f}% menos); "
+          f"por shards: {result['stages']['transform_sharded']['peak_memory_mb']} MB, con spill a disco: "
+          f"{result['stages']['transform_sharded_spill']['peak_memory_mb']} MB.")
+    print(f"Pico de memoria residente del proceso: {metrics.get_peak_rss_bytes() / 1024 ** 2:,.0f} MB")
+
+    # La paridad de las variantes se exige siempre; la línea base solo se usa para el throughput
+    parity_problems = check_output_parity(result)
+    for problem in parity_problems:
+        print(f"ERROR: {problem}")
+    if parity_problems:
+        return 1
+
+    if save_baseline:
+        baselines[key] = result
+        with open(BASELINE_PATH, "w") as baseline_file:
+            json.dump(baselines, baseline_file, indent=2, sort_keys=True)
+            baseline_file.write("\n")
+        print(f"Línea base guardada en {BASELINE_PATH} ({key}).")
+        return 0
+    if key not in baselines:
+        print(f"No hay línea base para {key}; usa --save-baseline para guardarla.")
+        return 0
+    for problem in problems:
+        print(f"REGRESIÓN: {problem}")
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--suite", choices=["steps", "pipeline", "sql", "athena"], default="steps")
+    parser.add_argument("--rows", type=int, help="steps: 1000000 por defecto; pipeline y sql: 100000")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--save-baseline", action="store_true", help="guarda el resultado como línea base")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="caída de filas/s frente a la línea base que se considera regresión")
+    args = parser.parse_args()
+
+    if args.suite == "steps":
+        run_steps(args.rows or 1_000_000)
+    elif args.suite == "athena":
+        os.environ.setdefault("LOG_LEVEL", "WARNING")
+        metrics.setup_logging()
+        athena_problems = run_athena_polling_checks()
+        for problem in athena_problems:
+            print(f"ERROR: {problem}")
+        sys.exit(1 if athena_problems else 0)
+    elif args.suite == "sql":
+        os.environ.setdefault("LOG_LEVEL", "WARNING")
+        metrics.setup_logging()
+        parity = [run_sql_parity(args.rows or 100_000, args.seed, without_contact_slots) for without_contact_slots in (False, True)]
+        sys.exit(0 if all(parity) else 1)
+    else:
+        # Sin nube: los clientes se reemplazan por StubClientPool y los logs por pantalla se silencian
+        os.environ.setdefault("S3_BUCKET", "benchmark")
+        os.environ.setdefault("LOG_LEVEL", "WARNING")
+        metrics.setup_logging()
+        sys.exit(main_pipeline(args.rows or 100_000, args.seed, args.save_baseline, args.tolerance))
@@ -1,81 +1,402 @@
+import logging
+import os
+import tempfile
 import pandas as pd
 import numpy as np
-from pandas import json_normalize
+import pyarrow as pa
+import pyarrow.compute as pc
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+"""
+#Verificar campos que eliminan del excel los 
+jsonPayload.gemini_final_response.
+jsonPayload.intent_information.
+jsonPayload.session_attributes.
+resource.labels.
+"""
+BASE_COLS = [
+    'timestamp', 'intent_name', 'knowledge_domain', 'origin_channel',
+    'transactional_or_non_transactional', 'configuration_name',
+    'conversation_log', 'inputTranscript', 'final_response', 'botName',
+    'inputMode', 'sessionid', 'slot_type', 'curp', 'correo', 'correoElectronico', 'correo_WA', 'email',
+    'telefono', 'numeroCelular', 'phoneNumber', 'tel1', 'telefono1_WA', 'telefonos', 'tels'
+]
+
+RESOURCE_MAP = {
+    "type": "resource_type",
+    "labels.configuration_name": "configuration_name",
+    "labels.project_id": "project_id",
+    "labels.location": "location",
+    "labels.service_name": "service_name",
+    "labels.revision_name": "revision_name",
+}
+COLUMN_MAP = {
+    # intent_information
+    "intent_information.intent_name": "intent_name",
+    "intent_information.knowledge_domain": "knowledge_domain",
+    "intent_information.origin_channel": "origin_channel",
+    "intent_information.transactional_or_non_transactional": "transactional_or_non_transactional",
+
+    # gemini_final_response
+    "gemini_final_response.final_response": "final_response",
+
+    # session_attributes
+    "session_attributes.botname": "botName",
+    "session_attributes.inputmode": "inputMode",
+    "session_attributes.sessionid": "sessionid",
+    "session_attributes.conversation_log": "conversation_log",
+    "session_attributes.inputtranscript": "inputTranscript",
+
+    # otros slots útiles (no en base_cols pero tal vez quieras guardarlos)
+    "session_attributes.clavecliente": "clavecliente",
+    "session_attributes.curp": "curp",
+    "session_attributes.telefono": "telefono",
+    "session_attributes.sucursal": "sucursal",
+    "session_attributes.estado": "estado",
+    "session_attributes.foliocita": "foliocita",
+    "session_attributes.correo": "correo",
+    "session_attributes.correoElectronico": "correoElectronico",
+    "session_attributes.correo_WA": "correo_WA",
+    "session_attributes.email": "email",
+    "session_attributes.numeroCelular": "numeroCelular",
+    "session_attributes.phoneNumber": "phoneNumber",
+    "session_attributes.tel1": "tel1",
+    "session_attributes.telefono1_WA": "telefono1_WA",
+    "session_attributes.telefonos": "telefonos",
+    "session_attributes.tels": "tels",
+}
+
+# Rutas de jsonPayload a extraer: las de COLUMN_MAP más las claves de primer nivel que
+# coinciden con columnas usadas (p. ej. slot_type).
+JSON_PAYLOAD_MAP = {
+    **COLUMN_MAP,
+    **{
+        col: col for col in BASE_COLS
+        if col != 'timestamp' and col not in COLUMN_MAP.values() and col not in RESOURCE_MAP.values()
+    },
+}
+
+# Columnas de contacto, en orden de prioridad
+CURP_COLS = ['curp']
+EMAIL_COLS = ['correo', 'correoElectronico', 'correo_WA', 'email']
+PHONE_COLS = ['telefono', 'numeroCelular', 'phoneNumber', 'tel1', 'telefono1_WA', 'telefonos', 'tels']
+
+# Modo compacto: solo se extraen las columnas que llegan a la salida. Las de COMPACT_REQUIRED_COLS
+# deben existir en el origen; si falta alguna se usa el camino completo, que les da valores por omisión.
+COMPACT_REQUIRED_COLS = [
+    'sessionid', 'intent_name', 'knowledge_domain', 'transactional_or_non_transactional',
+    'configuration_name', 'conversation_log', 'inputTranscript', 'final_response',
+]
+COMPACT_RESOURCE_MAP = {path: name for path, name in RESOURCE_MAP.items() if name in COMPACT_REQUIRED_COLS}
+COMPACT_JSON_PAYLOAD_MAP = {
+    path: name for path, name in JSON_PAYLOAD_MAP.items()
+    if name in COMPACT_REQUIRED_COLS + ['slot_type'] + CURP_COLS + EMAIL_COLS + PHONE_COLS
+}
+
+# Columnas del DataFrame final, en orden
+FINAL_COLUMNS = [
+    'timestamp', 'sessionid', 'lineanegocio', 'motivoinicial', 'respuesta',
+    'transacciondurantellamada', 'nombretransaccion', 'concluyeenvoice',
+    'transferenciaasesor', 'datollave', 'canal', 'tramiteseleccionado',
+    'tramiteaccion', 'intentprevio', 'isfallback', 'fallbackmessage',
+    'isderivacion', 'duracion', 'tiempo_por_sesion', 'horafinal',
+    '__index_level_0__', 'prestamoend', 'flujoterminado', 'curp',
+    'correo', 'telefono', 'year', 'month'
+]
+
+
+# --- Extracción selectiva de jsonPayload / resource ---
+def compile_paths(path_map: dict) -> dict:
+    """
+    Convierte {'a.b.c': 'nombre'} en un árbol {'a': {'b': {'c': 'nombre'}}} para recorrer
+    cada registro una sola vez.
+    """
+    tree = {}
+    for path, name in path_map.items():
+        node = tree
+        *parents, leaf = path.split('.')
+        for key in parents:
+            node = node.setdefault(key, {})
+        node[leaf] = name
+    return tree
+
+
+def _extract_record(record, tree, row, columns, size):
+    for key, node in tree.items():
+        if key not in record:
+            continue
+        value = record[key]
+        if isinstance(node, dict):
+            if isinstance(value, dict):
+                _extract_record(value, node, row, columns, size)
+        else:
+            column = columns.get(node)
+            if column is None:
+                column = columns[node] = [np.nan] * size
+            column[row] = value
+
+
+def _extract_arrow(values, path_map: dict, index) -> pd.DataFrame:
+    extracted = {}
+    for path, name in path_map.items():
+        try:
+            field = pc.struct_field(values, path.split('.'))
+        except (KeyError, pa.ArrowInvalid, pa.ArrowTypeError):
+            continue
+        extracted[name] = field.to_pandas().set_axis(index).astype(object)
+    return pd.DataFrame(extracted, index=index)
+
+
+def extract_fields(values, path_map: dict) -> pd.DataFrame:
+    """
+    Extrae solo las rutas de path_map ('a.b': 'columna') de una columna de registros anidados,
+    en lugar de aplanar todo el payload con json_normalize.
+    Acepta una Series de dicts, una Series respaldada por Arrow (pd.ArrowDtype de struct, como
+    la deja la lectura con la Storage API) o un arreglo Arrow de structs; en los dos últimos
+    casos se extrae con pyarrow.compute, sin crear un dict por fila.
+    Igual que json_normalize, una columna aparece si algún registro tiene la ruta, y vale
+    NaN en los registros que no la tienen.
+    """
+    if isinstance(values, (pa.Array, pa.ChunkedArray)):
+        return _extract_arrow(values, path_map, pd.RangeIndex(len(values)))
+    if isinstance(values.dtype, pd.ArrowDtype):
+        return _extract_arrow(values.array.__arrow_array__(), path_map, values.index)
+
+    tree = compile_paths(path_map)
+    columns = {}
+    for row, record in enumerate(values):
+        if isinstance(record, dict):
+            _extract_record(record, tree, row, columns, len(values))
+
+    extracted = {name: columns[name] for name in path_map.values() if name in columns}
+    return pd.DataFrame(extracted, index=values.index)
+
+
+# --- Datos de contacto por sesión ---
+def get_contact_info(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Devuelve una fila por sessionid con curp, correo y telefono.
+    Para cada grupo de columnas toma la primera columna (en orden de prioridad) con algún valor
+    en la sesión, y de ella el primer valor no nulo. Si no hay telefono y la sesión es de
+    WhatsApp, el teléfono se toma del sessionid.
+    """
+    contact_groups = {'curp': CURP_COLS, 'correo': EMAIL_COLS, 'telefono': PHONE_COLS}
+    present_cols = [col for cols in contact_groups.values() for col in cols if col in df.columns]
+    grouped = df.groupby('sessionid')
+    # first() toma el primer valor no nulo de cada columna dentro de la sesión
+    firsts = grouped[present_cols].first() if present_cols else pd.DataFrame(index=grouped.size().index)
+
+    contact_info = pd.DataFrame(index=firsts.index)
+    for name, cols in contact_groups.items():
+        value = pd.Series(None, index=firsts.index, dtype=object)
+        for col in reversed([col for col in cols if col in firsts.columns]):
+            value = firsts[col].astype(object).where(firsts[col].notna(), value)
+        contact_info[name] = value
+
+    session_ids = contact_info.index.to_series()
+    missing_phone = contact_info['telefono'].isna() | (contact_info['telefono'] == '')
+    whatsapp = session_ids.str.startswith('whatsapp:').fillna(False).astype(bool)
+    fill_phone = missing_phone & whatsapp
+    contact_info.loc[fill_phone, 'telefono'] = session_ids[fill_phone].str.replace('whatsapp:', '', regex=False)
+    contact_info = contact_info.astype(object).where(contact_info.notna(), None)
+
+    return contact_info.reset_index()
+
+
+# --- Operaciones vectorizadas ---
+TWO_DIGITS = np.array([f"{number:02}" for number in range(100)], dtype=object)
+
+
+def determinar_canal(session_ids: pd.Series) -> pd.Series:
+    """
+    Canal de la sesión según su id: 'whatsapp', 'text' (Lex us-east-1) o 'speech'.
+    """
+    # Cada sesión se repite en todos sus turnos: se evalúa una vez por id único
+    codes, unique_ids = pd.factorize(session_ids)
+    unique_ids = pd.Series(unique_ids).astype(str)
+    canal = np.select(
+        [unique_ids.str.contains('whatsapp:', regex=False), unique_ids.str.contains('us-east-1', regex=False)],
+        ['whatsapp', 'text'],
+        default='speech',
+    ).astype(object)
+    return pd.Series(canal[codes], index=session_ids.index, dtype=object)
+
+
+def fill_within_session(values: pd.Series, session_ids: pd.Series) -> pd.Series:
+    """
+    ffill seguido de bfill dentro de cada sesión, con los métodos agrupados nativos de pandas.
+    """
+    filled = values.groupby(session_ids).ffill()
+    filled = filled.groupby(session_ids).bfill()
+    # Las sesiones sin ningún valor conservan su nulo original (None), igual que transform(ffill/bfill)
+    return filled.where(filled.notna(), values)
+
+
+def format_duration(durations: pd.Series) -> pd.Series:
+    """
+    Formatea duraciones (timedelta) como HH:MM:SS, truncando los microsegundos.
+    """
+    total_seconds = (durations.dt.days * 86400 + durations.dt.seconds).to_numpy()
+    hours, remainder = np.divmod(total_seconds, 3600)
+    minutes, seconds = np.divmod(remainder, 60)
+    if len(hours) and hours.max() >= len(TWO_DIGITS):
+        hours_text = pd.Series(hours).astype(str).str.zfill(2).to_numpy(dtype=object)
+    else:
+        hours_text = TWO_DIGITS[hours]
+    formatted = hours_text + ':' + TWO_DIGITS[minutes] + ':' + TWO_DIGITS[seconds]
+    return pd.Series(formatted, index=durations.index, dtype=object)
+
+
+def text_length(values: np.ndarray) -> np.ndarray:
+    # Longitud de cada texto, 0 para los nulos (como después de fillna(''))
+    return pd.Series(values, dtype=object).str.len().fillna(0).to_numpy()
+
+
+def fill_at(values: np.ndarray, session_codes: np.ndarray, positions: np.ndarray) -> np.ndarray:
+    """
+    fill_within_session de values (con '' como nulo) evaluado solo en positions.
+    El relleno se hace sobre una categórica, así la copia por fila es de códigos y no de objetos.
+    """
+    values = pd.Series(values, dtype=object).replace('', np.nan)
+    filled = fill_within_session(values.astype('category'), session_codes)
+    filled = filled.iloc[positions].astype(object).to_numpy()
+    original = values.iloc[positions].to_numpy()
+    return np.where(pd.isna(filled), original, filled)
+
+
+def clean_transform_data_compact(df: pd.DataFrame):
+    """
+    Misma salida que clean_transform_data con menos memoria y sin modificar df:
+    - solo se extraen las rutas que llegan a la salida y no se unen al DataFrame de entrada;
+    - sessionid se codifica como categoría (códigos enteros en orden) y las filas se ordenan una
+      sola vez por sesión y timestamp; la fila representativa se elige sobre ese orden;
+    - intent_name y knowledge_domain se rellenan como categóricas;
+    - la conversación concatenada solo se arma para la fila representativa de cada sesión
+      (para elegirla basta su longitud).
+    Devuelve None si al origen le falta alguna de COMPACT_REQUIRED_COLS.
+    """
+    timer = metrics.StageTimer('transform')
+    resource_df = extract_fields(df["resource"], COMPACT_RESOURCE_MAP)
+    json_df = extract_fields(df["jsonPayload"], COMPACT_JSON_PAYLOAD_MAP)
+    timer.mark('extract_fields', rows=len(df))
+    columns = {**{col: resource_df[col] for col in resource_df.columns}, **{col: json_df[col] for col in json_df.columns}}
+    if any(col not in columns for col in COMPACT_REQUIRED_COLS):
+        return None
+
+    rows = np.flatnonzero(columns['sessionid'].notna().to_numpy())
+    if not len(rows):
+        return None
+    session_codes, session_ids = pd.factorize(columns['sessionid'].to_numpy()[rows], sort=True)
+    timestamps = pd.to_datetime(df['timestamp'], utc=True).dt.tz_localize(None).to_numpy()[rows]
+    # Único ordenamiento: por sesión y, dentro de ella, por timestamp (estable, como sort_values)
+    order = np.lexsort((timestamps, session_codes))
+    rows, session_codes, timestamps = rows[order], session_codes[order], timestamps[order]
+
+    def values(col):
+        return columns[col].to_numpy()[rows]
+
+    # Fila representativa: la de conversación más larga y, entre ellas, la más reciente; en empate
+    # la primera en el orden por timestamp. has_intent es igual en todas las filas de una sesión.
+    lengths = (text_length(values('conversation_log')) + len(', user_say: ') +
+               text_length(values('inputTranscript')) + len(', bot_say: ') + text_length(values('final_response')))
+    grouped_codes = pd.Series(session_codes)
+    candidate = lengths == pd.Series(lengths).groupby(grouped_codes).transform('max').to_numpy()
+    candidate_times = pd.Series(np.where(candidate, timestamps, np.datetime64('NaT')))
+    candidate &= timestamps == candidate_times.groupby(grouped_codes).transform('max').to_numpy()
+    candidates = np.flatnonzero(candidate)
+    representative = candidates[np.unique(session_codes[candidates], return_index=True)[1]]
+    starts = np.flatnonzero(np.r_[True, session_codes[1:] != session_codes[:-1]])
+    ends = np.r_[starts[1:], len(rows)] - 1
+    timer.mark('representative_sessions', sessions=len(session_ids))
+
+    transaccion = values('transactional_or_non_transactional')[representative]
+    if 'slot_type' in columns:
+        has_slot_type = pd.Series(values('slot_type')).notna().groupby(grouped_codes).any().to_numpy()
+        transaccion = np.where(has_slot_type, 'transactional', transaccion).astype(object)
+    motivoinicial = fill_at(values('intent_name'), grouped_codes, representative)
+    intentprevio = fill_at(values('knowledge_domain'), grouped_codes, representative)
+    nombretransaccion = values('intent_name')[representative]
+    respuesta = (
+        pd.Series(values('conversation_log')[representative], dtype=object).fillna('') + ', user_say: ' +
+        pd.Series(values('inputTranscript')[representative], dtype=object).fillna('') + ', bot_say: ' +
+        pd.Series(values('final_response')[representative], dtype=object).fillna('')
+    )
+    timer.mark('sessions', rows=len(rows))
+
+    session_start = pd.Series(timestamps[starts])
+    session_end = pd.Series(timestamps[ends])
+    duracion = format_duration(session_end - session_start)
+    DatosTemporales = pd.DataFrame({
+        'timestamp': session_start,
+        'sessionid': pd.Series(session_ids, dtype=object),
+        'lineanegocio': values('configuration_name')[representative],
+        'motivoinicial': motivoinicial,
+        'respuesta': respuesta,
+        'transacciondurantellamada': transaccion,
+        'nombretransaccion': nombretransaccion,
+        'concluyeenvoice': 'No',
+        'transferenciaasesor': np.where(nombretransaccion == 'asesorEnLinea', 'Si', '').astype(object),
+        'datollave': None,
+        'canal': determinar_canal(pd.Series(session_ids, dtype=object)),
+        'tramiteseleccionado': None,
+        'tramiteaccion': None,
+        'intentprevio': intentprevio,
+        'isfallback': None,
+        'fallbackmessage': np.where(motivoinicial == 'FallbackIntent', 'Yes', None),
+        'isderivacion': None,
+        'duracion': duracion,
+        'tiempo_por_sesion': duracion,
+        'horafinal': session_end.dt.strftime('%H:%M:%S'),
+        '__index_level_0__': '0',
+        'prestamoend': None,
+        'flujoterminado': None,
+        'year': session_start.dt.year,
+        'month': session_start.dt.month,
+    })
+    timer.mark('session_times')
+
+    # Igual que en clean_transform_data, curp/correo/telefono solo salen si el payload no trae
+    # un slot con ese nombre; los datos se toman en el orden original de las filas.
+    contact_outputs = [name for name in ('curp', 'correo', 'telefono') if name not in columns]
+    if contact_outputs:
+        contact_cols = [col for col in CURP_COLS + EMAIL_COLS + PHONE_COLS if col in columns]
+        contact_info = get_contact_info(json_df[['sessionid'] + contact_cols])
+        DatosTemporales = pd.merge(DatosTemporales, contact_info[['sessionid'] + contact_outputs], on='sessionid', how='left')
+    timer.mark('contact_info')
+
+    DatosTemporales = DatosTemporales[[col for col in FINAL_COLUMNS if col in DatosTemporales.columns]]
+    DatosTemporales = DatosTemporales.sort_values(by='timestamp', ascending=False)
+    timer.mark('output', rows=len(DatosTemporales))
+    return DatosTemporales
 
 
 # --- Limpieza y Preparación de Datos ---
-def clean_transform_data(df: pd.DataFrame):
+def clean_transform_data(df: pd.DataFrame, compact: bool = False):
+    """
+    Deja una fila por sesión con las columnas de FINAL_COLUMNS.
+    Con compact=True usa clean_transform_data_compact (mismo resultado, menos memoria) cuando
+    el origen tiene las columnas que necesita.
+    """
+    if compact:
+        DatosTemporales = clean_transform_data_compact(df)
+        if DatosTemporales is not None:
+            return DatosTemporales
+    # Cada paso queda registrado como transform.<paso> en las métricas (ver metrics.StageTimer)
+    timer = metrics.StageTimer('transform')
     df['timestamp'] = pd.to_datetime(df['timestamp'], utc=True).dt.tz_localize(None)
 
-    resource_df = json_normalize(df["resource"])
-    json_df = json_normalize(df["jsonPayload"])
-    json_df.columns = [col.replace("jsonPayload.", "") for col in json_df.columns]
-
-    """
-    #Verificar campos que eliminan del excel los 
-    jsonPayload.gemini_final_response.
-    jsonPayload.intent_information.
-    jsonPayload.session_attributes.
-    resource.labels.
-    """
-    base_cols = [
-        'timestamp', 'intent_name', 'knowledge_domain', 'origin_channel',
-        'transactional_or_non_transactional', 'configuration_name',
-        'conversation_log', 'inputTranscript', 'final_response', 'botName',
-        'inputMode', 'sessionid', 'slot_type', 'curp', 'correo', 'correoElectronico', 'correo_WA', 'email',
-        'telefono', 'numeroCelular', 'phoneNumber', 'tel1', 'telefono1_WA', 'telefonos', 'tels'
-    ]
-
-    resource_map = {
-        "type": "resource_type",
-        "labels.configuration_name": "configuration_name",
-        "labels.project_id": "project_id",
-        "labels.location": "location",
-        "labels.service_name": "service_name",
-        "labels.revision_name": "revision_name",
-    }
-    resource_df = resource_df.rename(columns=resource_map)
-    column_map = {
-        # intent_information
-        "intent_information.intent_name": "intent_name",
-        "intent_information.knowledge_domain": "knowledge_domain",
-        "intent_information.origin_channel": "origin_channel",
-        "intent_information.transactional_or_non_transactional": "transactional_or_non_transactional",
-
-        # gemini_final_response
-        "gemini_final_response.final_response": "final_response",
-
-        # session_attributes
-        "session_attributes.botname": "botName",
-        "session_attributes.inputmode": "inputMode",
-        "session_attributes.sessionid": "sessionid",
-        "session_attributes.conversation_log": "conversation_log",
-        "session_attributes.inputtranscript": "inputTranscript",
-
-        # otros slots útiles (no en base_cols pero tal vez quieras guardarlos)
-        "session_attributes.clavecliente": "clavecliente",
-        "session_attributes.curp": "curp",
-        "session_attributes.telefono": "telefono",
-        "session_attributes.sucursal": "sucursal",
-        "session_attributes.estado": "estado",
-        "session_attributes.foliocita": "foliocita",
-        "session_attributes.correo": "correo",
-        "session_attributes.correoElectronico": "correoElectronico",
-        "session_attributes.correo_WA": "correo_WA",
-        "session_attributes.email": "email",
-        "session_attributes.numeroCelular": "numeroCelular",
-        "session_attributes.phoneNumber": "phoneNumber",
-        "session_attributes.tel1": "tel1",
-        "session_attributes.telefono1_WA": "telefono1_WA",
-        "session_attributes.telefonos": "telefonos",
-        "session_attributes.tels": "tels",
-    }
-    json_df = json_df.rename(columns=column_map)
-    print(json_df.columns.tolist())
+    # Solo se extraen del payload las rutas que usa la transformación (ver extract_fields)
+    resource_df = extract_fields(df["resource"], RESOURCE_MAP)
+    json_df = extract_fields(df["jsonPayload"], JSON_PAYLOAD_MAP)
+    logger.debug(f"Columnas extraídas de jsonPayload: {json_df.columns.tolist()}")
     df = df.drop(columns=["resource"]).join(resource_df)
     df = df.drop(columns=["jsonPayload"]).join(json_df)
+    timer.mark('extract_fields', rows=len(df))
     
-    session_data = df[[col for col in base_cols if col in df.columns]].copy()
+    session_data = df[[col for col in BASE_COLS if col in df.columns]].copy()
 
     # --- Mapeo y Creación de Nuevas Columnas ---
     session_data['gemini_intent_name'] = session_data.get('intent_name')
@@ -94,15 +415,7 @@ def clean_transform_data(df: pd.DataFrame):
     # Filtrar filas donde session_id es nulo
     session_data = session_data[session_data['session_id'].notna()]
 
-    def determinar_canal(session_id):
-        session_id_str = str(session_id)
-        if 'whatsapp:' in session_id_str:
-            return 'whatsapp'
-        elif 'us-east-1' in session_id_str:
-            return 'text'
-        else:
-            return 'speech'
-    session_data['canal'] = session_data['session_id'].apply(determinar_canal)
+    session_data['canal'] = determinar_canal(session_data['session_id'])
 
     if 'slot_type' in session_data.columns:
         sessions_con_slot_type = session_data.dropna(subset=['slot_type'])['session_id'].unique()
@@ -111,13 +424,13 @@ def clean_transform_data(df: pd.DataFrame):
     session_data = session_data.sort_values(by=['session_id', 'timestamp'])
     if 'intent_name' in session_data.columns:
         session_data['intent_name'] = session_data['intent_name'].replace('', np.nan)
-        session_data['intent_name'] = session_data.groupby('session_id')['intent_name'].transform(lambda x: x.ffill().bfill())
+        session_data['intent_name'] = fill_within_session(session_data['intent_name'], session_data['session_id'])
         session_data['session_motivo_inicial'] = session_data['intent_name']
     if 'knowledge_domain' in session_data.columns:
         session_data['knowledge_domain'] = session_data['knowledge_domain'].replace('', np.nan)
-        session_data['knowledge_domain'] = session_data.groupby('session_id')['knowledge_domain'].transform(lambda x: x.ffill().bfill())
+        session_data['knowledge_domain'] = fill_within_session(session_data['knowledge_domain'], session_data['session_id'])
         session_data['gemini_knowledge_domain'] = session_data['knowledge_domain']
-
+    timer.mark('sessions', rows=len(session_data))
 
     session_data['conversation_log_length'] = session_data['session_conversation_log'].str.len()
     session_data['has_intent'] = session_data['session_motivo_inicial'].notna().astype(int)
@@ -126,32 +439,11 @@ def clean_transform_data(df: pd.DataFrame):
         by=['session_id', 'has_intent', 'conversation_log_length', 'timestamp'],
         ascending=[True, False, False, False]
     ).drop_duplicates('session_id', keep='first').copy()
+    timer.mark('representative_sessions', sessions=len(representative_sessions))
 
     # Datos de contacto
-    def get_contact_info(group):
-        def find_first(data, cols):
-            for col in cols:
-                if col in data and not data[col].dropna().empty:
-                    return data[col].dropna().iloc[0]
-            return None
-
-        curp_cols = ['curp']
-        email_cols = ['correo', 'correoElectronico', 'correo_WA', 'email']
-        phone_cols = ['telefono', 'numeroCelular', 'phoneNumber', 'tel1', 'telefono1_WA', 'telefonos', 'tels']
-
-        curp = find_first(group, curp_cols)
-        correo = find_first(group, email_cols)
-        telefono = find_first(group, phone_cols)
-
-        if not telefono and 'sessionid' in group:
-            session_id_val = group['sessionid'].iloc[0]
-            if isinstance(session_id_val, str) and session_id_val.startswith('whatsapp:'):
-                telefono = session_id_val.replace('whatsapp:', '')
-
-        return pd.Series({'curp': curp, 'correo': correo, 'telefono': telefono})
-
-    #contact_info = df.groupby('sessionid').apply(get_contact_info, include_groups=False).reset_index()
-    contact_info = df.groupby('sessionid').apply(get_contact_info).reset_index()
+    contact_info = get_contact_info(df)
+    timer.mark('contact_info')
 
 
     session_times = session_data.groupby('session_id').agg(
@@ -162,17 +454,12 @@ def clean_transform_data(df: pd.DataFrame):
     final_df = pd.merge(representative_sessions, session_times, on='session_id', how='left')
     final_df = pd.merge(final_df, contact_info, left_on='session_id', right_on='sessionid', how='left')
 
-    def format_duration(td):
-        total_seconds = int(td.total_seconds())
-        hours, remainder = divmod(total_seconds, 3600)
-        minutes, seconds = divmod(remainder, 60)
-        return f"{hours:02}:{minutes:02}:{seconds:02}"
-
-    final_df['duracion'] = (final_df['session_end'] - final_df['session_start']).apply(format_duration)
+    final_df['duracion'] = format_duration(final_df['session_end'] - final_df['session_start'])
     final_df['tiempo_por_sesion'] = final_df['duracion']
     final_df['horafinal'] = final_df['session_end'].dt.strftime('%H:%M:%S')
     final_df['year'] = final_df['session_start'].dt.year
     final_df['month'] = final_df['session_start'].dt.month
+    timer.mark('session_times')
 
 
     # --- Estructura del DataFrame Final ---
@@ -192,15 +479,17 @@ def clean_transform_data(df: pd.DataFrame):
 
     # Añadir columnas calculadas/constantes
     DatosTemporales['concluyeenvoice'] = 'No'
-    DatosTemporales['transferenciaasesor'] = DatosTemporales.get('nombretransaccion', pd.Series(dtype=str)).apply(
-        lambda x: 'Si' if x == 'asesorEnLinea' else ''
+    nombretransaccion = DatosTemporales.get('nombretransaccion', pd.Series(dtype=str))
+    DatosTemporales['transferenciaasesor'] = pd.Series(
+        np.where(nombretransaccion == 'asesorEnLinea', 'Si', ''), index=nombretransaccion.index, dtype=object
     )
     DatosTemporales['datollave'] = None
     DatosTemporales['tramiteseleccionado'] = None
     DatosTemporales['tramiteaccion'] = None
     DatosTemporales['isfallback'] = None
-    DatosTemporales['fallbackmessage'] = DatosTemporales.get('motivoinicial', pd.Series(dtype=str)).apply(
-        lambda x: 'Yes' if x == 'FallbackIntent' else None
+    motivoinicial = DatosTemporales.get('motivoinicial', pd.Series(dtype=str))
+    DatosTemporales['fallbackmessage'] = pd.Series(
+        np.where(motivoinicial == 'FallbackIntent', 'Yes', None), index=motivoinicial.index, dtype=object
     )
     DatosTemporales['isderivacion'] = None
     DatosTemporales['__index_level_0__'] = '0'
@@ -208,20 +497,236 @@ def clean_transform_data(df: pd.DataFrame):
     DatosTemporales['flujoterminado'] = None
 
     # Seleccionar y reordenar las columnas finales
-    final_columns = [
-        'timestamp', 'sessionid', 'lineanegocio', 'motivoinicial', 'respuesta',
-        'transacciondurantellamada', 'nombretransaccion', 'concluyeenvoice',
-        'transferenciaasesor', 'datollave', 'canal', 'tramiteseleccionado',
-        'tramiteaccion', 'intentprevio', 'isfallback', 'fallbackmessage',
-        'isderivacion', 'duracion', 'tiempo_por_sesion', 'horafinal',
-        '__index_level_0__', 'prestamoend', 'flujoterminado', 'curp',
-        'correo', 'telefono', 'year', 'month'
-    ]
-
-    existing_columns = [col for col in final_columns if col in DatosTemporales.columns]
+    existing_columns = [col for col in FINAL_COLUMNS if col in DatosTemporales.columns]
     DatosTemporales = DatosTemporales[existing_columns]
 
 
     DatosTemporales = DatosTemporales.sort_values(by='timestamp', ascending=False)
+    timer.mark('output', rows=len(DatosTemporales))
+
+    return DatosTemporales
+
+# --- Procesamiento por páginas (streaming) ---
+def get_session_ids(df: pd.DataFrame) -> pd.Series:
+    """
+    Extrae jsonPayload.session_attributes.sessionid de cada fila sin normalizar todo el payload.
+    """
+    extracted = extract_fields(df['jsonPayload'], {'session_attributes.sessionid': 'sessionid'})
+    if 'sessionid' not in extracted.columns:
+        return pd.Series(None, index=df.index, dtype=object)
+    return extracted['sessionid']
+
+
+def iter_session_chunks(pages):
+    """
+    Reagrupa páginas ordenadas por sessionid en trozos con sesiones completas.
+    Las filas de la última sesión de cada página se guardan y se entregan junto con la siguiente,
+    porque la sesión puede continuar ahí; las filas sin sessionid se descartan (clean_transform_data
+    también las descarta). La memoria queda acotada por el tamaño de página más las sesiones abiertas.
+    """
+    carry = None
+    for page in pages:
+        if page.empty:
+            continue
+        if carry is not None:
+            page = pd.concat([carry, page], ignore_index=True)
+        session_ids = get_session_ids(page)
+        last_session_id = session_ids.iloc[-1]
+        if pd.isna(last_session_id):
+            open_session = session_ids.isna()
+        else:
+            open_session = session_ids == last_session_id
+
+        carry = page[open_session].reset_index(drop=True)
+        ready = page[~open_session & session_ids.notna()].reset_index(drop=True)
+        if not ready.empty:
+            yield ready
+
+    if carry is not None and get_session_ids(carry).notna().any():
+        yield carry
+
+
+def clean_transform_pages(pages, compact: bool = False):
+    """
+    Aplica clean_transform_data a cada trozo de iter_session_chunks (páginas ordenadas por sessionid).
+    """
+    for chunk in iter_session_chunks(pages):
+        yield clean_transform_data(chunk, compact)
+
+
+def clean_transform_stream(pages, compact: bool = False):
+    """
+    Consume las páginas con clean_transform_pages y une el resultado (una fila por sesión)
+    con el mismo orden final que clean_transform_data.
+    Se conservan solo las columnas comunes a todas las páginas, igual que en el proceso completo
+    (p. ej. curp/correo/telefono desaparecen si algún registro trae esos slots).
+    """
+    chunks = list(clean_transform_pages(pages, compact))
+    if not chunks:
+        return pd.DataFrame()
+    DatosTemporales = pd.concat(chunks, join='inner', ignore_index=True)
+    return DatosTemporales.sort_values(by='timestamp', ascending=False)
+
+
+# --- Transformación por shards con presupuesto de memoria ---
+# Memoria de trabajo de clean_transform_data en proporción al tamaño de los campos que extrae de la entrada
+# (ver estimate_transform_memory). Medido con tracemalloc sobre logs sintéticos, con payloads en dict y en
+# Arrow: 0.8-1.0 en el proceso completo y 0.4-0.55 en modo compacto; se redondea hacia arriba.
+TRANSFORM_MEMORY_FACTOR = {False: 1.0, True: 0.6}
+# Máximo de shards: con más, el costo fijo de cada pasada supera el ahorro de memoria
+TRANSFORM_MAX_SHARDS = 32
+SPILL_COLUMNS = ['timestamp', 'resource', 'jsonPayload']
+
+
+def estimate_transform_memory(df: pd.DataFrame, compact: bool = False, memory_factor: float = None,
+                              sample_rows: int = 2000) -> int:
+    """
+    Estima en bytes la memoria de trabajo de clean_transform_data para df: extrae los campos que usa la
+    transformación de una muestra de hasta sample_rows filas repartidas en toda la entrada, mide su tamaño
+    real (memory_usage(deep=True)), lo escala al total de filas y lo multiplica por memory_factor
+    (TRANSFORM_MEMORY_FACTOR si no se da).
+    """
+    if df.empty:
+        return 0
+    sample = df.iloc[np.unique(np.linspace(0, len(df) - 1, min(sample_rows, len(df))).astype(int))]
+    resource_map, json_payload_map = (COMPACT_RESOURCE_MAP, COMPACT_JSON_PAYLOAD_MAP) if compact else (RESOURCE_MAP, JSON_PAYLOAD_MAP)
+    sample_bytes = (
+        extract_fields(sample['resource'], resource_map).memory_usage(deep=True, index=False).sum()
+        + extract_fields(sample['jsonPayload'], json_payload_map).memory_usage(deep=True, index=False).sum()
+        + sample['timestamp'].memory_usage(deep=True, index=False)
+    )
+    memory_factor = memory_factor or TRANSFORM_MEMORY_FACTOR[compact]
+    return int(sample_bytes * len(df) / len(sample) * memory_factor)
+
+
+def get_shard_count(estimated_memory: int, max_memory: int, sessions: int = None) -> int:
+    """
+    Número de shards para que la memoria estimada de cada uno quede dentro de max_memory (bytes).
+    0 o None en max_memory = sin límite (un solo shard). Nunca hay más shards que sesiones (sessions)
+    ni que TRANSFORM_MAX_SHARDS: cada shard es una pasada completa de clean_transform_data, así que con
+    un presupuesto demasiado chico se usa el máximo aunque cada shard lo supere.
+    """
+    if not max_memory or not estimated_memory:
+        return 1
+    shards = -(-estimated_memory // max_memory)
+    if shards > TRANSFORM_MAX_SHARDS:
+        logger.warning(f"El presupuesto de {max_memory / 1024 ** 2:,.1f} MB pediría {shards:,} shards para "
+                       f"{estimated_memory / 1024 ** 2:,.0f} MB estimados; se usan {TRANSFORM_MAX_SHARDS}.")
+        shards = TRANSFORM_MAX_SHARDS
+    if sessions is not None:
+        shards = min(shards, sessions)
+    return max(1, shards)
+
+
+def get_session_shards(session_ids: pd.Series, shards: int) -> list:
+    """
+    Reparte las filas por hash del sessionid (get_session_ids): todas las filas de una sesión quedan en
+    el mismo shard. Devuelve las posiciones de las filas de cada shard, en su orden original; las filas
+    sin sessionid se descartan (clean_transform_data también las descarta).
+    Se hace en una sola pasada: orden estable por shard y corte en los límites entre shards.
+    """
+    session_ids = session_ids.reset_index(drop=True)
+    positions = np.flatnonzero(session_ids.notna().to_numpy())
+    shard_of_row = pd.util.hash_pandas_object(session_ids.iloc[positions].astype(object), index=False).to_numpy() % shards
+    order = np.argsort(shard_of_row, kind='stable')
+    boundaries = np.searchsorted(shard_of_row[order], np.arange(1, shards))
+    return np.split(positions[order], boundaries)
+
+
+def get_spill_schema(df: pd.DataFrame) -> pa.Schema:
+    """
+    Esquema Arrow de las columnas de SPILL_COLUMNS para toda la entrada, sin convertirla: las columnas en
+    Arrow (pd.ArrowDtype) y las de tipos fijos se leen del dtype, y en las de dicts (object) pa.infer_type
+    recorre los valores y une los campos de todos los registros.
+    """
+    fields = []
+    for column in SPILL_COLUMNS:
+        if df[column].dtype == object:
+            fields.append(pa.field(column, pa.infer_type(df[column].to_numpy(), from_pandas=True)))
+        else:
+            fields.append(pa.Schema.from_pandas(df[[column]].iloc[:0], preserve_index=False).field(column))
+    return pa.schema(fields)
+
 
-    return DatosTemporales
\ No newline at end of file
+def spill_shards(df: pd.DataFrame, partitions: list, directory: str):
+    """
+    Escribe las filas de cada shard (solo las columnas que usa la transformación) como archivo
+    Arrow IPC en directory. Cada shard se convierte por separado con el esquema de la entrada completa
+    (get_spill_schema), así que en memoria solo hay un shard en Arrow a la vez y las columnas presentes
+    no dependen del shard. Devuelve las rutas, o None si la entrada no se puede convertir a Arrow
+    (p. ej. un campo del payload con tipos mezclados).
+    """
+    paths = []
+    try:
+        schema = get_spill_schema(df)
+        for shard, rows in enumerate(partitions):
+            if len(rows) == 0:
+                continue
+            shard_table = pa.Table.from_pandas(df[SPILL_COLUMNS].iloc[rows], schema=schema, preserve_index=False)
+            path = os.path.join(directory, f"shard-{shard:05d}.arrow")
+            with pa.OSFile(path, 'wb') as sink, pa.ipc.new_file(sink, schema) as writer:
+                writer.write_table(shard_table)
+            paths.append(path)
+    except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError) as e:
+        logger.warning(f"No se pudieron escribir los shards en disco, se transforman en memoria: {e}")
+        return None
+    return paths
+
+
+def read_shard(path: str) -> pd.DataFrame:
+    """
+    Lee un shard de spill_shards con memory map; resource y jsonPayload se quedan en Arrow (pd.ArrowDtype).
+    """
+    with pa.memory_map(path) as source:
+        table = pa.ipc.open_file(source).read_all()
+    return table.to_pandas(types_mapper=lambda arrow_type: pd.ArrowDtype(arrow_type) if pa.types.is_struct(arrow_type) else None)
+
+
+def combine_shard_results(results: list) -> pd.DataFrame:
+    """
+    Une los resultados de los shards con el mismo orden, índice y columnas que clean_transform_data
+    sobre la entrada completa: se conservan las columnas comunes a todos (como en clean_transform_stream)
+    y se reordena por sessionid antes del orden final por timestamp, para que los empates queden igual.
+    """
+    DatosTemporales = pd.concat(results, join='inner', ignore_index=True)
+    DatosTemporales = DatosTemporales.sort_values(by='sessionid', kind='mergesort', ignore_index=True)
+    return DatosTemporales.sort_values(by='timestamp', ascending=False)
+
+
+def clean_transform_budgeted(df: pd.DataFrame, max_memory: int = 0, compact: bool = False, spill_dir: str = None,
+                             memory_factor: float = None):
+    """
+    clean_transform_data dentro de un presupuesto de memoria (bytes, 0 = sin límite). Si la memoria
+    estimada para df (estimate_transform_memory) lo supera, las filas se reparten por sesión en shards
+    (get_session_shards), cada shard se transforma por separado y los resultados se unen
+    (combine_shard_results). df no se modifica.
+
+    Con spill_dir los shards se escriben como Arrow IPC en un directorio temporal dentro de spill_dir
+    y se leen de uno en uno con memory map, en lugar de copiar las filas de cada shard en memoria.
+    """
+    if not max_memory:
+        return clean_transform_data(df, compact)
+    estimated_memory = estimate_transform_memory(df, compact, memory_factor)
+    if estimated_memory <= max_memory:
+        return clean_transform_data(df, compact)
+    session_ids = get_session_ids(df)
+    shards = get_shard_count(estimated_memory, max_memory, session_ids.nunique())
+    if shards <= 1:
+        return clean_transform_data(df, compact)
+
+    partitions = get_session_shards(session_ids, shards)
+    logger.info(f"Transformación en {shards} shards de sesiones ({len(df)} filas, memoria estimada "
+                f"{estimated_memory / 1024 ** 2:,.0f} MB, presupuesto {max_memory / 1024 ** 2:,.0f} MB)")
+    results = []
+    if spill_dir:
+        with tempfile.TemporaryDirectory(prefix='transform_shards_', dir=spill_dir) as directory:
+            paths = spill_shards(df, partitions, directory)
+            if paths is not None:
+                results = [clean_transform_data(read_shard(path), compact) for path in paths]
+    if not results:
+        results = [
+            clean_transform_data(df.iloc[rows].reset_index(drop=True), compact) for rows in partitions if len(rows)
+        ]
+    if not results:
+        return clean_transform_data(df, compact)
+    return combine_shard_results(results)
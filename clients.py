@@ -0,0 +1,122 @@
+import os
+import threading
+import boto3
+from botocore.config import Config
+from google.oauth2 import service_account
+from google.cloud import bigquery
+
+try:
+    from google.cloud import bigquery_storage
+except ImportError:  # Opcional: sin él la extracción de BigQuery usa REST
+    bigquery_storage = None
+
+
+class ClientPool:
+    """
+    Registro de clientes de AWS y Google Cloud compartidos por todo el proceso.
+    Los clientes se crean la primera vez que se piden (de forma segura entre hilos) y se reutilizan,
+    evitando leer credenciales, resolver endpoints y abrir conexiones TLS nuevas en cada llamada.
+    """
+
+    def __init__(self, aws_access_key_id=None, aws_secret_access_key=None, region_name=None,
+                 credentials_path=None, max_pool_connections=20, max_attempts=5):
+        self.aws_access_key_id = aws_access_key_id
+        self.aws_secret_access_key = aws_secret_access_key
+        self.region_name = region_name
+        self.credentials_path = credentials_path
+        self.aws_config = Config(
+            max_pool_connections=max_pool_connections,
+            retries={'max_attempts': max_attempts, 'mode': 'standard'},
+        )
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._session = None
+        self._aws_clients = {}
+        self._credentials = None
+        self._bigquery_client = None
+        self._bigquery_storage_client = None
+        self._credentials_mtime = None
+
+    def _check_process(self):
+        # Los clientes no se comparten con procesos hijos (fork): cada proceso crea los suyos.
+        if self._pid != os.getpid():
+            self._reset()
+
+    def aws_client(self, service_name: str):
+        """
+        Devuelve el cliente boto3 de service_name ('s3', 'athena', ...) creado desde una única Session.
+        """
+        with self._lock:
+            self._check_process()
+            client = self._aws_clients.get(service_name)
+            if client is None:
+                if self._session is None:
+                    self._session = boto3.session.Session(
+                        aws_access_key_id=self.aws_access_key_id,
+                        aws_secret_access_key=self.aws_secret_access_key,
+                        region_name=self.region_name,
+                    )
+                client = self._session.client(service_name, config=self.aws_config)
+                self._aws_clients[service_name] = client
+            return client
+
+    def bigquery_client(self) -> bigquery.Client:
+        """
+        Devuelve el cliente de BigQuery. Si el archivo de la cuenta de servicio cambió
+        (credenciales rotadas), se vuelve a leer y se crea un cliente nuevo.
+        """
+        with self._lock:
+            self._check_process()
+            self._load_credentials()
+            if self._bigquery_client is None:
+                self._bigquery_client = bigquery.Client(
+                    credentials=self._credentials,
+                    project=self._credentials.project_id,
+                )
+            return self._bigquery_client
+
+    def bigquery_storage_client(self):
+        """
+        Devuelve el cliente de la BigQuery Storage Read API, con las mismas credenciales que
+        bigquery_client(), o None si google-cloud-bigquery-storage no está instalado.
+        """
+        if bigquery_storage is None:
+            return None
+        with self._lock:
+            self._check_process()
+            self._load_credentials()
+            if self._bigquery_storage_client is None:
+                self._bigquery_storage_client = bigquery_storage.BigQueryReadClient(credentials=self._credentials)
+            return self._bigquery_storage_client
+
+    def _load_credentials(self):
+        # Si el archivo de la cuenta de servicio cambió se descartan los clientes de Google Cloud
+        credentials_mtime = self._get_credentials_mtime()
+        if self._credentials is None or credentials_mtime != self._credentials_mtime:
+            self._credentials = service_account.Credentials.from_service_account_file(
+                self.credentials_path,
+                scopes=["https://www.googleapis.com/auth/cloud-platform"],
+            )
+            self._credentials_mtime = credentials_mtime
+            self._bigquery_client = None
+            self._bigquery_storage_client = None
+
+    def refresh(self, aws_access_key_id=None, aws_secret_access_key=None):
+        """
+        Descarta todos los clientes para que se creen de nuevo con credenciales actualizadas.
+        """
+        with self._lock:
+            if aws_access_key_id is not None:
+                self.aws_access_key_id = aws_access_key_id
+            if aws_secret_access_key is not None:
+                self.aws_secret_access_key = aws_secret_access_key
+            self._reset()
+
+    def _get_credentials_mtime(self):
+        try:
+            return os.path.getmtime(self.credentials_path)
+        except OSError:
+            return None
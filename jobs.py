@@ -0,0 +1,117 @@
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Job:
+    """
+    Ejecución del pipeline en segundo plano: estado, etapa actual y progreso.
+    """
+
+    def __init__(self, key: str, description: str):
+        self.id = uuid.uuid4().hex
+        self.key = key
+        self.description = description
+        self.status = 'queued'  # queued, running, succeeded, failed
+        self.stage = None
+        self.progress = {}
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self._lock = threading.Lock()
+
+    def set_stage(self, stage: str, **progress):
+        """
+        Marca la etapa actual del pipeline (extract, upload, athena_insert, ...) y su progreso.
+        """
+        with self._lock:
+            self.stage = stage
+            self.progress.update(progress)
+
+    @property
+    def active(self):
+        return self.status in ('queued', 'running')
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                'id': self.id,
+                'key': self.key,
+                'description': self.description,
+                'status': self.status,
+                'stage': self.stage,
+                'progress': dict(self.progress),
+                'result': self.result,
+                'error': self.error,
+                'created_at': self.created_at,
+                'started_at': self.started_at,
+                'finished_at': self.finished_at,
+            }
+
+
+class JobManager:
+    """
+    Cola de trabajos con un pool de hilos de concurrencia limitada.
+    Un trabajo nuevo con la misma llave (p. ej. la misma ventana de fechas) que otro que sigue
+    en cola o en ejecución no se lanza de nuevo: se devuelve el existente.
+    Los trabajos terminados se conservan retention_seconds para poder consultarlos.
+    """
+
+    def __init__(self, max_workers: int = 1, retention_seconds: int = 86400):
+        self.retention_seconds = retention_seconds
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job")
+        self._jobs = {}
+        self._active_by_key = {}
+        self._lock = threading.Lock()
+
+    def submit(self, key: str, description: str, function, *args, **kwargs):
+        """
+        Encola function(job, *args, **kwargs). Devuelve (job, creado); creado es False si se
+        reutilizó un trabajo activo con la misma llave.
+        """
+        with self._lock:
+            self._prune()
+            existing = self._active_by_key.get(key)
+            if existing is not None and existing.active:
+                return existing, False
+            job = Job(key, description)
+            self._jobs[job.id] = job
+            self._active_by_key[key] = job
+        self._executor.submit(self._run, job, function, args, kwargs)
+        return job, True
+
+    def get(self, job_id: str):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def list(self):
+        with self._lock:
+            return list(self._jobs.values())
+
+    def _run(self, job: Job, function, args, kwargs):
+        with job._lock:
+            job.started_at = time.time()
+            job.status = 'running'
+        status, result, error = 'failed', None, None
+        try:
+            result = function(job, *args, **kwargs)
+            status = 'succeeded'
+        except Exception as e:
+            error = str(e)
+        finally:
+            # El estado final y finished_at cambian juntos bajo el lock del manager: _prune nunca ve
+            # un trabajo terminado sin finished_at
+            with self._lock, job._lock:
+                job.finished_at = time.time()
+                job.result, job.error, job.status = result, error, status
+                if self._active_by_key.get(job.key) is job:
+                    del self._active_by_key[job.key]
+
+    def _prune(self):
+        limit = time.time() - self.retention_seconds
+        for job_id, job in list(self._jobs.items()):
+            if not job.active and job.finished_at is not None and job.finished_at < limit:
+                del self._jobs[job_id]
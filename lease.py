@@ -0,0 +1,155 @@
+"""
+Concesión (lease) sobre una ventana de carga para que dos ejecuciones no carguen la misma
+ventana a la vez. Se guarda como un JSON en S3 (o en disco) con el dueño y la expiración;
+una concesión expirada se puede tomar aunque su dueño no la haya liberado.
+
+En S3 se usan escrituras condicionales, que son atómicas en el servicio:
+- tomar una concesión libre: put_object con IfNoneMatch='*' (falla si el objeto ya existe);
+- tomar una expirada: put_object con IfMatch=<ETag leído> (falla si otra ejecución la cambió antes);
+- liberar: delete_object con IfMatch=<ETag propio> (no borra la concesión que tomó otra ejecución
+  después de que la propia expiró).
+En disco (desarrollo local) se usa os.link, que es atómico y falla si el archivo ya existe.
+"""
+import datetime
+import json
+import os
+import uuid
+from contextlib import contextmanager
+import pandas as pd
+from botocore.exceptions import ClientError
+import watermark
+
+# Códigos de S3 cuando la condición de una escritura condicional no se cumple (412) o cuando
+# otra escritura condicional sobre el mismo objeto está en curso (409)
+CONDITION_FAILED_CODES = {"PreconditionFailed", "ConditionalRequestConflict", "412", "409"}
+
+
+class LeaseUnavailable(Exception):
+    """
+    Otra ejecución tiene la concesión vigente.
+    """
+
+    def __init__(self, location: str, holder: dict):
+        super().__init__(f"{location} la tiene {holder.get('owner')} hasta {holder.get('expires_at')}")
+        self.holder = holder
+
+
+def _is_active(holder: dict, now: datetime.datetime) -> bool:
+    return bool(holder) and pd.Timestamp(holder["expires_at"]) > pd.Timestamp(now)
+
+
+def _new_holder(owner: str, ttl: datetime.timedelta, now: datetime.datetime) -> dict:
+    return {"owner": owner, "acquired_at": now.isoformat(), "expires_at": (now + ttl).isoformat()}
+
+
+def _condition_failed(error: ClientError) -> bool:
+    return error.response.get("Error", {}).get("Code") in CONDITION_FAILED_CODES
+
+
+def _acquire_file(location: str, holder: dict, now: datetime.datetime):
+    directory = os.path.dirname(location)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    # Se escribe aparte y se enlaza con os.link, que falla si el archivo ya existe
+    temp_location = f"{location}.{holder['owner']}.tmp"
+    with open(temp_location, "w") as lease_file:
+        json.dump(holder, lease_file)
+    try:
+        for _ in range(2):
+            try:
+                os.link(temp_location, location)
+                return holder
+            except FileExistsError:
+                current = watermark.load_state(location)
+                if _is_active(current, now):
+                    return current
+                # Concesión expirada: se elimina y se intenta otra vez
+                try:
+                    os.remove(location)
+                except FileNotFoundError:
+                    pass
+        return watermark.load_state(location)
+    finally:
+        os.remove(temp_location)
+
+
+def _read_s3(s3_client, bucket: str, key: str):
+    """
+    Devuelve (dueño, ETag) de la concesión guardada en S3, o ({}, None) si no existe.
+    """
+    try:
+        response = s3_client.get_object(Bucket=bucket, Key=key)
+    except s3_client.exceptions.NoSuchKey:
+        return {}, None
+    return json.loads(response["Body"].read()), response["ETag"]
+
+
+def _acquire_s3(location: str, holder: dict, now: datetime.datetime, s3_client):
+    bucket, key = watermark.parse_s3_location(location)
+    body = json.dumps(holder, indent=2, sort_keys=True).encode("utf-8")
+    for _ in range(2):
+        current, etag = _read_s3(s3_client, bucket, key)
+        if _is_active(current, now):
+            return current
+        # Libre: solo se crea si no existe; expirada: solo se reemplaza si nadie la cambió desde la lectura
+        condition = {"IfMatch": etag} if etag else {"IfNoneMatch": "*"}
+        try:
+            response = s3_client.put_object(Bucket=bucket, Key=key, Body=body, **condition)
+        except ClientError as e:
+            if not _condition_failed(e):
+                raise
+            continue
+        return {**holder, "etag": response["ETag"]}
+    current, _ = _read_s3(s3_client, bucket, key)
+    return current
+
+
+def try_acquire(location: str, owner: str, ttl: datetime.timedelta, s3_client=None,
+                now: datetime.datetime = None) -> dict:
+    """
+    Intenta tomar la concesión de location para owner. Devuelve el dueño vigente después del intento:
+    la concesión es de owner solo si el resultado tiene su mismo 'owner'. En S3 el resultado propio
+    incluye el 'etag' con el que se libera.
+    """
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    holder = _new_holder(owner, ttl, now)
+    if not location.startswith("s3://"):
+        return _acquire_file(location, holder, now)
+    return _acquire_s3(location, holder, now, s3_client)
+
+
+def release(location: str, holder: dict, s3_client=None):
+    """
+    Libera la concesión si sigue siendo de holder (el resultado propio de try_acquire): si expiró
+    y la tomó otra ejecución, no se toca.
+    """
+    if location.startswith("s3://"):
+        bucket, key = watermark.parse_s3_location(location)
+        try:
+            s3_client.delete_object(Bucket=bucket, Key=key, IfMatch=holder["etag"])
+        except ClientError as e:
+            if not _condition_failed(e):
+                raise
+        return
+    if watermark.load_state(location).get("owner") != holder["owner"]:
+        return
+    try:
+        os.remove(location)
+    except FileNotFoundError:
+        pass
+
+
+@contextmanager
+def hold(location: str, ttl: datetime.timedelta, s3_client=None):
+    """
+    Toma la concesión durante el bloque y la libera al salir. Lanza LeaseUnavailable si la tiene otra ejecución.
+    ttl debe ser mayor que la duración máxima de una ejecución.
+    """
+    owner = uuid.uuid4().hex
+    holder = try_acquire(location, owner, ttl, s3_client)
+    if holder.get("owner") != owner:
+        raise LeaseUnavailable(location, holder)
+    try:
+        yield holder
+    finally:
+        release(location, holder, s3_client)
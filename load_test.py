@@ -0,0 +1,267 @@
+"""
+Prueba de carga del servicio: lanza N solicitudes a '/' (varias a la vez) contra sustitutos
+locales de BigQuery, S3 y Athena, y reporta throughput, percentiles de latencia y si la tabla
+de destino quedó correcta (cada sesión cargada exactamente una vez, sin pérdidas ni duplicados).
+
+Las solicitudes corren en hilos de un solo proceso (como workers concurrentes de gunicorn que
+comparten S3 y Athena). El Athena local ejecuta CREATE/INSERT/DROP al terminar cada consulta y
+respeta IF NOT EXISTS, así que reproduce las carreras entre cargas simultáneas. Con --fail-inserts
+los primeros INSERT fallan, para comprobar que las tablas temporales se eliminan también en ese caso.
+
+Uso:
+    python load_test.py --requests 20 --concurrency 8
+    python load_test.py --requests 20 --concurrency 8 --no-lease --no-cache
+    python load_test.py --requests 20 --concurrency 8 --fail-inserts 3
+"""
+import argparse
+import hashlib
+import io
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+from botocore.exceptions import ClientError
+import benchmark
+import clean_data as c_data
+import synthetic_data
+
+
+class LocalS3Client(benchmark.StubS3Client):
+    """
+    S3 en memoria: guarda el contenido de los objetos y simula latency segundos por operación.
+    Respeta las escrituras y borrados condicionales (IfNoneMatch='*', IfMatch=ETag) como S3.
+    """
+
+    def __init__(self, latency: float = 0):
+        super().__init__()
+        self.latency = latency
+        self.bodies = {}
+        self._parts = {}
+        self._lock = threading.Lock()
+        self.exceptions = SimpleNamespace(NoSuchKey=type("NoSuchKey", (Exception,), {}))
+
+    @staticmethod
+    def _etag(body: bytes) -> str:
+        return f'"{hashlib.md5(body).hexdigest()}"'
+
+    @staticmethod
+    def _precondition_failed(operation: str):
+        return ClientError({'Error': {'Code': 'PreconditionFailed', 'Message': 'At least one of the pre-conditions you specified did not hold'}}, operation)
+
+    def put_object(self, Bucket, Key, Body, IfNoneMatch=None, IfMatch=None):
+        time.sleep(self.latency)
+        with self._lock:
+            current = self.bodies.get(Key)
+            if IfNoneMatch == '*' and current is not None:
+                raise self._precondition_failed('PutObject')
+            if IfMatch is not None and (current is None or self._etag(current) != IfMatch):
+                raise self._precondition_failed('PutObject')
+            self.bodies[Key] = bytes(Body)
+        super().put_object(Bucket, Key, Body)
+        return {'ETag': self._etag(bytes(Body))}
+
+    def get_object(self, Bucket, Key):
+        time.sleep(self.latency)
+        with self._lock:
+            if Key not in self.bodies:
+                raise self.exceptions.NoSuchKey(Key)
+            return {'Body': io.BytesIO(self.bodies[Key]), 'ETag': self._etag(self.bodies[Key])}
+
+    def delete_object(self, Bucket, Key, IfMatch=None):
+        time.sleep(self.latency)
+        with self._lock:
+            current = self.bodies.get(Key)
+            if IfMatch is not None and current is not None and self._etag(current) != IfMatch:
+                raise self._precondition_failed('DeleteObject')
+            self.bodies.pop(Key, None)
+        return {}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        with self._lock:
+            self._parts.setdefault(UploadId, {})[PartNumber] = bytes(Body)
+        return super().upload_part(Bucket, Key, UploadId, PartNumber, Body)
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        with self._lock:
+            parts = self._parts.pop(UploadId)
+            self.bodies[Key] = b"".join(parts[number] for number in sorted(parts))
+        return super().complete_multipart_upload(Bucket, Key, UploadId, MultipartUpload)
+
+    def list_keys(self, prefix: str):
+        with self._lock:
+            return sorted(key for key in self.bodies if key.startswith(prefix))
+
+
+class LocalAthenaClient:
+    """
+    Athena en memoria para el modo 'insert': cada consulta termina latency segundos después de
+    iniciarse y se ejecuta en ese momento sobre los archivos de LocalS3Client.
+    La tabla de destino guarda el sessionid de cada fila insertada. Los primeros fail_inserts
+    INSERT terminan en FAILED sin insertar nada.
+    """
+    CREATE = re.compile(r"CREATE EXTERNAL TABLE IF NOT EXISTS (\w+).*?LOCATION '(s3://[^']+)'", re.S)
+    INSERT = re.compile(r"INSERT INTO [\w.]+.*?FROM (\w+)", re.S)
+    DROP = re.compile(r"DROP TABLE (IF EXISTS )?(\w+)")
+
+    def __init__(self, s3_client: LocalS3Client, latency: float = 0, fail_inserts: int = 0):
+        self.s3_client = s3_client
+        self.latency = latency
+        self.fail_inserts = fail_inserts
+        self.failed_inserts = 0
+        self.tables = {}
+        self.target_rows = []
+        self._executions = {}
+        self._lock = threading.Lock()
+
+    def start_query_execution(self, QueryString, QueryExecutionContext, ResultConfiguration):
+        with self._lock:
+            execution_id = f"q{len(self._executions)}"
+            self._executions[execution_id] = {
+                'query': QueryString, 'ready_at': time.monotonic() + self.latency, 'state': None, 'reason': None,
+            }
+        return {'QueryExecutionId': execution_id}
+
+    def _execute(self, query: str):
+        if match := self.CREATE.search(query):
+            self.tables.setdefault(match.group(1), match.group(2))
+            return 'DDL'
+        if match := self.INSERT.search(query):
+            location = self.tables.get(match.group(1))
+            if location is None:
+                raise LookupError(f"Table not found {match.group(1)}")
+            if self.failed_inserts < self.fail_inserts:
+                self.failed_inserts += 1
+                raise LookupError(f"Simulated INSERT failure {self.failed_inserts} of {self.fail_inserts}")
+            prefix = location[len("s3://"):].partition("/")[2]
+            for key in self.s3_client.list_keys(prefix):
+                body = io.BytesIO(self.s3_client.bodies[key])
+                if key.endswith(".parquet"):
+                    session_ids = pq.read_table(body, columns=['sessionid']).column('sessionid').to_pylist()
+                else:
+                    session_ids = pd.read_csv(body, dtype=str, usecols=['sessionid'])['sessionid'].tolist()
+                self.target_rows.extend(session_ids)
+            return 'DML'
+        if match := self.DROP.search(query):
+            if self.tables.pop(match.group(2), None) is None and not match.group(1):
+                raise LookupError(f"Table not found {match.group(2)}")
+            return 'DDL'
+        return 'DDL'
+
+    def get_query_execution(self, QueryExecutionId):
+        with self._lock:
+            execution = self._executions[QueryExecutionId]
+            if execution['state'] is None and time.monotonic() >= execution['ready_at']:
+                try:
+                    execution['statement'] = self._execute(execution['query'])
+                    execution['state'] = 'SUCCEEDED'
+                except LookupError as e:
+                    execution['state'], execution['reason'] = 'FAILED', str(e)
+            status = {'State': execution['state'] or 'RUNNING'}
+            if execution['reason']:
+                status['StateChangeReason'] = execution['reason']
+            return {'QueryExecution': {
+                'QueryExecutionId': QueryExecutionId,
+                'StatementType': execution.get('statement', 'DDL'),
+                'Status': status,
+                'Statistics': {'EngineExecutionTimeInMillis': 0, 'QueryQueueTimeInMillis': 0, 'DataScannedInBytes': 0},
+            }}
+
+
+class LocalClientPool:
+    """
+    Reemplazo de clients.ClientPool con los sustitutos locales; el query de BigQuery tarda latency segundos.
+    """
+
+    def __init__(self, results: pd.DataFrame, latency: float = 0, fail_inserts: int = 0):
+        s3_client = LocalS3Client(latency)
+        self.clients = {'s3': s3_client, 'athena': LocalAthenaClient(s3_client, latency, fail_inserts)}
+        self.bigquery = benchmark.StubBigQueryClient(results)
+        to_arrow = self.bigquery.to_arrow
+
+        def slow_to_arrow(create_bqstorage_client=False):
+            time.sleep(latency)
+            return to_arrow(create_bqstorage_client)
+
+        self.bigquery.to_arrow = slow_to_arrow
+
+    def aws_client(self, service_name: str):
+        return self.clients[service_name]
+
+    def bigquery_client(self):
+        return self.bigquery
+
+    def bigquery_storage_client(self):
+        return None
+
+
+def run_load_test(requests: int, concurrency: int, rows: int, seed: int, latency: float, fail_inserts: int = 0):
+    """
+    Lanza las solicitudes e imprime el reporte. Devuelve True si la tabla de destino quedó correcta y no
+    quedaron tablas temporales; si ninguna solicitud terminó bien (p. ej. todos los INSERT fallaron),
+    no se exige que las sesiones se hayan cargado.
+    """
+    import main
+
+    raw = synthetic_data.generate_log_rows(rows, seed=seed)
+    expected_sessions = set(c_data.clean_transform_data(raw.copy())['sessionid'])
+    main.client_pool = pool = LocalClientPool(raw, latency, fail_inserts)
+
+    def trigger(_):
+        start = time.perf_counter()
+        response = main.app.test_client().get('/')
+        return response.status_code, time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        responses = list(executor.map(trigger, range(requests)))
+    elapsed = time.perf_counter() - start
+
+    latencies = np.array([seconds for _, seconds in responses])
+    loaded = Counter(pool.clients['athena'].target_rows)
+    lost = len(expected_sessions - set(loaded))
+    duplicated = sum(count - 1 for count in loaded.values())
+    unexpected = len(set(loaded) - expected_sessions)
+    leftover_tables = len(pool.clients['athena'].tables)
+    codes = Counter(code for code, _ in responses)
+
+    print(f"Solicitudes: {requests} ({concurrency} a la vez) en {elapsed:.2f}s = {requests / elapsed:.2f} solicitudes/s")
+    print("Latencia (s): " + ", ".join(
+        f"p{percentile}={np.percentile(latencies, percentile):.3f}" for percentile in (50, 90, 95, 99)
+    ) + f", max={latencies.max():.3f}")
+    print("Respuestas: " + ", ".join(f"{code}={count}" for code, count in sorted(codes.items()))
+          + f"; INSERT fallidos: {pool.clients['athena'].failed_inserts}")
+    print(f"Sesiones esperadas: {len(expected_sessions):,}; cargadas: {len(loaded):,}; perdidas: {lost:,}; "
+          f"duplicadas: {duplicated:,}; inesperadas: {unexpected:,}; tablas temporales sin borrar: {leftover_tables}")
+    correct = (lost == 0 or not codes[200]) and duplicated == 0 and unexpected == 0 and leftover_tables == 0
+    print("Resultado: " + ("correcto" if correct else "INCORRECTO"))
+    return correct
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--requests", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--rows", type=int, default=20_000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--latency-ms", type=float, default=50, help="latencia simulada de cada llamada a BigQuery, S3 y Athena")
+    parser.add_argument("--no-lease", action="store_true", help="sin RUN_LEASE (ejecuciones simultáneas de la misma ventana)")
+    parser.add_argument("--fail-inserts", type=int, default=0, help="número de INSERT (los primeros) que terminan en FAILED")
+    parser.add_argument("--no-cache", action="store_true", help="sin RESULT_CACHE (cada ejecución vuelve a cargar el día)")
+    args = parser.parse_args()
+
+    # La configuración de main se lee al importarlo
+    os.environ.update({
+        "S3_BUCKET": "load-test", "ATHENA_DATABASE": "load_test", "ATHENA_TABLE": "target", "BIGQUERY_TABLE": "project.logs.run",
+        "RUN_LEASE": str(not args.no_lease).lower(), "RESULT_CACHE": str(not args.no_cache).lower(),
+        "ATHENA_POLL_INITIAL_SECONDS": "0.01",
+    })
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    sys.exit(0 if run_load_test(args.requests, args.concurrency, args.rows, args.seed, args.latency_ms / 1000,
+                                args.fail_inserts) else 1)
@@ -1,13 +1,35 @@
 import os
-from google.oauth2 import service_account
-import boto3
+import sys
+import logging
 import pandas as pd
-from io import StringIO
+import pyarrow as pa
+import pyarrow.parquet as pq
+from io import StringIO, BytesIO
 import datetime
 from google.cloud import bigquery
-from flask import Flask
+from google.api_core import exceptions as google_exceptions
+from flask import Flask, request, jsonify
 import time # Import for time.sleep
+import random
+import threading
+import functools
+import uuid
+import contextlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from urllib.parse import urlencode
 import clean_data as c_data
+import clients
+import watermark
+import s3_writer
+import jobs
+import metrics
+import sql_transform
+import result_cache
+import pipeline
+import lease
+
+metrics.setup_logging()
+logger = logging.getLogger(__name__)
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))  # carpeta actual del script
 CREDENTIALS_PATH = os.environ.get("GOOGLE_APPLICATION_CREDENTIALS") or os.path.join(BASE_DIR, "asistentes-digitales-dev.json")
@@ -28,135 +50,652 @@ BIGQUERY_TABLE = os.environ.get("BIGQUERY_TABLE")
 
 # Query de BigQuery fijo y no configurable
 BIGQUERY_QUERY = f"SELECT * FROM `{BIGQUERY_TABLE}` WHERE DATE(timestamp) = CURRENT_DATE()"
+# En modo streaming los resultados se leen por páginas; deben venir ordenados por sesión
+# para que cada sesión quede contigua y pueda cerrarse al cambiar de sessionid.
+BIGQUERY_STREAMING_QUERY = f"{BIGQUERY_QUERY} ORDER BY jsonPayload.session_attributes.sessionid, timestamp"
+BIGQUERY_STREAMING = os.environ.get("BIGQUERY_STREAMING", "false").lower() == "true"
+BIGQUERY_PAGE_SIZE = int(os.environ.get("BIGQUERY_PAGE_SIZE", "50000"))
+
+# Lectura de resultados con la BigQuery Storage Read API (lotes Arrow en varios streams en paralelo).
+# Los resultados con menos de BIGQUERY_STORAGE_MIN_ROWS filas se leen por REST, que para pocos datos
+# es más rápido que abrir una sesión de lectura. Requiere google-cloud-bigquery-storage y el permiso
+# bigquery.readsessions.create para la cuenta de servicio; sin el permiso se lee por REST.
+BIGQUERY_STORAGE_API = os.environ.get("BIGQUERY_STORAGE_API", "false").lower() == "true"
+BIGQUERY_STORAGE_MIN_ROWS = int(os.environ.get("BIGQUERY_STORAGE_MIN_ROWS", "50000"))
+
+# Motor de transformación: 'pandas' (clean_data, en este servicio) o 'sql' (sql_transform: la agregación
+# por sesión se hace en BigQuery y solo se lee una fila por sesión). El modo incremental siempre usa
+# pandas, porque necesita las filas crudas para decidir qué sesiones están cerradas.
+TRANSFORM_ENGINE = os.environ.get("TRANSFORM_ENGINE", "pandas").lower()
+# Transformación pandas en modo compacto (clean_data.clean_transform_data_compact): mismo resultado
+# con menos memoria; sirve para días grandes en instancias con poca RAM.
+TRANSFORM_COMPACT = os.environ.get("TRANSFORM_COMPACT", "false").lower() == "true"
+# Presupuesto de memoria de la transformación pandas en MB (0 = sin límite): si la estimación para las
+# filas leídas lo supera, se transforma por shards de sesiones (clean_data.clean_transform_budgeted).
+# Con TRANSFORM_SPILL_DIR los shards se escriben ahí como Arrow IPC; en Cloud Run /tmp está en memoria,
+# así que debe ser un volumen montado. TRANSFORM_MEMORY_FACTOR ajusta la estimación (0 = la de clean_data).
+# Los shards se limitan a clean_data.TRANSFORM_MAX_SHARDS: un presupuesto muy chico no multiplica las pasadas.
+TRANSFORM_MAX_MEMORY_MB = int(os.environ.get("TRANSFORM_MAX_MEMORY_MB", "0"))
+if TRANSFORM_MAX_MEMORY_MB < 0:
+    raise ValueError(f"TRANSFORM_MAX_MEMORY_MB debe ser 0 (sin límite) o positivo: {TRANSFORM_MAX_MEMORY_MB}")
+TRANSFORM_SPILL_DIR = os.environ.get("TRANSFORM_SPILL_DIR") or None
+TRANSFORM_MEMORY_FACTOR = float(os.environ.get("TRANSFORM_MEMORY_FACTOR", "0")) or None
+
+# Ejecución en etapas concurrentes (pipeline.py): lectura por páginas ordenadas por sesión, transformación
+# en procesos por trozos de sesiones completas y subida de un archivo por trozo, unidas por colas de
+# PIPELINE_QUEUE_SIZE trozos. Aplica al modo de carga 'insert' con el motor pandas y sin modo incremental.
+PIPELINED_TRANSFER = os.environ.get("PIPELINED_TRANSFER", "false").lower() == "true"
+PIPELINE_TRANSFORM_WORKERS = int(os.environ.get("PIPELINE_TRANSFORM_WORKERS", str(os.cpu_count() or 1)))
+PIPELINE_UPLOAD_WORKERS = int(os.environ.get("PIPELINE_UPLOAD_WORKERS", "4"))
+PIPELINE_QUEUE_SIZE = int(os.environ.get("PIPELINE_QUEUE_SIZE", "2"))
+
+# Modo incremental: solo se leen las sesiones con actividad posterior a la marca de agua
+# (menos un solapamiento para eventos que llegan tarde), completas, y solo se cargan las cerradas.
+INCREMENTAL_MODE = os.environ.get("INCREMENTAL_MODE", "false").lower() == "true"
+WATERMARK_LOCATION = os.environ.get("WATERMARK_LOCATION") or f"s3://{S3_BUCKET}/state/watermark.json"
+INCREMENTAL_OVERLAP_MINUTES = int(os.environ.get("INCREMENTAL_OVERLAP_MINUTES", "10"))
+SESSION_IDLE_MINUTES = int(os.environ.get("SESSION_IDLE_MINUTES", "30"))
+SESSION_LOOKBACK_HOURS = int(os.environ.get("SESSION_LOOKBACK_HOURS", "24"))
+BIGQUERY_INCREMENTAL_QUERY = f"""
+    SELECT * FROM `{BIGQUERY_TABLE}`
+    WHERE timestamp >= @lookback_start
+      AND jsonPayload.session_attributes.sessionid IN (
+        SELECT DISTINCT jsonPayload.session_attributes.sessionid
+        FROM `{BIGQUERY_TABLE}`
+        WHERE timestamp >= @since
+      )
+"""
+
+# Caché de resultados (result_cache.py): si ni la tabla de origen ni el código de la transformación
+# cambiaron desde una ejecución del mismo día que ya subió o cargó su resultado, los reintentos
+# reutilizan ese resultado en lugar de volver a leer, transformar e insertar. No aplica al modo
+# incremental, que ya evita duplicados con la marca de agua. RESULT_CACHE_TTL_HOURS debe ser menor
+# que la expiración que tengan en S3 las subcarpetas de temp_athena_load/.
+RESULT_CACHE = os.environ.get("RESULT_CACHE", "false").lower() == "true"
+RESULT_CACHE_LOCATION = os.environ.get("RESULT_CACHE_LOCATION") or f"s3://{S3_BUCKET}/state/result_cache/"
+RESULT_CACHE_TTL_HOURS = int(os.environ.get("RESULT_CACHE_TTL_HOURS", "24"))
+
+# Concesión (lease.py) sobre la ventana que carga cada ejecución (el día o el modo incremental):
+# una segunda ejecución concurrente para la misma ventana responde 409 en lugar de cargar a la vez.
+# Se toma y se libera con escrituras condicionales de S3 (IfNoneMatch / IfMatch), atómicas en el servicio.
+# RUN_LEASE_TTL_SECONDS debe ser mayor que la duración máxima de una ejecución.
+RUN_LEASE = os.environ.get("RUN_LEASE", "false").lower() == "true"
+RUN_LEASE_LOCATION = os.environ.get("RUN_LEASE_LOCATION") or f"s3://{S3_BUCKET}/state/leases/"
+RUN_LEASE_TTL_SECONDS = int(os.environ.get("RUN_LEASE_TTL_SECONDS", "3600"))
+
+# Backfill: carga de rangos de fechas pasados, por particiones de día u hora. Cada partición carga las
+# sesiones completas cuyo primer evento cae en [window_start, window_end), así una sesión que cruza el
+# límite entre particiones se transforma una sola vez. Como en el modo incremental, las sesiones se buscan
+# hasta SESSION_LOOKBACK_HOURS antes (para saber si empezaron antes) y se leen hasta SESSION_LOOKBACK_HOURS
+# después del fin de la ventana.
+BIGQUERY_WINDOW_QUERY = f"""
+    SELECT * FROM `{BIGQUERY_TABLE}`
+    WHERE timestamp >= @window_start AND timestamp < @lookahead_end
+      AND jsonPayload.session_attributes.sessionid IN (
+        SELECT jsonPayload.session_attributes.sessionid
+        FROM `{BIGQUERY_TABLE}`
+        WHERE timestamp >= @lookback_start AND timestamp < @window_end
+        GROUP BY 1
+        HAVING MIN(timestamp) >= @window_start
+      )
+"""
+BACKFILL_WORKERS = int(os.environ.get("BACKFILL_WORKERS", str(os.cpu_count() or 1)))
+ATHENA_MAX_CONCURRENT_QUERIES = int(os.environ.get("ATHENA_MAX_CONCURRENT_QUERIES", "5"))
+
+# Modo de carga en Athena: 'insert' (tabla temporal + INSERT INTO + DROP) o 'direct'
+# (archivos Parquet escritos en las particiones year/month de la tabla de destino + ALTER TABLE ADD PARTITION)
+ATHENA_LOAD_MODE = os.environ.get("ATHENA_LOAD_MODE", "insert").lower()
+ATHENA_TABLE_LOCATION = os.environ.get("ATHENA_TABLE_LOCATION")  # Opcional; si no, se lee del catálogo
+
+# Formato del archivo que se sube a S3 para la tabla temporal: 'csv' o 'parquet'
+S3_OUTPUT_FORMAT = os.environ.get("S3_OUTPUT_FORMAT", "csv").lower()
+PARQUET_COMPRESSION = os.environ.get("PARQUET_COMPRESSION", "snappy")  # snappy, gzip, zstd, none
+
+# Subida multipart por bloques: tamaño de parte, partes concurrentes, filas por bloque codificado
+# y tamaño objetivo por objeto (0 = un solo objeto)
+S3_MULTIPART_UPLOAD = os.environ.get("S3_MULTIPART_UPLOAD", "false").lower() == "true"
+S3_PART_SIZE_MB = int(os.environ.get("S3_PART_SIZE_MB", "16"))
+S3_UPLOAD_CONCURRENCY = int(os.environ.get("S3_UPLOAD_CONCURRENCY", "4"))
+S3_UPLOAD_CHUNK_ROWS = int(os.environ.get("S3_UPLOAD_CHUNK_ROWS", "50000"))
+S3_TARGET_OBJECT_SIZE_MB = int(os.environ.get("S3_TARGET_OBJECT_SIZE_MB", "0"))
+
+# Columnas de la tabla externa temporal de Athena (nombre, tipo en CSV).
+# Se asume que el CSV tiene 'transferenciaasesor' como booleano.
+TEMP_TABLE_COLUMNS = [
+    ("timestamp", "STRING"),
+    ("sessionid", "STRING"),
+    ("lineanegocio", "STRING"),
+    ("motivoinicial", "STRING"),
+    ("respuesta", "STRING"),
+    ("transacciondurantellamada", "STRING"),
+    ("nombretransaccion", "STRING"),
+    ("concluyeenvoice", "STRING"),
+    ("transferenciaasesor", "BOOLEAN"),
+    ("datollave", "STRING"),
+    ("canal", "STRING"),
+    ("tramiteseleccionado", "STRING"),
+    ("tramiteaccion", "STRING"),
+    ("intentprevio", "STRING"),
+    ("isfallback", "STRING"),
+    ("fallbackmessage", "STRING"),
+    ("isderivacion", "STRING"),
+    ("duracion", "STRING"),
+    ("tiempo_por_sesion", "STRING"),
+    ("horafinal", "STRING"),
+    ("prestamoend", "STRING"),
+    ("flujoterminado", "STRING"),
+    ("year", "STRING"),
+    ("month", "STRING"),
+]
+
+# Valores que el INSERT INTO fija en la tabla de destino (ver load_s3_folder_into_athena)
+TARGET_TABLE_CONSTANTS = {
+    "duracion": "",
+    "tiempo_por_sesion": "",
+    "horafinal": "",
+    "__index_level_0__": 1,
+}
+
+# Tipos de Athena (Hive) a tipos Arrow para escribir archivos con el esquema de la tabla de destino
+ATHENA_ARROW_TYPES = {
+    "string": pa.string(),
+    "varchar": pa.string(),
+    "char": pa.string(),
+    "boolean": pa.bool_(),
+    "tinyint": pa.int8(),
+    "smallint": pa.int16(),
+    "int": pa.int32(),
+    "integer": pa.int32(),
+    "bigint": pa.int64(),
+    "float": pa.float32(),
+    "double": pa.float64(),
+}
+
+# Sondeo de consultas de Athena: intervalo inicial, factor de crecimiento y tope (segundos)
+ATHENA_POLL_INITIAL_SECONDS = float(os.environ.get("ATHENA_POLL_INITIAL_SECONDS", "0.25"))
+ATHENA_POLL_BACKOFF = float(os.environ.get("ATHENA_POLL_BACKOFF", "2"))
+ATHENA_POLL_MAX_SECONDS = float(os.environ.get("ATHENA_POLL_MAX_SECONDS", "5"))
+# Fracción del tiempo ya transcurrido (en cola o en ejecución) que se usa como intervalo mínimo
+ATHENA_POLL_ELAPSED_FRACTION = 0.25
+
+# Pool de clientes de AWS/GCP compartido por el proceso
+AWS_MAX_POOL_CONNECTIONS = int(os.environ.get("AWS_MAX_POOL_CONNECTIONS", "20"))
+AWS_MAX_ATTEMPTS = int(os.environ.get("AWS_MAX_ATTEMPTS", "5"))
+client_pool = clients.ClientPool(
+    aws_access_key_id=AWS_ACCESS_KEY_ID,
+    aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
+    region_name=AWS_REGION,
+    credentials_path=CREDENTIALS_PATH,
+    max_pool_connections=AWS_MAX_POOL_CONNECTIONS,
+    max_attempts=AWS_MAX_ATTEMPTS,
+)
+
+# Trabajos asíncronos (POST /jobs): ejecuciones simultáneas y tiempo que se conservan los terminados.
+# Los trabajos viven en la memoria del proceso: el servicio debe correr con un solo worker de gunicorn
+# y, en Cloud Run, con CPU asignada fuera de las solicitudes.
+JOBS_MAX_CONCURRENCY = int(os.environ.get("JOBS_MAX_CONCURRENCY", "1"))
+JOBS_RETENTION_SECONDS = int(os.environ.get("JOBS_RETENTION_SECONDS", "86400"))
+job_manager = jobs.JobManager(max_workers=JOBS_MAX_CONCURRENCY, retention_seconds=JOBS_RETENTION_SECONDS)
 
 app = Flask(__name__)
 
-def get_athena_query_status(query_execution_id: str):
+def get_athena_client():
     """
-    Checks the status of an Athena query execution.
+    Devuelve el cliente de Athena compartido del pool.
     """
-    athena_client = boto3.client(
-        'athena',
-        aws_access_key_id=AWS_ACCESS_KEY_ID,
-        aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
-        region_name=AWS_REGION
-    )
+    return client_pool.aws_client('athena')
+
+def get_athena_query_execution(query_execution_id: str, athena_client=None):
+    """
+    Returns the QueryExecution description (status and statistics) of an Athena query.
+    """
+    athena_client = athena_client or get_athena_client()
     response = athena_client.get_query_execution(QueryExecutionId=query_execution_id)
-    return response['QueryExecution']['Status']['State']
+    return response['QueryExecution']
+
+def get_athena_query_status(query_execution_id: str, athena_client=None):
+    """
+    Checks the status of an Athena query execution.
+    """
+    return get_athena_query_execution(query_execution_id, athena_client)['Status']['State']
 
-def wait_for_athena_query(query_execution_id: str, timeout_seconds: int = 300):
+def next_athena_poll_interval(attempt: int, query_execution: dict, rand=random.random):
+    """
+    Calculates how long to wait before the next poll of an Athena query.
+    Starts at ATHENA_POLL_INITIAL_SECONDS and backs off exponentially up to ATHENA_POLL_MAX_SECONDS.
+    Queries that have already spent a long time queued or running are polled less often,
+    in proportion to that elapsed time. Half of the interval is random jitter.
+    """
+    interval = ATHENA_POLL_INITIAL_SECONDS * (ATHENA_POLL_BACKOFF ** attempt)
+
+    statistics = query_execution.get('Statistics', {})
+    state = query_execution['Status']['State']
+    if state == 'QUEUED':
+        elapsed_ms = statistics.get('QueryQueueTimeInMillis', 0)
+    else:
+        elapsed_ms = statistics.get('EngineExecutionTimeInMillis', 0)
+    interval = max(interval, ATHENA_POLL_ELAPSED_FRACTION * elapsed_ms / 1000)
+
+    interval = min(max(interval, ATHENA_POLL_INITIAL_SECONDS), ATHENA_POLL_MAX_SECONDS)
+    return interval / 2 + rand() * interval / 2
+
+def wait_for_athena_query(query_execution_id: str, timeout_seconds: int = 300, athena_client=None,
+                          sleep=time.sleep, clock=time.monotonic):
     """
     Waits for an Athena query to complete and returns its final status.
     Raises an exception if the query fails or times out.
+    Polls with adaptive backoff (see next_athena_poll_interval) reusing a single client;
+    athena_client, sleep and clock can be replaced by stubs that replay query states.
     """
-    start_time = time.time()
+    athena_client = athena_client or get_athena_client()
+    start_time = clock()
+    attempt = 0
     while True:
-        status = get_athena_query_status(query_execution_id)
-        print(f"DEBUG ATHENA: Query {query_execution_id} current status: {status}")
+        query_execution = get_athena_query_execution(query_execution_id, athena_client)
+        status = query_execution['Status']['State']
+        logger.debug(f"ATHENA: Query {query_execution_id} current status: {status}")
         if status in ['SUCCEEDED', 'FAILED', 'CANCELLED']:
+            metrics.record_athena_statistics(query_execution)
             if status == 'FAILED':
-                athena_client = boto3.client(
-                    'athena',
-                    aws_access_key_id=AWS_ACCESS_KEY_ID,
-                    aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
-                    region_name=AWS_REGION
-                )
-                response = athena_client.get_query_execution(QueryExecutionId=query_execution_id)
-                error_message = response['QueryExecution']['Status'].get('StateChangeReason', 'Unknown Athena error.')
+                error_message = query_execution['Status'].get('StateChangeReason', 'Unknown Athena error.')
                 raise Exception(f"Athena query {query_execution_id} failed: {error_message}")
             return status
-        if time.time() - start_time > timeout_seconds:
+        elapsed = clock() - start_time
+        if elapsed > timeout_seconds:
             raise Exception(f"Athena query {query_execution_id} timed out after {timeout_seconds} seconds.")
-        time.sleep(5) # Wait for 5 seconds before checking again
+        interval = next_athena_poll_interval(attempt, query_execution)
+        sleep(interval)
+        attempt += 1
+
+
+def arrow_to_dataframe(table: pa.Table) -> pd.DataFrame:
+    """
+    Convierte los resultados Arrow en DataFrame. Las columnas RECORD (resource, jsonPayload) se
+    quedan en Arrow (pd.ArrowDtype) para que clean_data.extract_fields las lea con pyarrow.compute,
+    sin pasar por un dict de Python por fila.
+    """
+    return table.to_pandas(types_mapper=lambda arrow_type: pd.ArrowDtype(arrow_type) if pa.types.is_struct(arrow_type) else None)
+
+
+def fetch_query_results(client: bigquery.Client, query: str, job_config=None) -> pd.DataFrame:
+    """
+    Ejecuta el query y lee los resultados como Arrow: con la Storage Read API (RowIterator.to_arrow
+    con bqstorage_client, que lee los streams de la sesión en paralelo) si está habilitada, disponible
+    y el resultado tiene al menos BIGQUERY_STORAGE_MIN_ROWS filas, o por REST si no. Si la cuenta de
+    servicio no tiene permiso para abrir sesiones de lectura, se vuelve a leer por REST.
+    """
+    query_job = client.query(query, job_config=job_config)
+    rows = query_job.result()
+    storage_client = client_pool.bigquery_storage_client() if BIGQUERY_STORAGE_API else None
+    if storage_client is not None and rows.total_rows >= BIGQUERY_STORAGE_MIN_ROWS:
+        try:
+            return arrow_to_dataframe(rows.to_arrow(bqstorage_client=storage_client, create_bqstorage_client=False))
+        except google_exceptions.PermissionDenied as e:
+            logger.warning(f"Sin permiso para la BigQuery Storage Read API, se leen los resultados por REST: {e}")
+            rows = query_job.result()
+    return arrow_to_dataframe(rows.to_arrow(create_bqstorage_client=False))
+
+
+def record_rows_in(rows: int):
+    metrics.registry.inc("pipeline_rows_in_total", rows, "Filas leídas de BigQuery.")
+
+
+def transform_results(results: pd.DataFrame):
+    """
+    Aplica clean_transform_data (por shards si supera TRANSFORM_MAX_MEMORY_MB) midiendo la etapa
+    'transform' y las filas de entrada y salida.
+    """
+    with metrics.span('transform', rows_in=len(results)) as span:
+        df_results = c_data.clean_transform_budgeted(
+            results, TRANSFORM_MAX_MEMORY_MB * 1024 ** 2, compact=TRANSFORM_COMPACT,
+            spill_dir=TRANSFORM_SPILL_DIR, memory_factor=TRANSFORM_MEMORY_FACTOR,
+        )
+        span['rows_out'] = len(df_results)
+    metrics.registry.inc("pipeline_rows_out_total", len(df_results), "Filas (sesiones) producidas por la transformación.")
+    return df_results
 
 
 def execute_bigquery_query():
     """
     Ejecuta el query predefinido en BigQuery y devuelve los resultados como un DataFrame de Pandas.
     """
-    print("Iniciando conexión con BigQuery...")
+    logger.info("Iniciando conexión con BigQuery...")
     # It's generally better to use GOOGLE_APPLICATION_CREDENTIALS environment variable
     # or let the client library find credentials automatically in Cloud Run.
     # If 'asistentes-digitales.json' is required, ensure it's properly deployed with the Cloud Run service.
-    credentials = service_account.Credentials.from_service_account_file(
-        CREDENTIALS_PATH,
-        scopes=["https://www.googleapis.com/auth/cloud-platform"],
-    )
-    client = bigquery.Client(
-        credentials=credentials,
-        project=credentials.project_id,
-    )
-    print(f"Ejecutando query en BigQuery: {BIGQUERY_QUERY}")
-    query_job = client.query(BIGQUERY_QUERY)
-    # Espera a que el trabajo de BigQuery termine y obtiene los resultados en un DataFrame
-    results = query_job.result().to_dataframe()
-    print(f"Query de BigQuery completado. Se obtuvieron {len(results)} filas.")
+    # El cliente se crea una sola vez por proceso (ver clients.ClientPool).
+    client = client_pool.bigquery_client()
+    if TRANSFORM_ENGINE == "sql":
+        return execute_bigquery_query_sql(client, BIGQUERY_QUERY)
+    if BIGQUERY_STREAMING:
+        return execute_bigquery_query_streaming(client)
+
+    logger.info(f"Ejecutando query en BigQuery: {BIGQUERY_QUERY}")
+    with metrics.span('extract') as span:
+        # Espera a que el trabajo de BigQuery termine y obtiene los resultados en un DataFrame
+        results = fetch_query_results(client, BIGQUERY_QUERY)
+        span['rows'] = len(results)
+    record_rows_in(len(results))
+    logger.info(f"Query de BigQuery completado. Se obtuvieron {len(results)} filas.")
 
     #Logica adicional de python
-    clean_data = c_data.clean_transform_data(results)
+    clean_data = transform_results(results)
 
     return clean_data
 
 
-def upload_dataframe_to_s3(df: pd.DataFrame, s3_key: str):
+_source_field_paths = None
+
+
+def get_source_field_paths(client: bigquery.Client):
+    """
+    Campos (rutas 'a.b.c') de la tabla de logs de BigQuery, leídos una vez por proceso.
+    """
+    global _source_field_paths
+    if _source_field_paths is None:
+        _source_field_paths = sql_transform.get_schema_field_paths(client.get_table(BIGQUERY_TABLE).schema)
+    return _source_field_paths
+
+
+def execute_bigquery_query_sql(client: bigquery.Client, source_query: str, job_config=None):
+    """
+    Motor 'sql': envuelve source_query en el query de sql_transform, que hace en BigQuery la misma
+    transformación que clean_transform_data, y devuelve el resultado (una fila por sesión).
+    """
+    field_paths = get_source_field_paths(client)
+    query = sql_transform.build_session_query(source_query, field_paths)
+    logger.debug(f"Query de transformación enviado a BigQuery:\n{query}")
+    with metrics.span('extract_transform', engine='sql') as span:
+        df_results = sql_transform.finalize_results(fetch_query_results(client, query, job_config), field_paths)
+        span['rows_out'] = len(df_results)
+    metrics.registry.inc("pipeline_rows_out_total", len(df_results), "Filas (sesiones) producidas por la transformación.")
+    logger.info(f"Query de BigQuery completado. Se obtuvieron {len(df_results)} sesiones.")
+    return df_results
+
+
+def execute_bigquery_query_streaming(client: bigquery.Client):
+    """
+    Ejecuta el query ordenado por sesión y transforma los resultados página por página,
+    sin cargar en memoria todas las filas del día.
+    Este modo sigue leyendo por REST: el ORDER BY solo se respeta leyendo un único stream en orden.
+    """
+    logger.info(f"Ejecutando query en BigQuery (streaming, {BIGQUERY_PAGE_SIZE} filas por página): {BIGQUERY_STREAMING_QUERY}")
+    query_job = client.query(BIGQUERY_STREAMING_QUERY)
+    rows = query_job.result(page_size=BIGQUERY_PAGE_SIZE)
+    logger.info(f"Query de BigQuery completado. Se leerán {rows.total_rows} filas por páginas.")
+    record_rows_in(rows.total_rows)
+
+    # La lectura y la transformación se intercalan por página, así que se miden juntas
+    with metrics.span('extract_transform', rows_in=rows.total_rows) as span:
+        df_results = c_data.clean_transform_stream(rows.to_dataframe_iterable(), compact=TRANSFORM_COMPACT)
+        span['rows_out'] = len(df_results)
+    metrics.registry.inc("pipeline_rows_out_total", len(df_results), "Filas (sesiones) producidas por la transformación.")
+    return df_results
+
+
+def transform_session_chunk(chunk: pd.DataFrame, columns: list):
+    """
+    Transforma un trozo de sesiones completas dejando las columnas de salida de todo el día.
+    Corre en un proceso del pool de pipeline.run_pipeline.
+    """
+    return c_data.clean_transform_data(chunk, compact=TRANSFORM_COMPACT).reindex(columns=columns)
+
+
+def execute_pipelined_transfer(folder_prefix: str = "temp_athena_load"):
+    """
+    Lee de BigQuery, transforma y sube a S3 en etapas concurrentes (ver pipeline.run_pipeline).
+    Cada trozo de sesiones completas se sube como un archivo de la misma subcarpeta, que la tabla
+    temporal de Athena lee completa. Las columnas de salida salen del esquema de la tabla de origen
+    (igual que con la lectura Arrow y el motor 'sql'), así todos los archivos tienen las mismas.
+    Devuelve (subcarpeta, filas subidas), o (None, 0) si no hubo registros.
+    """
+    client = client_pool.bigquery_client()
+    columns = sql_transform.get_output_columns(get_source_field_paths(client))
+    unique_folder = f"{folder_prefix}/{new_run_id()}/"
+    file_extension = "parquet" if S3_OUTPUT_FORMAT == "parquet" else "csv"
+
+    logger.info(f"Ejecutando query en BigQuery (en etapas concurrentes, {BIGQUERY_PAGE_SIZE} filas por página): {BIGQUERY_STREAMING_QUERY}")
+    query_job = client.query(BIGQUERY_STREAMING_QUERY)
+    rows = query_job.result(page_size=BIGQUERY_PAGE_SIZE)
+    record_rows_in(rows.total_rows)
+
+    def upload(index, df_results):
+        if upload_dataframe_to_s3(df_results, f"{unique_folder}part-{index:05d}.{file_extension}") is None:
+            return 0
+        return len(df_results)
+
+    with metrics.span('extract_transform_upload', rows_in=rows.total_rows) as span:
+        uploaded_rows = sum(pipeline.run_pipeline(
+            c_data.iter_session_chunks(rows.to_dataframe_iterable()),
+            functools.partial(transform_session_chunk, columns=columns),
+            upload,
+            transform_workers=PIPELINE_TRANSFORM_WORKERS,
+            upload_workers=PIPELINE_UPLOAD_WORKERS,
+            queue_size=PIPELINE_QUEUE_SIZE,
+        ))
+        span['rows_out'] = uploaded_rows
+    metrics.registry.inc("pipeline_rows_out_total", uploaded_rows, "Filas (sesiones) producidas por la transformación.")
+    if not uploaded_rows:
+        return None, 0
+    logger.info(f"Subidas {uploaded_rows} filas a s3://{S3_BUCKET}/{unique_folder}")
+    return unique_folder, uploaded_rows
+
+
+def execute_bigquery_query_incremental():
     """
-    Sube un DataFrame de Pandas a S3 en formato CSV.
+    Lee de BigQuery solo las sesiones con actividad desde la última marca de agua y transforma
+    las que ya están cerradas. Devuelve (DataFrame limpio, nuevo estado); el estado se guarda
+    después de cargar los datos en Athena.
+    """
+    state = watermark.load_state(WATERMARK_LOCATION, client_pool.aws_client('s3'))
+    now = pd.Timestamp.now(tz="UTC")
+    overlap = datetime.timedelta(minutes=INCREMENTAL_OVERLAP_MINUTES)
+    # Sin estado previo se empieza desde el inicio del día, como el modo normal
+    previous_watermark = watermark.get_watermark(state, default=now.normalize())
+    new_watermark = now - datetime.timedelta(minutes=SESSION_IDLE_MINUTES)
+    since = previous_watermark - overlap
+    lookback_start = since - datetime.timedelta(hours=SESSION_LOOKBACK_HOURS)
+
+    client = client_pool.bigquery_client()
+    job_config = bigquery.QueryJobConfig(query_parameters=[
+        bigquery.ScalarQueryParameter("since", "TIMESTAMP", since.to_pydatetime()),
+        bigquery.ScalarQueryParameter("lookback_start", "TIMESTAMP", lookback_start.to_pydatetime()),
+    ])
+    logger.info(f"Ejecutando query incremental en BigQuery desde {since.isoformat()}: {BIGQUERY_INCREMENTAL_QUERY}")
+    with metrics.span('extract', mode='incremental') as span:
+        results = fetch_query_results(client, BIGQUERY_INCREMENTAL_QUERY, job_config)
+        span['rows'] = len(results)
+    record_rows_in(len(results))
+    logger.info(f"Query de BigQuery completado. Se obtuvieron {len(results)} filas.")
+
+    if results.empty:
+        return results, {**state, "watermark": new_watermark.isoformat()}
+
+    session_ids = c_data.get_session_ids(results)
+    timestamps = pd.to_datetime(results['timestamp'], utc=True)
+    rows_to_load, new_state = watermark.select_closed_sessions(
+        session_ids, timestamps, state, new_watermark, overlap
+    )
+    logger.info(f"Sesiones cerradas a cargar: {session_ids[rows_to_load].nunique()} de {session_ids.nunique()}.")
+    results = results[rows_to_load].reset_index(drop=True)
+    if results.empty:
+        return results, new_state
+
+    return transform_results(results), new_state
+
+
+def get_parquet_schema():
+    """
+    Esquema Parquet de la tabla temporal, tomado de TEMP_TABLE_COLUMNS.
+    Todas las columnas se guardan como texto, tal como las deja clean_transform_data
+    (p. ej. 'transferenciaasesor' contiene 'Si' o '').
+    """
+    return pa.schema([(name, pa.string()) for name, _ in TEMP_TABLE_COLUMNS])
+
+
+def build_parquet_table(df: pd.DataFrame):
+    """
+    Convierte el DataFrame en una tabla Arrow con el esquema de get_parquet_schema().
+    """
+    schema = get_parquet_schema()
+    arrays = []
+    for field in schema:
+        if field.name in df.columns:
+            values = df[field.name].astype("string")
+        else:
+            values = pd.Series(pd.NA, index=df.index, dtype="string")
+        arrays.append(pa.array(values, type=field.type, from_pandas=True))
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+
+def dataframe_to_parquet(df: pd.DataFrame, compression: str = PARQUET_COMPRESSION):
+    """
+    Serializa el DataFrame a Parquet con las columnas de la tabla temporal y devuelve los bytes.
+    A diferencia del CSV, Athena resuelve las columnas de Parquet por nombre, no por posición.
+    """
+    table = build_parquet_table(df)
+    parquet_buffer = BytesIO()
+    pq.write_table(table, parquet_buffer, compression=None if compression == "none" else compression)
+    return parquet_buffer.getvalue()
+
+
+def build_create_temp_table_query(s3_table_location: str, file_format: str = S3_OUTPUT_FORMAT,
+                                  table_name: str = "temp_csv_source_table"):
+    """
+    Construye el CREATE EXTERNAL TABLE de la tabla temporal para el formato subido a S3.
+    """
+    if file_format == "parquet":
+        columns = ",\n            ".join(f"{name} STRING" for name, _ in TEMP_TABLE_COLUMNS)
+        return f"""
+            CREATE EXTERNAL TABLE IF NOT EXISTS {table_name} (
+            {columns}
+        )
+        STORED AS PARQUET
+        LOCATION '{s3_table_location}' -- APUNTA A LA SUBCARPETA ÚNICA
+        TBLPROPERTIES ('external.table.purge'='TRUE');
+        """
+
+    columns = ",\n            ".join(f"{name} {column_type}" for name, column_type in TEMP_TABLE_COLUMNS)
+    return f"""
+            CREATE EXTERNAL TABLE IF NOT EXISTS {table_name} (
+            {columns}
+        )
+        ROW FORMAT SERDE 'org.apache.hadoop.hive.serde2.OpenCSVSerde'
+        WITH SERDEPROPERTIES (
+            'separatorChar' = ',',
+            'quoteChar' = '"',
+            'escapeChar' = '\\\\'
+        )
+        LOCATION '{s3_table_location}' -- APUNTA A LA SUBCARPETA ÚNICA
+        TBLPROPERTIES ('skip.header.line.count'='1', 'external.table.purge'='TRUE');
+        """
+
+
+def record_bytes_uploaded(size: int):
+    metrics.registry.inc("s3_uploaded_bytes_total", size, "Bytes subidos a S3.")
+
+
+def upload_dataframe_to_s3(df: pd.DataFrame, s3_key: str, file_format: str = S3_OUTPUT_FORMAT):
+    """
+    Sube un DataFrame de Pandas a S3 en formato CSV o Parquet.
     El archivo CSV no incluye el índice y tiene cabecera.
+    El archivo Parquet usa el esquema de la tabla temporal y la compresión PARQUET_COMPRESSION.
     s3_key es la ruta completa del objeto en S3 (ej. 'carpeta/mi_archivo.csv')
     """
-    print(f"Preparando DataFrame para subir a S3 como '{s3_key}'...")
+    logger.info(f"Preparando DataFrame para subir a S3 como '{s3_key}'...")
 
     # --- Impresiones de depuración ---
-    print(f"DEBUG S3: AWS_ACCESS_KEY_ID (primeros 4 chars): {AWS_ACCESS_KEY_ID[:4] if AWS_ACCESS_KEY_ID else 'None/Empty'}")
-    print(f"DEBUG S3: AWS_SECRET_ACCESS_KEY (primeros 4 chars): {AWS_SECRET_ACCESS_KEY[:4] if AWS_SECRET_ACCESS_KEY else 'None/Empty'}")
-    print(f"DEBUG S3: AWS_REGION: {AWS_REGION if AWS_REGION else 'None/Empty'}")
-    print(f"DEBUG S3: S3_BUCKET: {S3_BUCKET if S3_BUCKET else 'None/Empty'}")
+    logger.debug(f"S3: AWS_ACCESS_KEY_ID (primeros 4 chars): {AWS_ACCESS_KEY_ID[:4] if AWS_ACCESS_KEY_ID else 'None/Empty'}")
+    logger.debug(f"S3: AWS_SECRET_ACCESS_KEY definida: {'sí' if AWS_SECRET_ACCESS_KEY else 'no'}")
+    logger.debug(f"S3: AWS_REGION: {AWS_REGION if AWS_REGION else 'None/Empty'}")
+    logger.debug(f"S3: S3_BUCKET: {S3_BUCKET if S3_BUCKET else 'None/Empty'}")
 
     if df.empty:
-        print("DEBUG S3: El DataFrame está vacío. No se subirá ningún archivo a S3.")
+        logger.debug("S3: El DataFrame está vacío. No se subirá ningún archivo a S3.")
         return None # O considera un error si no es un escenario esperado
 
-    csv_buffer = StringIO()
+    if S3_MULTIPART_UPLOAD:
+        return upload_dataframe_to_s3_multipart(df, s3_key, file_format)
+
+    with metrics.span('serialize', format=file_format, rows=len(df)) as span:
+        if file_format == "parquet":
+            try:
+                body = dataframe_to_parquet(df)
+                logger.debug(f"S3: DataFrame convertido a Parquet ({PARQUET_COMPRESSION}, {len(body)} bytes) exitosamente.")
+            except Exception as e:
+                logger.error(f"S3: Falló la conversión del DataFrame a Parquet: {e}")
+                raise
+        else:
+            csv_buffer = StringIO()
+            try:
+                df.to_csv(csv_buffer, index=False, header=True)
+                body = csv_buffer.getvalue().encode("utf-8")
+                logger.debug("S3: DataFrame convertido a CSV en buffer exitosamente.")
+            except Exception as e:
+                logger.error(f"S3: Falló la conversión del DataFrame a CSV: {e}")
+                raise
+        span['bytes'] = len(body)
+
     try:
-        df.to_csv(csv_buffer, index=False, header=True)
-        print("DEBUG S3: DataFrame convertido a CSV en buffer exitosamente.")
+        s3_client = client_pool.aws_client('s3')
+        logger.debug("S3: Cliente S3 inicializado exitosamente.")
     except Exception as e:
-        print(f"ERROR S3: Falló la conversión del DataFrame a CSV: {e}")
+        logger.error(f"S3: Falló la inicialización del cliente S3. ¿Credenciales o región incorrectas/faltantes?: {e}")
         raise
 
     try:
-        s3_client = boto3.client(
-            's3',
-            aws_access_key_id=AWS_ACCESS_KEY_ID,
-            aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
-            region_name=AWS_REGION
-        )
-        print("DEBUG S3: Cliente S3 inicializado exitosamente.")
+        with metrics.span('upload', format=file_format, bytes=len(body)):
+            s3_client.put_object(Bucket=S3_BUCKET, Key=s3_key, Body=body)
+        record_bytes_uploaded(len(body))
+        s3_path = f"s3://{S3_BUCKET}/{s3_key}"
+        logger.info(f"Archivo subido exitosamente a S3: {s3_path}")
+        return s3_path
     except Exception as e:
-        print(f"ERROR S3: Falló la inicialización del cliente S3. ¿Credenciales o región incorrectas/faltantes?: {e}")
+        logger.error(f"S3: Falló la subida del archivo a S3. ¿Bucket o permisos incorrectos?: {e}")
         raise
 
+
+def upload_dataframe_to_s3_multipart(df: pd.DataFrame, s3_key: str, file_format: str = S3_OUTPUT_FORMAT):
+    """
+    Sube el DataFrame codificándolo por bloques y enviando partes concurrentes a S3 (multipart),
+    sin construir el archivo completo en memoria. Con S3_TARGET_OBJECT_SIZE_MB > 0 la salida se
+    divide en varios objetos dentro de la misma carpeta.
+    Devuelve la ruta s3:// del objeto, o de la carpeta si se generaron varios.
+    """
+    if file_format == "parquet":
+        encoder = s3_writer.ParquetEncoder(get_parquet_schema(), build_parquet_table, PARQUET_COMPRESSION)
+    else:
+        encoder = s3_writer.CsvEncoder()
+
     try:
-        s3_client.put_object(Bucket=S3_BUCKET, Key=s3_key, Body=csv_buffer.getvalue())
-        s3_path = f"s3://{S3_BUCKET}/{s3_key}"
-        print(f"Archivo subido exitosamente a S3: {s3_path}")
-        return s3_path
+        # La codificación y la subida se intercalan por bloques, así que se miden juntas
+        with metrics.span('upload', format=file_format, rows=len(df), multipart=True) as span:
+            objects = s3_writer.upload_dataframe_in_parts(
+                client_pool.aws_client('s3'), S3_BUCKET, s3_key, df, encoder,
+                rows_per_chunk=S3_UPLOAD_CHUNK_ROWS,
+                part_size=S3_PART_SIZE_MB * 1024 * 1024,
+                max_concurrency=S3_UPLOAD_CONCURRENCY,
+                target_object_size=S3_TARGET_OBJECT_SIZE_MB * 1024 * 1024,
+            )
+            span['bytes'] = sum(size for _, size in objects)
     except Exception as e:
-        print(f"ERROR S3: Falló la subida del archivo a S3. ¿Bucket o permisos incorrectos?: {e}")
+        logger.error(f"S3: Falló la subida multipart a S3. ¿Bucket o permisos incorrectos?: {e}")
         raise
 
+    record_bytes_uploaded(span['bytes'])
+    keys = [key for key, _ in objects]
+    logger.info(f"Archivo subido exitosamente a S3 en {len(keys)} objeto(s): {', '.join(keys)}")
+    if len(keys) == 1:
+        return f"s3://{S3_BUCKET}/{keys[0]}"
+    return f"s3://{S3_BUCKET}/{s3_key.rpartition('/')[0]}/"
+
 
 def start_athena_query_execution(query_string: str):
     """
     Inicia la ejecución de una consulta en Athena.
     """
-    print("Iniciando ejecución de consulta en Athena...")
-    athena_client = boto3.client(
-        'athena',
-        aws_access_key_id=AWS_ACCESS_KEY_ID,
-        aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
-        region_name=AWS_REGION
-    )
+    logger.info("Iniciando ejecución de consulta en Athena...")
+    athena_client = get_athena_client()
 
     # La ubicación de salida para los resultados de la consulta de Athena
     athena_output_location = f's3://{S3_BUCKET}/athena_query_results/' # Puedes cambiar esto si quieres que los resultados de Athena también vayan a una subcarpeta específica
@@ -167,87 +706,109 @@ def start_athena_query_execution(query_string: str):
         ResultConfiguration={'OutputLocation': athena_output_location}
     )
     query_execution_id = response['QueryExecutionId']
-    print(f"Consulta de Athena iniciada con ID: {query_execution_id}")
+    logger.info(f"Consulta de Athena iniciada con ID: {query_execution_id}")
     return query_execution_id
 
 
-@app.route("/")
-def main():
+def upload_results_to_s3(df_results: pd.DataFrame, folder_prefix: str = "temp_athena_load"):
     """
-    Función principal que se ejecuta cuando el Cloud Run recibe una solicitud.
-    Orquesta la lectura de BigQuery, la subida a S3 y la inserción en Athena.
+    Sube el DataFrame limpio a una subcarpeta única de S3 y devuelve la subcarpeta,
+    o None si el DataFrame estaba vacío.
     """
-    try:
-        print("Iniciando proceso de transferencia de datos de BigQuery a Athena...")
+    # Generamos una subcarpeta única basada en la fecha y hora actual (más un sufijo aleatorio, ver new_run_id)
+    unique_folder = f"{folder_prefix}/{new_run_id()}/" # Una subcarpeta única para esta ejecución
+    file_extension = "parquet" if S3_OUTPUT_FORMAT == "parquet" else "csv"
+    actual_s3_key = f"{unique_folder}data.{file_extension}" # El nombre del archivo dentro de la subcarpeta
 
-        # 1. Leer datos de BigQuery
-        df_results = execute_bigquery_query()
+    # Subimos el archivo a la subcarpeta única
+    s3_full_path = upload_dataframe_to_s3(df_results, actual_s3_key)
 
-        if df_results.empty:
-            print("No se encontraron registros en BigQuery. Proceso finalizado.")
-            return "No se encontraron registros en BigQuery.", 200
+    if s3_full_path is None:
+        return None
 
-        # 2. Subir los resultados a S3
-        # Generamos una subcarpeta única basada en la fecha y hora actual
-        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S_%f")
-        unique_folder = f"temp_athena_load/{timestamp}/" # Una subcarpeta única para esta ejecución
-        actual_s3_key = f"{unique_folder}data.csv" # El nombre del archivo dentro de la subcarpeta
+    logger.info(f"Uploaded {file_extension.upper()} to S3: {s3_full_path}")
+    return unique_folder
 
-        # Subimos el archivo a la subcarpeta única
-        s3_full_path = upload_dataframe_to_s3(df_results, actual_s3_key)
 
-        if s3_full_path is None:
-            return "No se subió ningún archivo a S3 porque el DataFrame estaba vacío.", 200
+def run_athena_query(query_string: str, query_slots=None, stage: str = "athena_query"):
+    """
+    Ejecuta una consulta en Athena y espera su resultado. Devuelve (id de ejecución, estado).
+    Si se pasa query_slots (un semáforo), la consulta ocupa un lugar mientras está en vuelo,
+    para no superar el límite de consultas concurrentes de la cuenta.
+    El tiempo total (incluida la espera por un lugar) se registra como la etapa stage.
+    """
+    with metrics.span(stage) as span:
+        if query_slots is None:
+            query_execution_id = start_athena_query_execution(query_string)
+            span['query_execution_id'] = query_execution_id
+            return query_execution_id, wait_for_athena_query(query_execution_id)
+        with query_slots:
+            query_execution_id = start_athena_query_execution(query_string)
+            span['query_execution_id'] = query_execution_id
+            return query_execution_id, wait_for_athena_query(query_execution_id)
 
-        print(f"Uploaded CSV to S3: {s3_full_path}")
-
-        # 3. Construir y ejecutar la consulta de inserción en Athena
-        # La LOCATION para la tabla externa de Athena debe ser el directorio que contiene SOLO el archivo deseado.
-        s3_table_location = f"s3://{S3_BUCKET}/{unique_folder}" # Apunta a la subcarpeta única
-        print(f"DEBUG ATHENA: S3 Location para la tabla externa de Athena: {s3_table_location}")
-
-        # Crear la tabla externa temporal con los tipos correctos para los datos del CSV
-        # Se asume que el CSV tiene 'transferenciaasesor' y 'isderivacion' como booleanos, y 'duracion' como entero.
-        create_table_query = f"""
-            CREATE EXTERNAL TABLE IF NOT EXISTS temp_csv_source_table (
-            timestamp STRING,
-            sessionid STRING,
-            lineanegocio STRING,
-            motivoinicial STRING,
-            respuesta STRING,
-            transacciondurantellamada STRING,
-            nombretransaccion STRING,
-            concluyeenvoice STRING,
-            transferenciaasesor BOOLEAN,
-            datollave STRING,
-            canal STRING,
-            tramiteseleccionado STRING,
-            tramiteaccion STRING,
-            intentprevio STRING,
-            isfallback STRING,
-            fallbackmessage STRING,
-            isderivacion STRING,
-            duracion STRING,
-            tiempo_por_sesion STRING,
-            horafinal STRING,
-            prestamoend STRING,
-            flujoterminado STRING,
-            year STRING,
-            month STRING
-        )
-        ROW FORMAT SERDE 'org.apache.hadoop.hive.serde2.OpenCSVSerde'
-        WITH SERDEPROPERTIES (
-            'separatorChar' = ',',
-            'quoteChar' = '"',
-            'escapeChar' = '\\\\'
-        )
-        LOCATION '{s3_table_location}' -- APUNTA A LA SUBCARPETA ÚNICA
-        TBLPROPERTIES ('skip.header.line.count'='1', 'external.table.purge'='TRUE');
-        """
-        print(f"\nConsulta de creación de tabla enviada a Athena:\n {create_table_query}\n ---------------------\n")
-        create_table_execution_id = start_athena_query_execution(create_table_query)
-        create_status = wait_for_athena_query(create_table_execution_id)
-        print(f"Consulta de creación de tabla completada con estado: {create_status}")
+
+def new_run_id():
+    """
+    Identificador de una ejecución: fecha y hora más un sufijo aleatorio, para que dos ejecuciones
+    simultáneas (en distintos workers o instancias) no compartan subcarpeta ni tabla temporal.
+    """
+    return f"{datetime.datetime.now().strftime('%Y%m%d_%H%M%S_%f')}_{uuid.uuid4().hex[:8]}"
+
+
+def get_temp_table_name(label: str = None):
+    """
+    Nombre único de la tabla temporal de Athena. Con un nombre fijo, dos cargas simultáneas se pisan:
+    el CREATE ... IF NOT EXISTS de una reutiliza la tabla (y la LOCATION) de la otra y su DROP se la borra.
+    """
+    return f"temp_csv_source_table_{label + '_' if label else ''}{uuid.uuid4().hex}"
+
+
+def drop_temp_table(temp_table_name: str, query_slots=None):
+    """
+    Elimina la tabla temporal de Athena si existe. Se llama desde el finally de load_s3_folder_into_athena,
+    así que no lanza excepciones (no debe ocultar el error original): si falla solo se registra.
+    Devuelve (id de ejecución, estado); el id es None si la consulta no se pudo iniciar.
+    """
+    drop_query = f"""
+    DROP TABLE IF EXISTS {temp_table_name};
+    """
+    logger.debug(f"\n--- Consulta de eliminación de tabla ---\n{drop_query}\n------------------\n")
+    try:
+        drop_execution_id, drop_status = run_athena_query(drop_query, query_slots, 'athena_drop')
+    except Exception as e:
+        logger.warning(f"La eliminación de la tabla temporal {temp_table_name} de Athena falló: {e}. Puede que necesites eliminarla manualmente.")
+        return None, 'FAILED'
+    if drop_status != 'SUCCEEDED':
+        logger.warning(f"La eliminación de la tabla temporal de Athena falló con estado: {drop_status}. Puede que necesites eliminarla manualmente.")
+    logger.info(f"Consulta de eliminación de tabla completada con estado: {drop_status}")
+    return drop_execution_id, drop_status
+
+
+def load_s3_folder_into_athena(unique_folder: str, temp_table_name: str = None, query_slots=None,
+                               on_stage=None):
+    """
+    Carga en la tabla de destino de Athena el archivo subido a unique_folder:
+    crea una tabla externa temporal sobre la subcarpeta, inserta con INSERT INTO ... SELECT y la elimina.
+    La tabla temporal se elimina también si el CREATE o el INSERT fallan (ver drop_temp_table).
+    Si no se da temp_table_name se usa uno único (ver get_temp_table_name).
+    Devuelve {'create': (id, estado), 'insert': (id, estado), 'drop': (id, estado)}.
+    on_stage(etapa) se llama antes de cada consulta.
+    """
+    on_stage = on_stage or (lambda stage, **progress: None)
+    temp_table_name = temp_table_name or get_temp_table_name()
+    # La LOCATION para la tabla externa de Athena debe ser el directorio que contiene SOLO el archivo deseado.
+    s3_table_location = f"s3://{S3_BUCKET}/{unique_folder}" # Apunta a la subcarpeta única
+    logger.debug(f"ATHENA: S3 Location para la tabla externa de Athena: {s3_table_location}")
+
+    try:
+        # Crear la tabla externa temporal con los tipos correctos para los datos del archivo subido
+        # (CSV con OpenCSVSerde o Parquet, según S3_OUTPUT_FORMAT).
+        create_table_query = build_create_temp_table_query(s3_table_location, table_name=temp_table_name)
+        logger.debug(f"\nConsulta de creación de tabla enviada a Athena:\n {create_table_query}\n ---------------------\n")
+        on_stage('athena_create')
+        create_table_execution_id, create_status = run_athena_query(create_table_query, query_slots, 'athena_create')
+        logger.info(f"Consulta de creación de tabla completada con estado: {create_status}")
 
 
         # Insertar datos en la tabla de destino desde la tabla temporal
@@ -267,32 +828,542 @@ def main():
             '' AS  horafinal,  -- CAST(horafinal AS VARCHAR) 
             1 __index_level_0__, 
             prestamoend, flujoterminado, year, month
-        FROM temp_csv_source_table;
+        FROM {temp_table_name};
         """
-        print(f"Consulta de inserción enviada a Athena:\n {insert_query}\n---------------")
-        insert_execution_id = start_athena_query_execution(insert_query)
-        insert_status = wait_for_athena_query(insert_execution_id)
-        print(f"Consulta de inserción completada con estado: {insert_status}")
+        logger.debug(f"Consulta de inserción enviada a Athena:\n {insert_query}\n---------------")
+        on_stage('athena_insert')
+        insert_execution_id, insert_status = run_athena_query(insert_query, query_slots, 'athena_insert')
+        logger.info(f"Consulta de inserción completada con estado: {insert_status}")
+    finally:
+        # Eliminar la tabla temporal después de la inserción (o de un error: si no, queda en el catálogo)
+        on_stage('athena_drop')
+        drop_execution_id, drop_status = drop_temp_table(temp_table_name, query_slots)
 
+    return {
+        'create': (create_table_execution_id, create_status),
+        'insert': (insert_execution_id, insert_status),
+        'drop': (drop_execution_id, drop_status),
+    }
 
-        # Eliminar la tabla temporal después de la inserción
-        drop_query = """
-        DROP TABLE temp_csv_source_table;
-        """
-        print(f"\n--- Consulta de eliminación de tabla ---\n{drop_query}\n------------------\n")
-        drop_execution_id = start_athena_query_execution(drop_query)
-        drop_status = wait_for_athena_query(drop_execution_id)
-        if drop_status != 'SUCCEEDED':
-            print(f"ADVERTENCIA: La eliminación de la tabla temporal de Athena falló con estado: {drop_status}. Puede que necesites eliminarla manualmente.")
-        print(f"Consulta de eliminación de tabla completada con estado: {drop_status}")
 
-        print("Proceso completado exitosamente.")
-        return f"Proceso completado. IDs de ejecución de consulta de Athena: Crear={create_table_execution_id} ({create_status}), Insertar={insert_execution_id} ({insert_status}), Eliminar={drop_execution_id} ({drop_status}).", 200
+_target_table_metadata = None
+
+
+def get_target_table_metadata():
+    """
+    Lee del catálogo de Athena (una vez por proceso) las columnas, las llaves de partición
+    y los parámetros (ubicación, formato, proyección de particiones) de la tabla de destino.
+    """
+    global _target_table_metadata
+    if _target_table_metadata is None:
+        response = get_athena_client().get_table_metadata(
+            CatalogName='AwsDataCatalog', DatabaseName=ATHENA_DATABASE, TableName=ATHENA_TABLE
+        )
+        _target_table_metadata = response['TableMetadata']
+    return _target_table_metadata
+
+
+def get_arrow_type(athena_type: str):
+    base_type = athena_type.split("(")[0].strip().lower()
+    if base_type not in ATHENA_ARROW_TYPES:
+        raise ValueError(f"Tipo de columna de Athena no soportado en modo direct: {athena_type}")
+    return ATHENA_ARROW_TYPES[base_type]
+
+
+def build_target_table(df: pd.DataFrame, columns: list):
+    """
+    Construye una tabla Arrow con las columnas (no de partición) de la tabla de destino,
+    con los mismos valores que deja el INSERT INTO ... SELECT del modo 'insert'.
+    """
+    arrays = []
+    fields = []
+    for column in columns:
+        arrow_type = get_arrow_type(column['Type'])
+        name = column['Name']
+        if name in TARGET_TABLE_CONSTANTS:
+            values = pd.Series(TARGET_TABLE_CONSTANTS[name], index=df.index)
+        elif name in df.columns:
+            values = df[name]
+        else:
+            values = pd.Series(None, index=df.index, dtype=object)
+
+        if pa.types.is_string(arrow_type):
+            values = values.astype("string")
+        elif pa.types.is_boolean(arrow_type):
+            values = values.astype("boolean")
+        else:
+            values = pd.to_numeric(values, errors="coerce")
+        arrays.append(pa.array(values, type=arrow_type, from_pandas=True))
+        fields.append(pa.field(name, arrow_type))
+    return pa.Table.from_arrays(arrays, schema=pa.schema(fields))
+
+
+def write_to_target_partitions(df_results: pd.DataFrame, run_id: str):
+    """
+    Escribe el DataFrame como archivos Parquet directamente en las carpetas de partición
+    (Hive: year=YYYY/month=M/) de la tabla de destino, un archivo por partición.
+    Devuelve la lista de particiones escritas: [({'year': ..., 'month': ...}, ubicación S3)].
+    """
+    metadata = get_target_table_metadata()
+    parameters = metadata.get('Parameters', {})
+    table_format = " ".join([parameters.get('inputformat', ''), parameters.get('serde.serialization.lib', '')]).lower()
+    if 'parquet' not in table_format:
+        raise ValueError(f"El modo direct solo soporta tablas de destino en Parquet; formato de {ATHENA_TABLE}: {table_format or 'desconocido'}")
+
+    table_location = (ATHENA_TABLE_LOCATION or parameters['location']).rstrip('/')
+    bucket, prefix = watermark.parse_s3_location(table_location)
+    partition_keys = [key['Name'] for key in metadata.get('PartitionKeys', [])]
+    s3_client = client_pool.aws_client('s3')
+
+    partitions = []
+    for partition_values, partition_df in df_results.groupby(partition_keys, sort=True):
+        partition_values = dict(zip(partition_keys, map(str, partition_values)))
+        partition_path = "/".join(f"{key}={value}" for key, value in partition_values.items())
+        with metrics.span('serialize', format='parquet', rows=len(partition_df)) as span:
+            table = build_target_table(partition_df, metadata['Columns'])
+            parquet_buffer = BytesIO()
+            pq.write_table(table, parquet_buffer, compression=None if PARQUET_COMPRESSION == "none" else PARQUET_COMPRESSION)
+            body = parquet_buffer.getvalue()
+            span['bytes'] = len(body)
+
+        s3_key = f"{prefix}/{partition_path}/{run_id}.parquet" if prefix else f"{partition_path}/{run_id}.parquet"
+        with metrics.span('upload', format='parquet', bytes=len(body)):
+            s3_client.put_object(Bucket=bucket, Key=s3_key, Body=body)
+        record_bytes_uploaded(len(body))
+        logger.info(f"Archivo escrito en la partición de destino: s3://{bucket}/{s3_key} ({len(partition_df)} filas)")
+        partitions.append((partition_values, f"{table_location}/{partition_path}/"))
+    return partitions
+
+
+def register_target_partitions(partitions: list, query_slots=None):
+    """
+    Registra las particiones escritas con un solo ALTER TABLE ADD IF NOT EXISTS PARTITION.
+    Si la tabla usa proyección de particiones no hace falta registrar nada.
+    Devuelve (id de ejecución, estado) o (None, 'PROJECTION').
+    """
+    parameters = get_target_table_metadata().get('Parameters', {})
+    if parameters.get('projection.enabled', 'false').lower() == 'true':
+        logger.info("La tabla de destino usa proyección de particiones; no se registran particiones.")
+        return None, 'PROJECTION'
+
+    partition_clauses = "\n        ".join(
+        "PARTITION ({}) LOCATION '{}'".format(
+            ", ".join(f"{key} = '{value}'" for key, value in partition_values.items()), location
+        )
+        for partition_values, location in partitions
+    )
+    alter_query = f"""
+    ALTER TABLE {ATHENA_DATABASE}.{ATHENA_TABLE} ADD IF NOT EXISTS
+        {partition_clauses};
+    """
+    logger.debug(f"Consulta de registro de particiones enviada a Athena:\n {alter_query}\n---------------")
+    alter_execution_id, alter_status = run_athena_query(alter_query, query_slots, 'athena_register')
+    logger.info(f"Registro de particiones completado con estado: {alter_status}")
+    return alter_execution_id, alter_status
+
+
+def split_backfill_partitions(start: pd.Timestamp, end: pd.Timestamp, granularity: str = "day"):
+    """
+    Divide [start, end) en particiones de un día o una hora. Devuelve una lista de (inicio, fin).
+    Cada sesión pertenece a la partición donde cae su primer evento (ver BIGQUERY_WINDOW_QUERY).
+    """
+    step = pd.Timedelta(hours=1) if granularity == "hour" else pd.Timedelta(days=1)
+    partitions = []
+    partition_start = start.floor("h" if granularity == "hour" else "D")
+    while partition_start < end:
+        partition_end = partition_start + step
+        partitions.append((max(partition_start, start), min(partition_end, end)))
+        partition_start = partition_end
+    return partitions
+
+
+def get_partition_label(partition_start: pd.Timestamp, granularity: str = "day"):
+    return partition_start.strftime("%Y%m%d%H" if granularity == "hour" else "%Y%m%d")
+
+
+def extract_transform_upload_partition(window_start: str, window_end: str, label: str):
+    """
+    Lee de BigQuery las sesiones que empiezan en [window_start, window_end) (ver BIGQUERY_WINDOW_QUERY),
+    las transforma y las sube a S3. Se ejecuta en un proceso del pool de backfill (la transformación usa CPU).
+    Devuelve (subcarpeta en S3 o None si no hubo datos, filas cargadas); en modo 'direct'
+    devuelve las particiones escritas en la tabla de destino en lugar de la subcarpeta.
+    """
+    client = client_pool.bigquery_client()
+    lookback = datetime.timedelta(hours=SESSION_LOOKBACK_HOURS)
+    job_config = bigquery.QueryJobConfig(query_parameters=[
+        bigquery.ScalarQueryParameter("window_start", "TIMESTAMP", pd.Timestamp(window_start).to_pydatetime()),
+        bigquery.ScalarQueryParameter("window_end", "TIMESTAMP", pd.Timestamp(window_end).to_pydatetime()),
+        bigquery.ScalarQueryParameter("lookback_start", "TIMESTAMP", (pd.Timestamp(window_start) - lookback).to_pydatetime()),
+        bigquery.ScalarQueryParameter("lookahead_end", "TIMESTAMP", (pd.Timestamp(window_end) + lookback).to_pydatetime()),
+    ])
+    logger.info(f"Backfill {label}: ejecutando query en BigQuery de {window_start} a {window_end}")
+    # Corre en un proceso del pool: sus métricas solo quedan en el log estructurado
+    if TRANSFORM_ENGINE == "sql":
+        df_results = execute_bigquery_query_sql(client, BIGQUERY_WINDOW_QUERY, job_config)
+    else:
+        with metrics.span('extract', partition=label) as span:
+            results = fetch_query_results(client, BIGQUERY_WINDOW_QUERY, job_config)
+            span['rows'] = len(results)
+        logger.info(f"Backfill {label}: se obtuvieron {len(results)} filas.")
+        df_results = transform_results(results) if not results.empty else results
+    if df_results.empty:
+        return None, 0
+
+    if ATHENA_LOAD_MODE == "direct":
+        run_id = f"backfill_{label}_{new_run_id()}"
+        return write_to_target_partitions(df_results, run_id), len(df_results)
+    return upload_results_to_s3(df_results, folder_prefix=f"backfill_athena_load/{label}"), len(df_results)
+
+
+def run_backfill(start: pd.Timestamp, end: pd.Timestamp, granularity: str = "day", on_progress=None):
+    """
+    Carga el rango [start, end) en Athena partición por partición.
+    La extracción, transformación y subida corren en paralelo en un pool de procesos;
+    las cargas en Athena usan un semáforo para no pasar de ATHENA_MAX_CONCURRENT_QUERIES
+    consultas en vuelo. Devuelve el estado de cada partición; las fallidas se pueden
+    reintentar por separado con su rango.
+    on_progress(terminadas, total) se llama cada vez que termina una partición.
+    """
+    partitions = split_backfill_partitions(start, end, granularity)
+    finished = []
+    finished_lock = threading.Lock()
+    query_slots = threading.BoundedSemaphore(ATHENA_MAX_CONCURRENT_QUERIES)
+    report = []
+
+    def load_partition(entry, extract_future):
+        try:
+            uploaded, rows = extract_future.result()
+            entry['rows'] = rows
+            if uploaded is None:
+                entry['status'] = 'empty'
+                return entry
+            if ATHENA_LOAD_MODE == "direct":
+                entry['target_partitions'] = [location for _, location in uploaded]
+                athena_results = {'register': register_target_partitions(uploaded, query_slots)}
+            else:
+                entry['s3_folder'] = uploaded
+                athena_results = load_s3_folder_into_athena(
+                    uploaded, temp_table_name=get_temp_table_name(entry['partition']), query_slots=query_slots
+                )
+            entry['athena'] = {step: {'id': query_id, 'status': status} for step, (query_id, status) in athena_results.items()}
+            entry['status'] = 'loaded'
+        except Exception as e:
+            entry['status'] = 'failed'
+            entry['error'] = str(e)
+        logger.info(f"Backfill {entry['partition']}: {entry['status']}")
+        if on_progress is not None:
+            with finished_lock:
+                finished.append(entry['partition'])
+                on_progress(len(finished), len(partitions))
+        return entry
+
+    workers = max(min(BACKFILL_WORKERS, len(partitions)), 1)
+    with ProcessPoolExecutor(max_workers=workers) as process_pool, \
+            ThreadPoolExecutor(max_workers=ATHENA_MAX_CONCURRENT_QUERIES) as load_pool:
+        load_futures = []
+        for partition_start, partition_end in partitions:
+            label = get_partition_label(partition_start, granularity)
+            entry = {
+                'partition': label,
+                'start': partition_start.isoformat(),
+                'end': partition_end.isoformat(),
+                'retry': "/backfill?" + urlencode({
+                    'start': partition_start.isoformat(), 'end': partition_end.isoformat(), 'granularity': granularity,
+                }),
+            }
+            extract_future = process_pool.submit(
+                extract_transform_upload_partition, partition_start.isoformat(), partition_end.isoformat(), label
+            )
+            load_futures.append(load_pool.submit(load_partition, entry, extract_future))
+        report = [future.result() for future in load_futures]
+
+    return report
+
+
+def parse_backfill_bound(value: str, is_end: bool = False):
+    """
+    Convierte start/end del query string a Timestamp UTC. Una fecha sin hora en 'end' es inclusiva.
+    """
+    bound = pd.Timestamp(value)
+    bound = bound.tz_localize("UTC") if bound.tzinfo is None else bound.tz_convert("UTC")
+    if is_end and len(value) == 10:
+        bound += pd.Timedelta(days=1)
+    return bound
+
+
+def parse_backfill_args(args):
+    """
+    Lee start, end y granularity del query string. Lanza ValueError si no son válidos.
+    """
+    try:
+        start = parse_backfill_bound(args["start"])
+        end = parse_backfill_bound(args.get("end", args["start"]), is_end=True)
+    except KeyError as e:
+        raise ValueError(f"falta el parámetro {e}")
+    granularity = args.get("granularity", "day")
+    if granularity not in ("day", "hour") or end <= start:
+        raise ValueError("granularity debe ser day u hour y end posterior a start")
+    return start, end, granularity
+
+
+@app.route("/backfill")
+def backfill():
+    """
+    Recarga un rango de fechas: /backfill?start=2025-01-01&end=2025-01-07[&granularity=day|hour]
+    """
+    try:
+        start, end, granularity = parse_backfill_args(request.args)
+    except ValueError as e:
+        return f"Parámetros inválidos para backfill: {e}", 400
+
+    logger.info(f"Iniciando backfill de {start.isoformat()} a {end.isoformat()} por {granularity}...")
+    report = run_backfill(start, end, granularity)
+    failed = [entry for entry in report if entry['status'] == 'failed']
+    logger.info(f"Backfill terminado: {len(report) - len(failed)} particiones correctas, {len(failed)} fallidas.")
+    return jsonify({'partitions': report, 'failed': len(failed)}), 500 if failed else 200
+
+
+def run_transfer_job(job):
+    message, status_code = run_transfer(on_stage=job.set_stage)
+    if status_code != 200:
+        raise Exception(message)
+    return message
+
+
+def run_backfill_job(job, start, end, granularity):
+    job.set_stage('backfill', partitions_done=0)
+    report = run_backfill(
+        start, end, granularity,
+        on_progress=lambda done, total: job.set_stage('backfill', partitions_done=done, partitions_total=total),
+    )
+    failed = [entry for entry in report if entry['status'] == 'failed']
+    job.result = {'partitions': report, 'failed': len(failed)}
+    if failed:
+        raise Exception(f"Fallaron {len(failed)} particiones del backfill.")
+    return job.result
+
+
+@app.route("/jobs", methods=["POST"])
+def create_job():
+    """
+    Encola una ejecución y responde de inmediato con el id del trabajo.
+    Sin parámetros carga el día actual (como /); con start/end[/granularity] hace un backfill.
+    Si ya hay un trabajo en curso para la misma ventana de fechas se devuelve ese.
+    """
+    if "start" in request.args:
+        try:
+            start, end, granularity = parse_backfill_args(request.args)
+        except ValueError as e:
+            return f"Parámetros inválidos para backfill: {e}", 400
+        key = f"backfill:{start.isoformat()}:{end.isoformat()}:{granularity}"
+        job, created = job_manager.submit(
+            key, f"Backfill de {start.isoformat()} a {end.isoformat()} por {granularity}",
+            run_backfill_job, start, end, granularity,
+        )
+    else:
+        window = "incremental" if INCREMENTAL_MODE else pd.Timestamp.now(tz="UTC").date().isoformat()
+        job, created = job_manager.submit(f"transfer:{window}", f"Transferencia {window}", run_transfer_job)
+
+    logger.info(f"Trabajo {job.id} ({job.key}) {'encolado' if created else 'ya en curso, se reutiliza'}.")
+    return jsonify({'job': job.to_dict(), 'coalesced': not created, 'status_url': f"/jobs/{job.id}"}), 202 if created else 200
+
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def get_job(job_id):
+    """
+    Estado, etapa y progreso de un trabajo.
+    """
+    job = job_manager.get(job_id)
+    if job is None:
+        return f"No existe el trabajo {job_id}.", 404
+    return jsonify(job.to_dict()), 200
+
+
+@app.route("/jobs", methods=["GET"])
+def list_jobs():
+    return jsonify([job.to_dict() for job in job_manager.list()]), 200
+
+
+def hold_run_lease():
+    """
+    Concesión sobre la ventana que carga esta ejecución (ver RUN_LEASE); sin RUN_LEASE no hace nada.
+    """
+    if not RUN_LEASE:
+        return contextlib.nullcontext()
+    window = "incremental" if INCREMENTAL_MODE else datetime.datetime.now(datetime.timezone.utc).date().isoformat()
+    location = f"{RUN_LEASE_LOCATION.rstrip('/')}/{ATHENA_DATABASE}.{ATHENA_TABLE}/{window}.json"
+    return lease.hold(location, datetime.timedelta(seconds=RUN_LEASE_TTL_SECONDS), client_pool.aws_client('s3'))
+
+
+def run_transfer(on_stage=None):
+    """
+    Orquesta la lectura de BigQuery, la subida a S3 y la inserción en Athena.
+    Devuelve (mensaje, código HTTP). on_stage(etapa, **progreso) informa la etapa actual.
+    La ejecución completa se registra como la etapa 'run'.
+    """
+    with metrics.span('run', load_mode=ATHENA_LOAD_MODE, incremental=INCREMENTAL_MODE) as span:
+        try:
+            with hold_run_lease():
+                message, status_code = _run_transfer(on_stage)
+        except lease.LeaseUnavailable as e:
+            logger.warning(f"Otra ejecución está cargando la misma ventana: {e}")
+            message, status_code = f"Otra ejecución está cargando la misma ventana ({e}). Reintenta más tarde.", 409
+        span['status_code'] = status_code
+    metrics.registry.inc("pipeline_runs_total", 1, "Ejecuciones del pipeline terminadas.", status_code=status_code)
+    return message, status_code
+
+
+_transform_code_version = None
+
+
+def get_result_cache_key():
+    """
+    Llave de la caché para la ejecución del día (ver result_cache): query y día (CURRENT_DATE de
+    BigQuery es UTC), foto de la tabla de origen, versión del código y la configuración que cambia
+    el archivo subido o su carga. La versión cubre la transformación (clean_data, sql_transform) y
+    lo que arma el archivo y el INSERT (este módulo y s3_writer): columnas, tipos, serialización.
+    """
+    global _transform_code_version
+    if _transform_code_version is None:
+        _transform_code_version = result_cache.get_code_version(
+            [c_data, sql_transform, s3_writer, sys.modules[__name__]])
+    table = client_pool.bigquery_client().get_table(BIGQUERY_TABLE)
+    return result_cache.build_cache_key(
+        query=BIGQUERY_QUERY,
+        window=datetime.datetime.now(datetime.timezone.utc).date().isoformat(),
+        source=result_cache.get_source_snapshot(table),
+        code=_transform_code_version,
+        transform_engine=TRANSFORM_ENGINE,
+        output_format=S3_OUTPUT_FORMAT,
+        load_mode=ATHENA_LOAD_MODE,
+        target=f"{ATHENA_DATABASE}.{ATHENA_TABLE}",
+    )
+
+
+def load_result_cache_entry(cache_key):
+    """
+    Entrada vigente de la caché para cache_key ('uploaded' o 'loaded'), o None.
+    """
+    if cache_key is None:
+        return None
+    entry = result_cache.load_entry(RESULT_CACHE_LOCATION, cache_key, client_pool.aws_client('s3'))
+    metrics.registry.inc("result_cache_lookups_total", 1, "Búsquedas en la caché de resultados por resultado.",
+                         result=entry['status'] if entry else 'miss')
+    return entry
+
+
+def save_result_cache_entry(cache_key, entry: dict):
+    if cache_key is None:
+        return entry
+    return result_cache.save_entry(RESULT_CACHE_LOCATION, cache_key, entry,
+                                   datetime.timedelta(hours=RESULT_CACHE_TTL_HOURS), client_pool.aws_client('s3'))
+
+
+def _run_transfer(on_stage=None):
+    on_stage = on_stage or (lambda stage, **progress: None)
+    logger.info("Iniciando proceso de transferencia de datos de BigQuery a Athena...")
+
+    # 0. Buscar el resultado en la caché: si ya se cargó no hay nada que hacer; si solo se subió,
+    # se reutiliza el archivo y se repite únicamente la carga en Athena.
+    cache_key = get_result_cache_key() if RESULT_CACHE and not INCREMENTAL_MODE else None
+    cache_entry = load_result_cache_entry(cache_key)
+    if cache_entry is not None and cache_entry['status'] == 'loaded':
+        logger.info(f"Sin cambios en el origen ni en el código desde la ejecución de {cache_entry['created_at']}; se omite la carga.")
+        return f"Sin cambios desde la ejecución de {cache_entry['created_at']}: los datos ya están cargados en Athena.", 200
+
+    incremental_state = None
+    if cache_entry is not None:
+        logger.info(f"Se reutiliza el resultado subido en la ejecución de {cache_entry['created_at']} ({cache_entry['rows']} filas).")
+    elif PIPELINED_TRANSFER and ATHENA_LOAD_MODE == "insert" and TRANSFORM_ENGINE == "pandas" and not INCREMENTAL_MODE:
+        # 1-2. Leer, transformar y subir a S3 a la vez, por trozos
+        on_stage('extract')
+        unique_folder, rows = execute_pipelined_transfer()
+        if unique_folder is None:
+            logger.info("No se encontraron registros en BigQuery. Proceso finalizado.")
+            return "No se encontraron registros en BigQuery.", 200
+        cache_entry = save_result_cache_entry(cache_key, {'status': 'uploaded', 'rows': rows, 's3_folder': unique_folder})
+    else:
+        # 1. Leer datos de BigQuery
+        on_stage('extract')
+        if INCREMENTAL_MODE:
+            df_results, incremental_state = execute_bigquery_query_incremental()
+        else:
+            df_results = execute_bigquery_query()
+
+        if df_results.empty:
+            if incremental_state is not None:
+                watermark.save_state(WATERMARK_LOCATION, incremental_state, client_pool.aws_client('s3'))
+            logger.info("No se encontraron registros en BigQuery. Proceso finalizado.")
+            return "No se encontraron registros en BigQuery.", 200
+
+    if ATHENA_LOAD_MODE == "direct":
+        # 2-3. Escribir en las particiones de la tabla de destino y registrarlas (sin tabla temporal)
+        if cache_entry is None:
+            on_stage('upload', rows=len(df_results))
+            run_id = new_run_id()
+            partitions = write_to_target_partitions(df_results, run_id)
+            cache_entry = save_result_cache_entry(cache_key, {'status': 'uploaded', 'rows': len(df_results), 'partitions': partitions})
+        partitions = cache_entry['partitions']
+        on_stage('athena_register')
+        register_execution_id, register_status = register_target_partitions(partitions)
+        if register_status in ('SUCCEEDED', 'PROJECTION'):
+            save_result_cache_entry(cache_key, {**cache_entry, 'status': 'loaded'})
+        if incremental_state is not None:
+            watermark.save_state(WATERMARK_LOCATION, incremental_state, client_pool.aws_client('s3'))
+        logger.info("Proceso completado exitosamente.")
+        return f"Proceso completado. Particiones escritas: {len(partitions)}. Registro de particiones en Athena: {register_execution_id} ({register_status}).", 200
+
+    # 2. Subir los resultados a S3
+    if cache_entry is None:
+        on_stage('upload', rows=len(df_results))
+        unique_folder = upload_results_to_s3(df_results)
+
+        if unique_folder is None:
+            return "No se subió ningún archivo a S3 porque el DataFrame estaba vacío.", 200
+        cache_entry = save_result_cache_entry(cache_key, {'status': 'uploaded', 'rows': len(df_results), 's3_folder': unique_folder})
+    unique_folder = cache_entry['s3_folder']
+
+    # 3. Crear la tabla temporal, insertar en la tabla de destino y eliminar la temporal
+    athena_results = load_s3_folder_into_athena(unique_folder, on_stage=on_stage)
+    create_table_execution_id, create_status = athena_results['create']
+    insert_execution_id, insert_status = athena_results['insert']
+    drop_execution_id, drop_status = athena_results['drop']
+
+    # Solo se marca como cargado si el INSERT terminó bien; si no, el reintento repite la carga
+    if insert_status == 'SUCCEEDED':
+        save_result_cache_entry(cache_key, {**cache_entry, 'status': 'loaded'})
+
+    # La marca de agua solo avanza cuando los datos ya están en Athena
+    if incremental_state is not None:
+        watermark.save_state(WATERMARK_LOCATION, incremental_state, client_pool.aws_client('s3'))
+        logger.info(f"Marca de agua incremental actualizada a {incremental_state['watermark']}")
+
+    logger.info("Proceso completado exitosamente.")
+    return f"Proceso completado. IDs de ejecución de consulta de Athena: Crear={create_table_execution_id} ({create_status}), Insertar={insert_execution_id} ({insert_status}), Eliminar={drop_execution_id} ({drop_status}).", 200
+
+
+@app.route("/metrics")
+def metrics_endpoint():
+    """
+    Métricas del proceso en formato de texto de Prometheus: duración por etapa, filas,
+    bytes subidos, tiempos y bytes escaneados de Athena y pico de memoria.
+    """
+    return metrics.registry.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+
+@app.route("/")
+def main():
+    """
+    Función principal que se ejecuta cuando el Cloud Run recibe una solicitud.
+    Orquesta la lectura de BigQuery, la subida a S3 y la inserción en Athena.
+    """
+    try:
+        return run_transfer()
 
     except Exception as e:
         # Manejo de errores general
         error_message = f"Ocurrió un error durante la ejecución: {e}"
-        print(error_message)
+        logger.exception(error_message)
         return error_message, 500
 
 
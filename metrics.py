@@ -0,0 +1,191 @@
+import json
+import logging
+import os
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Una línea JSON por registro, con 'severity' y 'message' (campos que Cloud Logging reconoce)
+    más los campos estructurados pasados en extra={'fields': {...}}.
+    """
+
+    def format(self, record):
+        entry = {
+            'severity': record.levelname,
+            'message': record.getMessage(),
+            'logger': record.name,
+        }
+        entry.update(getattr(record, 'fields', {}))
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+def setup_logging(level: str = None):
+    """
+    Configura el logging raíz con salida JSON a stdout. El nivel se toma de LOG_LEVEL (INFO por defecto).
+    """
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(JsonFormatter())
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel((level or os.environ.get("LOG_LEVEL", "INFO")).upper())
+
+
+def get_peak_rss_bytes():
+    # ru_maxrss está en KiB en Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class MetricsRegistry:
+    """
+    Contadores, gauges y resúmenes (suma y conteo) en memoria, con etiquetas,
+    exportables en el formato de texto de Prometheus.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}  # nombre -> (tipo, ayuda, {etiquetas: valor})
+
+    def _series(self, name: str, metric_type: str, help_text: str):
+        if name not in self._metrics:
+            self._metrics[name] = (metric_type, help_text, {})
+        return self._metrics[name][2]
+
+    def inc(self, name: str, value: float = 1, help_text: str = "", **labels):
+        with self._lock:
+            series = self._series(name, "counter", help_text)
+            key = tuple(sorted(labels.items()))
+            series[key] = series.get(key, 0) + value
+
+    def set(self, name: str, value: float, help_text: str = "", **labels):
+        with self._lock:
+            self._series(name, "gauge", help_text)[tuple(sorted(labels.items()))] = value
+
+    def observe(self, name: str, value: float, help_text: str = "", **labels):
+        with self._lock:
+            series = self._series(name, "summary", help_text)
+            key = tuple(sorted(labels.items()))
+            total, count = series.get(key, (0.0, 0))
+            series[key] = (total + value, count + 1)
+
+    def render(self):
+        """
+        Devuelve todas las métricas en el formato de exposición de texto de Prometheus.
+        """
+        self.set("process_peak_rss_bytes", get_peak_rss_bytes(), "Pico de memoria residente del proceso.")
+        lines = []
+        with self._lock:
+            for name, (metric_type, help_text, series) in sorted(self._metrics.items()):
+                if help_text:
+                    lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {metric_type}")
+                for key, value in sorted(series.items()):
+                    labels = _format_labels(key)
+                    if metric_type == "summary":
+                        total, count = value
+                        lines.append(f"{name}_sum{labels} {total}")
+                        lines.append(f"{name}_count{labels} {count}")
+                    else:
+                        lines.append(f"{name}{labels} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def _format_labels(key):
+    if not key:
+        return ""
+    escaped = []
+    for label, value in key:
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        escaped.append(f'{label}="{value}"')
+    return "{" + ",".join(escaped) + "}"
+
+
+registry = MetricsRegistry()
+
+# Funciones listener(etapa, segundos, campos) que se llaman al terminar cada etapa o paso
+# (p. ej. el benchmark las usa para medir la memoria de cada paso).
+stage_listeners = []
+
+
+def _record_stage(stage: str, seconds: float, outcome: str, fields: dict, level: int = logging.INFO):
+    registry.observe("pipeline_stage_seconds", seconds, "Duración de cada etapa del pipeline.",
+                     stage=stage, outcome=outcome)
+    registry.set("pipeline_stage_last_seconds", seconds, "Duración de la última ejecución de cada etapa.",
+                 stage=stage)
+    logger.log(level, f"Etapa {stage} terminada en {seconds:.3f}s", extra={'fields': {
+        'stage': stage, 'seconds': round(seconds, 6), 'outcome': outcome,
+        'peak_rss_bytes': get_peak_rss_bytes(), **fields,
+    }})
+    for listener in stage_listeners:
+        listener(stage, seconds, fields)
+
+
+@contextmanager
+def span(stage: str, **fields):
+    """
+    Mide la duración de una etapa del pipeline. Registra pipeline_stage_seconds{stage=...}
+    y deja un log estructurado con la duración, el resultado y los campos extra.
+    Dentro del bloque se pueden agregar campos al log: `with span('x') as s: s['rows'] = 10`.
+    """
+    span_fields = dict(fields)
+    start = time.perf_counter()
+    outcome = "ok"
+    try:
+        yield span_fields
+    except Exception:
+        outcome = "error"
+        raise
+    finally:
+        _record_stage(stage, time.perf_counter() - start, outcome, span_fields)
+
+
+class StageTimer:
+    """
+    Mide pasos consecutivos dentro de una etapa sin anidar bloques: cada mark(paso)
+    registra como '<etapa>.<paso>' el tiempo transcurrido desde la marca anterior.
+    Los pasos se registran en el log con nivel DEBUG.
+    """
+
+    def __init__(self, stage: str):
+        self.stage = stage
+        self._last = time.perf_counter()
+
+    def mark(self, step: str, **fields):
+        now = time.perf_counter()
+        _record_stage(f"{self.stage}.{step}", now - self._last, "ok", fields, logging.DEBUG)
+        self._last = now
+
+
+def record_athena_statistics(query_execution: dict):
+    """
+    Registra los tiempos de motor, cola y planificación y los bytes escaneados de una consulta
+    de Athena terminada (QueryExecution de get_query_execution).
+    """
+    statistics = query_execution.get('Statistics', {})
+    statement = query_execution.get('StatementType', 'UNKNOWN')
+    state = query_execution['Status']['State']
+    timings = {
+        'engine': statistics.get('EngineExecutionTimeInMillis', 0),
+        'queue': statistics.get('QueryQueueTimeInMillis', 0),
+        'planning': statistics.get('QueryPlanningTimeInMillis', 0),
+        'total': statistics.get('TotalExecutionTimeInMillis', 0),
+    }
+    for phase, millis in timings.items():
+        registry.observe("athena_query_seconds", millis / 1000, "Tiempos de las consultas de Athena por fase.",
+                         statement=statement, phase=phase)
+    scanned = statistics.get('DataScannedInBytes', 0)
+    registry.inc("athena_data_scanned_bytes_total", scanned, "Bytes escaneados por Athena.", statement=statement)
+    registry.inc("athena_queries_total", 1, "Consultas de Athena terminadas.", statement=statement, state=state)
+    logger.info(f"Consulta de Athena {query_execution.get('QueryExecutionId')} terminada: {state}", extra={'fields': {
+        'stage': 'athena', 'statement': statement, 'state': state,
+        'engine_ms': timings['engine'], 'queue_ms': timings['queue'], 'planning_ms': timings['planning'],
+        'total_ms': timings['total'], 'data_scanned_bytes': scanned,
+    }})
@@ -0,0 +1,110 @@
+"""
+Ejecutor por etapas concurrentes (productor/consumidor) unidas por colas acotadas:
+un hilo lee los trozos de la fuente (red), un pool de procesos los transforma (CPU) y un pool
+de hilos sube los resultados (red). Mientras una etapa trabaja las demás avanzan con otros
+trozos, así el tiempo total se acerca al de la etapa más lenta en lugar de la suma de todas.
+Las colas llenas detienen a la etapa anterior (contrapresión): en memoria hay como mucho
+queue_size trozos por cola más los que cada pool tiene en proceso.
+"""
+import collections
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+_DONE = object()
+
+
+def run_pipeline(source, transform, upload, transform_workers: int = 1, upload_workers: int = 1,
+                 queue_size: int = 2, executor_class=ProcessPoolExecutor):
+    """
+    Ejecuta upload(índice, transform(trozo)) para cada trozo de source (un iterable).
+    transform corre en executor_class (procesos por defecto: debe poder serializarse con pickle);
+    upload corre en upload_workers hilos. Devuelve los resultados de upload en el orden de los trozos.
+    Si una etapa falla, las demás se detienen y se relanza la primera excepción.
+    """
+    fetched = queue.Queue(maxsize=queue_size)
+    transformed = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    errors = []
+    results = {}
+
+    def fail(error):
+        errors.append(error)
+        stop.set()
+
+    def put(target, item):
+        # Espera lugar en la cola salvo que otra etapa haya fallado
+        while not stop.is_set():
+            try:
+                target.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def get(origin):
+        while not stop.is_set():
+            try:
+                return origin.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _DONE
+
+    def fetch():
+        try:
+            for index, chunk in enumerate(source):
+                if not put(fetched, (index, chunk)):
+                    return
+        except Exception as e:
+            fail(e)
+            return
+        put(fetched, _DONE)
+
+    def dispatch():
+        # Hasta transform_workers trozos en proceso; se entregan en orden a la cola de subida
+        pending = collections.deque()
+        try:
+            with executor_class(max_workers=transform_workers) as executor:
+                while True:
+                    item = get(fetched)
+                    if item is _DONE:
+                        break
+                    index, chunk = item
+                    pending.append((index, executor.submit(transform, chunk)))
+                    if len(pending) >= transform_workers:
+                        index, future = pending.popleft()
+                        if not put(transformed, (index, future.result())):
+                            break
+                while pending and not stop.is_set():
+                    index, future = pending.popleft()
+                    put(transformed, (index, future.result()))
+                for _, future in pending:
+                    future.cancel()
+        except Exception as e:
+            fail(e)
+            return
+        for _ in range(upload_workers):
+            put(transformed, _DONE)
+
+    def upload_loop():
+        while True:
+            item = get(transformed)
+            if item is _DONE:
+                return
+            index, result = item
+            try:
+                results[index] = upload(index, result)
+            except Exception as e:
+                fail(e)
+                return
+
+    threads = [threading.Thread(target=fetch), threading.Thread(target=dispatch)]
+    threads += [threading.Thread(target=upload_loop) for _ in range(upload_workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        raise errors[0]
+    return [results[index] for index in sorted(results)]
@@ -0,0 +1,80 @@
+"""
+Caché de resultados por contenido: cada ejecución se identifica con una llave que combina el
+query y su ventana, una foto del estado de la tabla de origen y la versión del código de la
+transformación. Si una ejecución con la misma llave ya subió su archivo o ya lo cargó en Athena,
+los reintentos no vuelven a leer BigQuery, transformar ni insertar (ver main._run_transfer).
+Las entradas se guardan como JSON en S3 o en disco, con las mismas funciones que la marca de agua.
+"""
+import datetime
+import hashlib
+import json
+import pandas as pd
+import watermark
+
+
+def get_code_version(modules) -> str:
+    """
+    Hash del código fuente de los módulos dados (p. ej. clean_data, sql_transform y los que arman
+    el archivo subido): cualquier cambio en la transformación o en la salida produce llaves nuevas.
+    """
+    digest = hashlib.sha256()
+    for module in modules:
+        with open(module.__file__, "rb") as source_file:
+            digest.update(source_file.read())
+    return digest.hexdigest()
+
+
+def get_source_snapshot(table) -> dict:
+    """
+    Foto del estado de una tabla de BigQuery (bigquery.Table de get_table): fecha de modificación,
+    filas y bytes, más las filas estimadas del buffer de streaming, que no se reflejan en las anteriores
+    hasta que se consolidan (las tablas de un sink de Cloud Logging reciben los logs por streaming).
+    """
+    streaming_buffer = table.streaming_buffer
+    return {
+        "modified": table.modified.isoformat() if table.modified else None,
+        "num_rows": table.num_rows,
+        "num_bytes": table.num_bytes,
+        "streaming_rows": streaming_buffer.estimated_rows if streaming_buffer else None,
+        "streaming_oldest_entry": (
+            streaming_buffer.oldest_entry_time.isoformat()
+            if streaming_buffer and streaming_buffer.oldest_entry_time else None
+        ),
+    }
+
+
+def build_cache_key(**parts) -> str:
+    """
+    Llave de la caché: sha256 de las partes (query, ventana, foto del origen, versión del código...)
+    serializadas en JSON con las claves ordenadas.
+    """
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def get_entry_location(location: str, key: str) -> str:
+    return f"{location.rstrip('/')}/{key}.json"
+
+
+def load_entry(location: str, key: str, s3_client=None, now: datetime.datetime = None):
+    """
+    Devuelve la entrada guardada para key, o None si no existe o ya expiró.
+    """
+    entry = watermark.load_state(get_entry_location(location, key), s3_client)
+    if not entry:
+        return None
+    now = pd.Timestamp(now or datetime.datetime.now(datetime.timezone.utc))
+    if pd.Timestamp(entry["expires_at"]) <= now:
+        return None
+    return entry
+
+
+def save_entry(location: str, key: str, entry: dict, ttl: datetime.timedelta, s3_client=None,
+               now: datetime.datetime = None) -> dict:
+    """
+    Guarda la entrada de key. La expiración se fija al crearla (now + ttl) y se conserva en las
+    actualizaciones posteriores de la misma entrada. Devuelve la entrada guardada.
+    """
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    entry = {"key": key, "created_at": now.isoformat(), "expires_at": (now + ttl).isoformat(), **entry}
+    watermark.save_state(get_entry_location(location, key), entry, s3_client)
+    return entry
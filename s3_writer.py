@@ -0,0 +1,172 @@
+import io
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+import pyarrow.parquet as pq
+
+# S3 exige al menos 5 MiB por parte en una subida multipart (salvo la última)
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+
+class S3MultipartStream(io.RawIOBase):
+    """
+    Archivo de solo escritura que sube su contenido a S3 por partes mientras se escribe.
+    Cada vez que se juntan part_size bytes se envía una parte en el executor; como mucho
+    max_in_flight partes esperan a la vez (si no, write() se bloquea), así la memoria queda
+    acotada a unas pocas partes. Si el objeto cabe en una sola parte se usa put_object.
+    """
+
+    def __init__(self, s3_client, bucket: str, key: str, part_size: int, executor, max_in_flight: int):
+        super().__init__()
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = max(part_size, MIN_PART_SIZE)
+        self.executor = executor
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._buffer = bytearray()
+        self._position = 0
+        self._upload_id = None
+        self._parts = []
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def write(self, data):
+        self._buffer += data
+        self._position += len(data)
+        while len(self._buffer) >= self.part_size:
+            self._submit_part(bytes(self._buffer[:self.part_size]))
+            del self._buffer[:self.part_size]
+        return len(data)
+
+    def _upload_part(self, part_number: int, body: bytes):
+        try:
+            response = self.s3_client.upload_part(
+                Bucket=self.bucket, Key=self.key, UploadId=self._upload_id, PartNumber=part_number, Body=body
+            )
+            return {'PartNumber': part_number, 'ETag': response['ETag']}
+        finally:
+            self._slots.release()
+
+    def _submit_part(self, body: bytes):
+        if self._upload_id is None:
+            response = self.s3_client.create_multipart_upload(Bucket=self.bucket, Key=self.key)
+            self._upload_id = response['UploadId']
+        self._slots.acquire()
+        part_number = len(self._parts) + 1
+        self._parts.append(self.executor.submit(self._upload_part, part_number, body))
+
+    def finish(self):
+        """
+        Sube lo que queda en el buffer y cierra el objeto en S3. Devuelve los bytes escritos.
+        """
+        if self._upload_id is None:
+            self.s3_client.put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self._buffer))
+            self._buffer.clear()
+            return self._position
+        try:
+            if self._buffer:
+                self._submit_part(bytes(self._buffer))
+                self._buffer.clear()
+            parts = [future.result() for future in self._parts]
+            self.s3_client.complete_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=self._upload_id, MultipartUpload={'Parts': parts}
+            )
+        except Exception:
+            self.abort()
+            raise
+        return self._position
+
+    def abort(self):
+        if self._upload_id is not None:
+            for future in self._parts:
+                future.cancel()
+            self.s3_client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self._upload_id)
+            self._upload_id = None
+
+
+class CsvEncoder:
+    """
+    Codifica bloques de filas como CSV (sin índice, con cabecera al inicio de cada objeto).
+    """
+    extension = "csv"
+
+    def open(self, stream):
+        self.stream = stream
+        self.header = True
+
+    def write(self, df: pd.DataFrame):
+        self.stream.write(df.to_csv(index=False, header=self.header).encode("utf-8"))
+        self.header = False
+
+    def close(self):
+        pass
+
+
+class ParquetEncoder:
+    """
+    Codifica bloques de filas como grupos de filas de un archivo Parquet.
+    to_table convierte cada bloque en una tabla Arrow con el esquema schema.
+    """
+    extension = "parquet"
+
+    def __init__(self, schema, to_table, compression: str = "snappy"):
+        self.schema = schema
+        self.to_table = to_table
+        self.compression = None if compression == "none" else compression
+
+    def open(self, stream):
+        self.writer = pq.ParquetWriter(stream, self.schema, compression=self.compression)
+
+    def write(self, df: pd.DataFrame):
+        self.writer.write_table(self.to_table(df))
+
+    def close(self):
+        self.writer.close()
+
+
+def get_object_key(key: str, index: int, split: bool):
+    if not split:
+        return key
+    base, dot, extension = key.rpartition(".")
+    return f"{base}-{index:05d}{dot}{extension}" if dot else f"{key}-{index:05d}"
+
+
+def upload_dataframe_in_parts(s3_client, bucket: str, key: str, df: pd.DataFrame, encoder,
+                              rows_per_chunk: int = 50000, part_size: int = 16 * 1024 * 1024,
+                              max_concurrency: int = 4, target_object_size: int = 0):
+    """
+    Codifica el DataFrame por bloques de rows_per_chunk filas y lo sube a S3 con subidas
+    multipart concurrentes, sin generar el archivo completo en memoria.
+    Si target_object_size > 0, la salida se divide en varios objetos de aproximadamente ese
+    tamaño (key-00000.ext, key-00001.ext, ...) para que Athena los lea en paralelo.
+    Devuelve la lista de objetos escritos: [(key, bytes)].
+    """
+    split = target_object_size > 0
+    objects = []
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        stream = None
+        try:
+            for start in range(0, len(df), rows_per_chunk):
+                if stream is None:
+                    stream = S3MultipartStream(
+                        s3_client, bucket, get_object_key(key, len(objects), split), part_size, executor, max_concurrency
+                    )
+                    encoder.open(stream)
+                encoder.write(df.iloc[start:start + rows_per_chunk])
+                if split and stream.tell() >= target_object_size:
+                    encoder.close()
+                    objects.append((stream.key, stream.finish()))
+                    stream = None
+            if stream is not None:
+                encoder.close()
+                objects.append((stream.key, stream.finish()))
+        except Exception:
+            if stream is not None:
+                stream.abort()
+            raise
+    return objects
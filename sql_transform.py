@@ -0,0 +1,199 @@
+"""
+Motor de transformación "sql": genera un solo query que hace en BigQuery la agregación por
+sesión de clean_data.clean_transform_data y devuelve ya una fila por sesión con las columnas
+finales, en lugar de traer todas las filas del log a pandas.
+"""
+import pandas as pd
+import clean_data as c_data
+
+# Ruta en la tabla de origen de cada columna que usa la transformación (ver RESOURCE_MAP y JSON_PAYLOAD_MAP)
+SOURCE_PATHS = {
+    **{name: f"resource.{path}" for path, name in c_data.RESOURCE_MAP.items()},
+    **{name: f"jsonPayload.{path}" for path, name in c_data.JSON_PAYLOAD_MAP.items()},
+}
+
+CONTACT_GROUPS = {'curp': c_data.CURP_COLS, 'correo': c_data.EMAIL_COLS, 'telefono': c_data.PHONE_COLS}
+
+# Expresiones que cambian entre BigQuery y DuckDB (DuckDB sirve para comparar con el motor pandas sin nube)
+SQL_DIALECTS = {
+    'bigquery': {
+        'first_non_null': "ARRAY_AGG({value} IGNORE NULLS ORDER BY {order} LIMIT 1)[SAFE_OFFSET(0)]",
+        'seconds_between': "TIMESTAMP_DIFF({end}, {start}, SECOND)",
+        'div': "DIV({dividend}, {divisor})",
+        'format_hms': "FORMAT('%02d:%02d:%02d', {hours}, {minutes}, {seconds})",
+        'time_of_day': "FORMAT_TIMESTAMP('%H:%M:%S', {value})",
+    },
+    'duckdb': {
+        'first_non_null': "FIRST({value} ORDER BY {order}) FILTER (WHERE {value} IS NOT NULL)",
+        'seconds_between': "(EPOCH_US({end}) - EPOCH_US({start})) // 1000000",
+        'div': "({dividend}) // ({divisor})",
+        'format_hms': "PRINTF('%02d:%02d:%02d', {hours}, {minutes}, {seconds})",
+        'time_of_day': "STRFTIME({value}, '%H:%M:%S')",
+    },
+}
+
+
+def get_schema_field_paths(fields, prefix: str = "") -> set:
+    """
+    Rutas 'a.b.c' de todos los campos de un esquema de BigQuery (lista de SchemaField, con RECORD anidados).
+    """
+    paths = set()
+    for field in fields:
+        path = f"{prefix}{field.name}"
+        paths.add(path)
+        if field.fields:
+            paths |= get_schema_field_paths(field.fields, f"{path}.")
+    return paths
+
+
+def get_output_columns(field_paths: set) -> list:
+    """
+    Columnas que deja clean_transform_data para una tabla de origen con esos campos.
+    Como en el motor pandas, curp/correo/telefono solo salen cuando el payload no trae un
+    slot con ese mismo nombre (si lo trae, el merge con los datos de contacto los duplica
+    con sufijos _x/_y y se descartan).
+    """
+    return [
+        column for column in c_data.FINAL_COLUMNS
+        if column not in CONTACT_GROUPS or SOURCE_PATHS[column] not in field_paths
+    ]
+
+
+def build_session_query(source_query: str, field_paths: set, dialect: str = 'bigquery') -> str:
+    """
+    Construye el query que produce el mismo resultado que clean_transform_data sobre las filas
+    de source_query (un SELECT de la tabla de logs; sus parámetros se conservan).
+    field_paths son los campos que existen en la tabla de origen (ver get_schema_field_paths);
+    los que faltan se tratan como NULL, igual que las columnas ausentes en pandas.
+    El resultado se ordena por timestamp descendente; pasar por finalize_results antes de subirlo.
+    """
+    sql = SQL_DIALECTS[dialect]
+
+    def field(column):
+        path = SOURCE_PATHS[column]
+        return path if path in field_paths else "CAST(NULL AS STRING)"
+
+    contact_columns = [column for columns in CONTACT_GROUPS.values() for column in columns]
+    contact_fields = "".join(f",\n        {field(column)} AS contact_{column}" for column in contact_columns)
+    contact_firsts = "".join(
+        f",\n        {sql['first_non_null'].format(value=f'contact_{column}', order='timestamp')} AS contact_{column}"
+        for column in contact_columns
+    )
+
+    def coalesce_contacts(name):
+        return "COALESCE({})".format(", ".join(f"s.contact_{column}" for column in CONTACT_GROUPS[name]))
+
+    contact_outputs = {
+        'curp': coalesce_contacts('curp'),
+        'correo': coalesce_contacts('correo'),
+        # Sin teléfono en los slots, las sesiones de WhatsApp lo toman de su sessionid
+        'telefono': f"""CASE
+            WHEN ({coalesce_contacts('telefono')} IS NULL OR {coalesce_contacts('telefono')} = '')
+                AND STARTS_WITH(r.sessionid, 'whatsapp:') THEN REPLACE(r.sessionid, 'whatsapp:', '')
+            ELSE {coalesce_contacts('telefono')}
+        END""",
+    }
+
+    def fill_within_session(column):
+        # ffill y luego bfill dentro de la sesión, con '' como nulo (ver clean_data.fill_within_session)
+        return f"""COALESCE(
+            LAST_VALUE(NULLIF({column}, '') IGNORE NULLS) OVER (
+                PARTITION BY sessionid ORDER BY timestamp ROWS BETWEEN UNBOUNDED PRECEDING AND CURRENT ROW),
+            FIRST_VALUE(NULLIF({column}, '') IGNORE NULLS) OVER (
+                PARTITION BY sessionid ORDER BY timestamp ROWS BETWEEN CURRENT ROW AND UNBOUNDED FOLLOWING)
+        )"""
+
+    hours = sql['div'].format(dividend="s.session_seconds", divisor="3600")
+    minutes = sql['div'].format(dividend="MOD(s.session_seconds, 3600)", divisor="60")
+    duration = sql['format_hms'].format(hours=hours, minutes=minutes, seconds="MOD(s.session_seconds, 60)")
+
+    outputs = {
+        'timestamp': "s.session_start",
+        'sessionid': "r.sessionid",
+        'lineanegocio': "r.configuration_name",
+        'motivoinicial': "r.session_intent_name",
+        'respuesta': "r.conversation",
+        'transacciondurantellamada': "CASE WHEN s.has_slot_type THEN 'transactional' ELSE r.transactional_or_non_transactional END",
+        'nombretransaccion': "r.intent_name",
+        'concluyeenvoice': "'No'",
+        'transferenciaasesor': "CASE WHEN r.intent_name = 'asesorEnLinea' THEN 'Si' ELSE '' END",
+        'canal': """CASE
+            WHEN STRPOS(r.sessionid, 'whatsapp:') > 0 THEN 'whatsapp'
+            WHEN STRPOS(r.sessionid, 'us-east-1') > 0 THEN 'text'
+            ELSE 'speech'
+        END""",
+        'intentprevio': "r.session_knowledge_domain",
+        'fallbackmessage': "CASE WHEN r.session_intent_name = 'FallbackIntent' THEN 'Yes' END",
+        'duracion': duration,
+        'tiempo_por_sesion': duration,
+        'horafinal': sql['time_of_day'].format(value="s.session_end"),
+        # BigQuery no admite nombres de columna que empiezan con '__': la agrega finalize_results
+        '__index_level_0__': None,
+        'year': "EXTRACT(YEAR FROM s.session_start)",
+        'month': "EXTRACT(MONTH FROM s.session_start)",
+        **contact_outputs,
+    }
+    select_list = ",\n        ".join(
+        f"{outputs.get(column, 'CAST(NULL AS STRING)')} AS {column}"
+        for column in get_output_columns(field_paths) if column != '__index_level_0__'
+    )
+
+    return f"""
+WITH source AS (
+    {source_query}
+),
+log_rows AS (
+    SELECT
+        {field('sessionid')} AS sessionid,
+        timestamp,
+        {field('intent_name')} AS intent_name,
+        {field('knowledge_domain')} AS knowledge_domain,
+        {field('transactional_or_non_transactional')} AS transactional_or_non_transactional,
+        {field('configuration_name')} AS configuration_name,
+        CONCAT(
+            COALESCE({field('conversation_log')}, ''), ', user_say: ',
+            COALESCE({field('inputTranscript')}, ''), ', bot_say: ',
+            COALESCE({field('final_response')}, '')
+        ) AS conversation,
+        {field('slot_type')} AS slot_type{contact_fields}
+    FROM source
+    WHERE {field('sessionid')} IS NOT NULL
+),
+ranked_rows AS (
+    SELECT
+        *,
+        {fill_within_session('intent_name')} AS session_intent_name,
+        {fill_within_session('knowledge_domain')} AS session_knowledge_domain,
+        -- Fila representativa: la de conversación más larga y, entre ellas, la más reciente
+        ROW_NUMBER() OVER (
+            PARTITION BY sessionid ORDER BY LENGTH(conversation) DESC, timestamp DESC
+        ) AS representative_rank
+    FROM log_rows
+),
+sessions AS (
+    SELECT
+        sessionid,
+        MIN(timestamp) AS session_start,
+        MAX(timestamp) AS session_end,
+        {sql['seconds_between'].format(start='MIN(timestamp)', end='MAX(timestamp)')} AS session_seconds,
+        COUNT(slot_type) > 0 AS has_slot_type{contact_firsts}
+    FROM log_rows
+    GROUP BY sessionid
+)
+SELECT
+        {select_list}
+FROM ranked_rows AS r
+JOIN sessions AS s ON s.sessionid = r.sessionid
+WHERE r.representative_rank = 1
+ORDER BY timestamp DESC
+"""
+
+
+def finalize_results(df: pd.DataFrame, field_paths: set) -> pd.DataFrame:
+    """
+    Deja el resultado del query con los mismos tipos y columnas que clean_transform_data:
+    timestamp UTC sin zona horaria y la columna constante __index_level_0__.
+    """
+    df['timestamp'] = pd.to_datetime(df['timestamp'], utc=True).dt.tz_localize(None)
+    df['__index_level_0__'] = '0'
+    return df[get_output_columns(field_paths)]
@@ -0,0 +1,154 @@
+"""
+Generador de filas sintéticas con la forma de los logs que se leen de BigQuery:
+'timestamp', 'resource' y 'jsonPayload' anidados, sesiones de WhatsApp, texto (Lex) y voz
+con varios turnos, y datos de contacto dispersos. Sirve para medir clean_transform_data
+y la subida sin acceso a la nube (ver benchmark.py).
+"""
+import numpy as np
+import pandas as pd
+
+INTENTS = np.array(['saldo', 'asesorEnLinea', 'FallbackIntent', 'citas', 'prestamo', 'movimientos', ''], dtype=object)
+INTENT_WEIGHTS = [0.25, 0.1, 0.1, 0.15, 0.15, 0.15, 0.1]
+DOMAINS = np.array(['creditos', 'ahorro', 'general', 'tarjetas', ''], dtype=object)
+RESPONSES = np.array([
+    'Claro, con gusto te ayudo.', 'Tu saldo disponible es de $1,234.56.', 'No entendí tu solicitud, ¿puedes repetirla?',
+    'Te comunico con un asesor.', 'Tu cita quedó agendada.', None,
+], dtype=object)
+TRANSCRIPTS = np.array([
+    'hola', 'quiero saber mi saldo', 'hablar con un asesor', 'agendar una cita', 'cuánto debo de mi préstamo', None,
+], dtype=object)
+CONFIGURATIONS = np.array(['bot-creditos', 'bot-ahorro', 'bot-general'], dtype=object)
+CHANNELS = np.array(['whatsapp', 'text', 'speech'], dtype=object)
+CHANNEL_WEIGHTS = [0.5, 0.3, 0.2]
+
+# Claves de contacto de session_attributes (ver clean_data.CURP_COLS/EMAIL_COLS/PHONE_COLS)
+CONTACT_KEYS = ['curp', 'correo', 'correoElectronico', 'correo_WA', 'email',
+                'telefono', 'numeroCelular', 'phoneNumber', 'tel1', 'telefono1_WA', 'telefonos', 'tels']
+# Claves que la transformación no usa pero que vienen en los logs reales
+OTHER_SLOT_KEYS = ['clavecliente', 'sucursal', 'estado', 'foliocita']
+
+
+def get_session_id(channel: str, number: int) -> str:
+    if channel == 'whatsapp':
+        return f"whatsapp:+52155{number % 100_000_000:08d}"
+    if channel == 'text':
+        return f"us-east-1:{number:08x}-4c1a-9f0e-{number * 7919 % 16 ** 12:012x}"
+    return f"{number:012d}"
+
+
+def get_contact_value(key: str, session_number: int) -> str:
+    if key == 'curp':
+        return f"GOMA{session_number % 1_000_000:06d}HDFRRN0{session_number % 10}"
+    if key.startswith(('correo', 'email')):
+        return f"cliente{session_number}@example.com"
+    return f"55{session_number % 100_000_000:08d}"
+
+
+def generate_log_rows(rows: int, seed: int = 0, day: str = '2025-03-04', max_turns: int = 12,
+                      contact_rate: float = 0.3, first_session: int = 0) -> pd.DataFrame:
+    """
+    Genera rows filas de log agrupadas por sesión (de 1 a max_turns turnos cada una).
+    contact_rate es la fracción de sesiones que dejan algún dato de contacto; dentro de esas
+    sesiones el dato aparece solo en algunos turnos y en una de varias claves posibles.
+    first_session permite generar varios lotes sin repetir sessionid (ver iter_log_pages).
+    """
+    rng = np.random.default_rng(seed)
+
+    # Sesiones y turnos: cada fila pertenece a una sesión y ocupa un turno dentro de ella
+    turns = rng.integers(1, max_turns + 1, size=rows)
+    turns = turns[:int(np.searchsorted(np.cumsum(turns), rows)) + 1]
+    sessions = len(turns)
+    session_of_row = np.repeat(np.arange(sessions), turns)[:rows]
+    first_row = np.cumsum(turns) - turns
+    turn_of_row = np.arange(rows) - first_row[session_of_row]
+
+    channels = CHANNELS[rng.choice(len(CHANNELS), size=sessions, p=CHANNEL_WEIGHTS)]
+    session_numbers = first_session + np.arange(sessions)
+    session_ids = np.array([get_session_id(channel, number) for channel, number in zip(channels, session_numbers)], dtype=object)
+    # Algunos registros no traen sessionid (p. ej. errores del bot)
+    session_ids[rng.random(sessions) < 0.01] = None
+    has_contact = rng.random(sessions) < contact_rate
+
+    # Marca de tiempo: inicio de la sesión en el día más los segundos entre turnos
+    session_start = rng.integers(0, 80_000_000_000, size=sessions)  # microsegundos
+    gaps = rng.exponential(45_000_000, size=rows).astype(np.int64)
+    gaps[turn_of_row == 0] = 0
+    elapsed = np.cumsum(gaps)
+    elapsed -= elapsed[first_row][session_of_row]
+    timestamps = pd.Timestamp(day, tz='UTC') + pd.to_timedelta(session_start[session_of_row] + elapsed, unit='us')
+
+    intents = INTENTS[rng.choice(len(INTENTS), size=rows, p=INTENT_WEIGHTS)]
+    domains = DOMAINS[rng.integers(0, len(DOMAINS), size=rows)]
+    responses = RESPONSES[rng.integers(0, len(RESPONSES), size=rows)]
+    transcripts = TRANSCRIPTS[rng.integers(0, len(TRANSCRIPTS), size=rows)]
+    configurations = CONFIGURATIONS[rng.integers(0, len(CONFIGURATIONS), size=sessions)]
+    log_words = rng.integers(0, 30, size=rows)
+    draws = rng.random((rows, 5))
+    contact_keys = rng.integers(0, len(CONTACT_KEYS), size=rows)
+
+    resources = {}
+    payloads = []
+    for row in range(rows):
+        session = session_of_row[row]
+        channel = channels[session]
+        attributes = {
+            'botname': 'AsistenteDigital',
+            'inputmode': 'Speech' if channel == 'speech' else 'Text',
+            'conversation_log': 'bot: hola, user: ' * log_words[row],
+            'inputtranscript': transcripts[row],
+        }
+        if session_ids[session] is not None:
+            attributes['sessionid'] = session_ids[session]
+        if has_contact[session] and draws[row, 0] < 0.3:
+            key = CONTACT_KEYS[contact_keys[row]]
+            attributes[key] = get_contact_value(key, session_numbers[session])
+        if draws[row, 1] < 0.1:
+            attributes[OTHER_SLOT_KEYS[row % len(OTHER_SLOT_KEYS)]] = f"valor{row % 1000}"
+
+        intent_information = {
+            'knowledge_domain': domains[row],
+            'origin_channel': channel,
+            'transactional_or_non_transactional': 'transactional' if draws[row, 2] < 0.3 else 'non_transactional',
+        }
+        # El primer turno no trae intent; los demás a veces tampoco
+        if turn_of_row[row] > 0 and draws[row, 3] < 0.8:
+            intent_information['intent_name'] = intents[row]
+
+        payload = {
+            'intent_information': intent_information,
+            'gemini_final_response': {'final_response': responses[row], 'model': 'gemini'},
+            'session_attributes': attributes,
+        }
+        if draws[row, 4] < 0.03:
+            payload['slot_type'] = 'monto'
+        payloads.append(payload)
+
+        configuration = configurations[session]
+        if configuration not in resources:
+            resources[configuration] = {
+                'type': 'cloud_run_revision',
+                'labels': {
+                    'configuration_name': configuration, 'project_id': 'asistentes-digitales',
+                    'location': 'us-central1', 'service_name': configuration, 'revision_name': f"{configuration}-00042",
+                },
+            }
+
+    return pd.DataFrame({
+        'timestamp': timestamps,
+        'severity': 'INFO',
+        'logName': 'projects/asistentes-digitales/logs/run.googleapis.com%2Fstdout',
+        'resource': [resources[configurations[session]] for session in session_of_row],
+        'jsonPayload': payloads,
+    })
+
+
+def iter_log_pages(rows: int, page_size: int = 100_000, seed: int = 0, **options):
+    """
+    Genera rows filas en páginas de page_size, con sesiones contiguas que no cruzan páginas,
+    para producir escalas grandes (p. ej. 10M filas) sin tener todo en memoria a la vez.
+    """
+    first_session = 0
+    for page, start in enumerate(range(0, rows, page_size)):
+        page_df = generate_log_rows(min(page_size, rows - start), seed=seed + page, first_session=first_session, **options)
+        first_session += page_size
+        yield page_df
@@ -0,0 +1,87 @@
+import json
+import os
+import datetime
+import pandas as pd
+
+
+def parse_s3_location(location: str):
+    """
+    Separa 's3://bucket/ruta/objeto' en (bucket, key).
+    """
+    bucket, _, key = location[len("s3://"):].partition("/")
+    return bucket, key
+
+
+def load_state(location: str, s3_client=None) -> dict:
+    """
+    Lee el estado del modo incremental desde S3 ('s3://...') o desde un archivo local.
+    Devuelve un diccionario vacío si todavía no existe.
+    """
+    if location.startswith("s3://"):
+        bucket, key = parse_s3_location(location)
+        try:
+            response = s3_client.get_object(Bucket=bucket, Key=key)
+        except s3_client.exceptions.NoSuchKey:
+            return {}
+        return json.loads(response["Body"].read())
+
+    if not os.path.exists(location):
+        return {}
+    with open(location) as state_file:
+        return json.load(state_file)
+
+
+def save_state(location: str, state: dict, s3_client=None):
+    """
+    Guarda el estado del modo incremental en S3 o en un archivo local (escritura atómica).
+    """
+    body = json.dumps(state, indent=2, sort_keys=True)
+    if location.startswith("s3://"):
+        bucket, key = parse_s3_location(location)
+        s3_client.put_object(Bucket=bucket, Key=key, Body=body.encode("utf-8"))
+        return
+
+    directory = os.path.dirname(location)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    temp_location = f"{location}.tmp"
+    with open(temp_location, "w") as state_file:
+        state_file.write(body)
+    os.replace(temp_location, location)
+
+
+def get_watermark(state: dict, default: datetime.datetime) -> pd.Timestamp:
+    """
+    Marca de agua (UTC): todas las sesiones cuya última actividad es anterior ya fueron cargadas.
+    """
+    watermark = state.get("watermark")
+    return pd.Timestamp(watermark) if watermark else pd.Timestamp(default)
+
+
+def select_closed_sessions(session_ids: pd.Series, timestamps: pd.Series, state: dict,
+                           new_watermark: pd.Timestamp, overlap: datetime.timedelta):
+    """
+    Decide qué sesiones se cargan en esta ejecución.
+    Una sesión se carga cuando está cerrada (su última actividad es anterior a new_watermark)
+    y no se cargó antes. Las sesiones abiertas se dejan para la siguiente ejecución, que las
+    vuelve a leer completas.
+    Devuelve (máscara de filas a transformar, nuevo estado).
+    """
+    last_seen = timestamps.groupby(session_ids).max()
+    emitted = {
+        session_id: pd.Timestamp(seen) for session_id, seen in state.get("emitted_sessions", {}).items()
+    }
+
+    closed = last_seen[last_seen <= new_watermark]
+    to_emit = closed[~closed.index.isin(list(emitted))]
+
+    emitted.update(to_emit.to_dict())
+    # Solo hace falta recordar las sesiones que la ventana de solapamiento puede volver a leer
+    keep_after = new_watermark - overlap
+    new_state = {
+        "watermark": new_watermark.isoformat(),
+        "emitted_sessions": {
+            session_id: seen.isoformat() for session_id, seen in emitted.items() if seen >= keep_after
+        },
+    }
+    return session_ids.isin(to_emit.index), new_state